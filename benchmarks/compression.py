@@ -0,0 +1,74 @@
+"""
+Compression codec benchmark.
+
+Generates a synthetic volume tree and reports throughput and compression ratio
+for every codec supported by main.py:
+
+    python benchmarks/compression.py --files 2000 --level 6
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py validates its configuration at import time
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('BOT_DEST', '0')
+
+import main  # noqa: E402
+from synthetic import generate_volume  # noqa: E402
+
+
+class CountingSink:
+    """Discards everything written while counting the bytes"""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+
+def run_codec(volume_path, codec, level):
+    sink = CountingSink()
+    started = time.perf_counter()
+    main.write_tar_stream(volume_path, sink, codec=codec, level=level)
+    return time.perf_counter() - started, sink.bytes_written
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000, help="number of files in the synthetic volume")
+    parser.add_argument('--compressibility', type=float, default=0.6, help="share of text-like data per file")
+    parser.add_argument('--level', type=int, default=None, help="compression level (codec default if omitted)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="codec-bench-")
+    try:
+        volume_path = os.path.join(work_dir, "volume")
+        generate_volume(volume_path, args.files, compressibility=args.compressibility, seed=args.seed)
+        _, tar_bytes = run_codec(volume_path, 'none', 0)
+        print(f"Synthetic volume: {args.files} files, {tar_bytes / (1024 * 1024):.1f} MB tar stream, "
+              f"{main.COMPRESSION_THREADS} compression threads")
+        print(f"{'codec':<8}{'level':>6}{'seconds':>10}{'MB/s':>10}{'ratio':>8}")
+
+        for codec in main.ARCHIVE_SUFFIXES:
+            if codec == 'zstd' and main.zstandard is None:
+                print(f"{codec:<8}  skipped (zstandard not installed)")
+                continue
+            level = args.level if args.level is not None else main.DEFAULT_COMPRESSION_LEVELS[codec]
+            seconds, compressed_bytes = run_codec(volume_path, codec, level)
+            throughput = tar_bytes / (1024 * 1024) / seconds
+            ratio = compressed_bytes / tar_bytes
+            print(f"{codec:<8}{level:>6}{seconds:>10.2f}{throughput:>10.1f}{ratio:>8.3f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,200 @@
+"""
+Docker Engine API client benchmark.
+
+Serves a fake Engine API on a local unix socket with many containers, then
+times container discovery and streaming a database dump through `exec`:
+
+    python benchmarks/docker_api.py --containers 200 --dump-mb 256
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py validates its configuration at import time
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('BOT_DEST', '0')
+
+import main  # noqa: E402
+
+IMAGES = ['nginx:1.25', 'redis:7', 'postgres:16', 'mysql:8.0', 'node:20', 'grafana/grafana']
+
+
+def make_containers(count):
+    containers = []
+    for index in range(count):
+        image = IMAGES[index % len(IMAGES)]
+        containers.append({
+            'Id': f"{index:064x}",
+            'Names': [f"/app{index}"],
+            'Image': image,
+            'State': 'running',
+            'Status': 'Up 2 hours',
+            'Mounts': [{'Type': 'bind', 'Source': f"/var/lib/docker/volumes/app{index}/_data",
+                        'Destination': '/data'}],
+        })
+    return containers
+
+
+def frame(stream_type, data):
+    return bytes([stream_type, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    """Answers the handful of Engine API endpoints main.py uses"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        engine = self.server.engine
+        path = re.sub(r'^/v[0-9.]+', '', self.path)
+        if path.startswith('/containers/json'):
+            return self.send_json(engine.containers)
+        match = re.fullmatch(r'/containers/([^/]+)/json', path)
+        if match:
+            container = engine.find(match.group(1))
+            if container is None:
+                return self.send_json({'message': f"No such container: {match.group(1)}"}, 404)
+            return self.send_json({'Id': container['Id'], 'Name': container['Names'][0],
+                                   'State': {'Running': container['State'] == 'running'}})
+        match = re.fullmatch(r'/exec/([^/]+)/json', path)
+        if match:
+            return self.send_json({'Running': False, 'ExitCode': engine.execs[match.group(1)]['exit_code']})
+        self.send_json({'message': 'page not found'}, 404)
+
+    def do_POST(self):
+        engine = self.server.engine
+        path = re.sub(r'^/v[0-9.]+', '', self.path)
+        body = self.read_json()
+        match = re.fullmatch(r'/containers/([^/]+)/exec', path)
+        if match:
+            if engine.find(match.group(1)) is None:
+                return self.send_json({'message': f"No such container: {match.group(1)}"}, 404)
+            exec_id = f"{len(engine.execs):064x}"
+            engine.execs[exec_id] = {'cmd': body['Cmd'], 'exit_code': None}
+            return self.send_json({'Id': exec_id}, 201)
+        match = re.fullmatch(r'/exec/([^/]+)/start', path)
+        if match:
+            session = engine.execs[match.group(1)]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            session['exit_code'] = engine.run(session['cmd'], self.wfile)
+            self.close_connection = True
+            return
+        self.send_json({'message': 'page not found'}, 404)
+
+
+class FakeDockerEngine(socketserver.ThreadingUnixStreamServer):
+    """Fake Engine API on a unix socket. `ps` reports mysqld, mysqldump streams `dump_bytes` of SQL"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, containers, dump_bytes):
+        super().__init__(socket_path, FakeDockerHandler)
+        self.engine = self
+        self.containers = containers
+        self.dump_bytes = dump_bytes
+        self.execs = {}
+
+    def find(self, name):
+        for container in self.containers:
+            if name in (container['Id'], container['Names'][0].lstrip('/')):
+                return container
+        return None
+
+    def run(self, cmd, output):
+        if cmd[0] == 'ps':
+            output.write(frame(1, b"PID USER COMMAND\n1 mysql mysqld --user=mysql\n"))
+            return 0
+        if cmd[0] == 'mysqldump':
+            line = b"INSERT INTO events VALUES (1, 'backup', '2024-01-01 00:00:00');\n"
+            block = line * (64 * 1024 // len(line))
+            output.write(frame(2, b"mysqldump: [Warning] Using a password on the command line\n"))
+            sent = 0
+            while sent < self.dump_bytes:
+                data = block[:self.dump_bytes - sent]
+                output.write(frame(1, data))
+                sent += len(data)
+            return 0
+        output.write(frame(2, f"exec: \"{cmd[0]}\": executable file not found\n".encode()))
+        return 127
+
+
+class NullWriter:
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--containers', type=int, default=200)
+    parser.add_argument('--dump-mb', type=int, default=256, help="size of the fake mysqldump output")
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="docker-api-bench-")
+    socket_path = os.path.join(work_dir, "docker.sock")
+    server = FakeDockerEngine(socket_path, make_containers(args.containers), args.dump_mb * 1024 * 1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    main.docker_client = main.DockerClient(socket_path)
+    try:
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            databases = main.detect_database_volumes()
+        discovery_ms = (time.perf_counter() - started) / args.rounds * 1000
+        print(f"Discovery: {args.containers} containers, {len(databases)} databases in {discovery_ms:.1f} ms")
+
+        started = time.perf_counter()
+        db_type, dump_cmd = main.get_dump_command('app3')
+        stream = main.docker_client.exec_stream('app3', dump_cmd)
+        sink = NullWriter()
+        dumped = 0
+        while True:
+            data = stream.read(main.DB_DUMP_READ_SIZE)
+            if not data:
+                break
+            dumped += len(data)
+            sink.write(data)
+        exit_code = stream.wait()
+        seconds = time.perf_counter() - started
+        print(f"Exec stream: {dumped / (1024 * 1024):.0f} MB {db_type} dump in {seconds:.2f}s "
+              f"({dumped / (1024 * 1024) / seconds:.0f} MB/s), exit code {exit_code}, "
+              f"stderr: {stream.stderr_text()!r}")
+        if dumped != args.dump_mb * 1024 * 1024 or exit_code != 0:
+            sys.exit("Exec stream returned the wrong output")
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,173 @@
+"""
+Encryption benchmark.
+
+Measures the CPU time per GB of the chunked AEAD framing of main.py for each
+cipher, then tars a synthetic volume three ways: unencrypted, encrypted in
+the same stream as compression (what main.py does), and encrypted by a
+second pass over the finished archive, as a separate `gpg` run would (same
+cipher, so only the extra pass differs). Reports wall and CPU time and the
+bytes read and written through the kernel (rchar/wchar of /proc/self/io,
+which include reading the volume), and checks the encrypted archive
+decrypts to the same tar stream:
+
+    python benchmarks/encryption.py --mb 512 --files 5000 --codec pgzip
+"""
+import argparse
+import base64
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py validates its configuration at import time, encryption needs a master key
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('BOT_DEST', '0')
+os.environ.setdefault('ENCRYPTION_KEY', base64.b64encode(os.urandom(32)).decode())
+
+import main  # noqa: E402
+from synthetic import generate_volume  # noqa: E402
+
+
+class NullFile:
+    """Discards what is written to it"""
+
+    def write(self, data):
+        return len(data)
+
+
+def io_counters():
+    """Bytes read and written through syscalls by this process so far"""
+    counters = {}
+    with open('/proc/self/io') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            counters[name] = int(value)
+    return counters['rchar'], counters['wchar']
+
+
+def measure(function, *args):
+    read_before, written_before = io_counters()
+    started_cpu = time.process_time()
+    started = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - started
+    cpu_seconds = time.process_time() - started_cpu
+    read_after, written_after = io_counters()
+    return seconds, cpu_seconds, read_after - read_before, written_after - written_before, result
+
+
+def encrypt_stream(data, total_bytes, output):
+    encryptor = main.EncryptingWriter(output, main.new_data_key())
+    written = 0
+    while written < total_bytes:
+        encryptor.write(data)
+        written += len(data)
+    encryptor.close()
+
+
+def decrypt_stream(blob):
+    reader = main.DecryptingReader(io.BytesIO(blob))
+    while reader.read(main.TAR_WRITE_SIZE):
+        pass
+
+
+def plain_archive(volume_path, archive_path, codec):
+    with open(archive_path, 'wb') as output:
+        main.write_tar_stream(volume_path, output, codec=codec)
+
+
+def encrypted_archive(volume_path, archive_path, codec):
+    with open(archive_path, 'wb') as output:
+        main.write_tar_stream(volume_path, output, codec=codec, data_key=main.new_data_key())
+
+
+def two_pass_archive(volume_path, archive_path, codec):
+    """Unencrypted archive first, then read back and encrypted into a second file"""
+    plain_path = archive_path + ".plain"
+    plain_archive(volume_path, plain_path, codec)
+    with open(plain_path, 'rb') as source, open(archive_path, 'wb') as output:
+        encryptor = main.EncryptingWriter(output, main.new_data_key())
+        shutil.copyfileobj(source, encryptor, main.TAR_WRITE_SIZE)
+        encryptor.close()
+    os.remove(plain_path)
+
+
+def tar_digest(archive_path):
+    """SHA-256 of the tar stream in an archive, decrypting it if needed"""
+    digest = hashlib.sha256()
+    with open(archive_path, 'rb') as archive:
+        stream = main.open_decompressor(archive, archive_path)
+        while True:
+            data = stream.read(main.TAR_WRITE_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mb', type=int, default=256, help="data encrypted and decrypted per cipher")
+    parser.add_argument('--files', type=int, default=2000, help="number of files in the synthetic volume")
+    parser.add_argument('--max-size', type=int, default=1024 * 1024, help="largest file in bytes (log-uniform)")
+    parser.add_argument('--compressibility', type=float, default=0.6, help="share of text-like data per file")
+    parser.add_argument('--codec', default=main.COMPRESSION, choices=list(main.ARCHIVE_SUFFIXES))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    total_bytes = args.mb * 1024 * 1024
+    data = os.urandom(main.TAR_WRITE_SIZE)
+    print(f"Ciphers: {args.mb} MB in writes of {main.TAR_WRITE_SIZE // 1024} KB, "
+          f"chunks of {main.ENCRYPTION_CHUNK_SIZE // 1024} KB")
+    print(f"{'cipher':<10}{'encrypt MB/s':>14}{'cpu s/GB':>10}{'decrypt MB/s':>14}{'cpu s/GB':>10}{'overhead':>10}")
+    for cipher in main.ENCRYPTION_CIPHER_IDS:
+        main.ENCRYPTION_CIPHER = cipher
+        seconds, cpu_seconds, _, _, _ = measure(encrypt_stream, data, total_bytes, NullFile())
+        output = io.BytesIO()
+        encrypt_stream(data, total_bytes, output)
+        blob = output.getvalue()
+        decrypt_seconds, decrypt_cpu_seconds, _, _, _ = measure(decrypt_stream, blob)
+        print(f"{cipher:<10}{args.mb / seconds:>14.0f}{cpu_seconds * 1024 / args.mb:>10.2f}"
+              f"{args.mb / decrypt_seconds:>14.0f}{decrypt_cpu_seconds * 1024 / args.mb:>10.2f}"
+              f"{(len(blob) - total_bytes) / total_bytes:>9.4%}")
+        del blob, output
+    main.ENCRYPTION_CIPHER = os.environ.get('ENCRYPTION_CIPHER', 'aes-gcm')
+
+    work_dir = tempfile.mkdtemp(prefix="encryption-bench-")
+    try:
+        volume_path = os.path.join(work_dir, "volume")
+        volume_bytes = generate_volume(volume_path, args.files, max_size=args.max_size,
+                                       compressibility=args.compressibility, seed=args.seed)
+        print(f"\nVolume: {args.files} files, {volume_bytes / (1024 * 1024):.1f} MB, codec {args.codec}, "
+              f"cipher {main.ENCRYPTION_CIPHER}")
+        print(f"{'archive':<12}{'seconds':>10}{'cpu s':>10}{'MB read':>10}{'MB written':>12}{'MB out':>10}")
+        results = {}
+        archives = {}
+        for name, function in (('plain', plain_archive), ('in-stream', encrypted_archive),
+                               ('two-pass', two_pass_archive)):
+            archives[name] = os.path.join(work_dir, f"{name}{main.ARCHIVE_SUFFIXES[args.codec]}")
+            results[name] = measure(function, volume_path, archives[name], args.codec)
+            seconds, cpu_seconds, read_bytes, written_bytes, _ = results[name]
+            print(f"{name:<12}{seconds:>10.2f}{cpu_seconds:>10.2f}{read_bytes / (1024 * 1024):>10.1f}"
+                  f"{written_bytes / (1024 * 1024):>12.1f}{os.path.getsize(archives[name]) / (1024 * 1024):>10.1f}")
+
+        gigabytes = volume_bytes / (1024 ** 3)
+        for name in ('in-stream', 'two-pass'):
+            extra_cpu = results[name][1] - results['plain'][1]
+            extra_io = (results[name][2] + results[name][3] - results['plain'][2] - results['plain'][3])
+            print(f"{name}: {extra_cpu / gigabytes:+.2f} CPU s per GB of volume, "
+                  f"{extra_io / (1024 * 1024):+.1f} MB of extra disk I/O")
+
+        if tar_digest(archives['in-stream']) != tar_digest(archives['plain']):
+            sys.exit("The encrypted archive does not decrypt to the same tar stream")
+        print("The encrypted archive decrypts to the same tar stream")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_benchmark()
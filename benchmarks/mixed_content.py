@@ -0,0 +1,147 @@
+"""
+Mixed-content archive benchmark.
+
+Generates a volume of media-like files (random data, some with a .jpg or .mp4
+extension), text logs and many tiny files, then tars it with tarfile.add, as
+main.py used to, and with the current writer, which stores incompressible
+files and batches small ones. Reports CPU time, archive size and the CPU time
+main.py estimates it saved, and checks that both archives restore the same
+tree:
+
+    python benchmarks/mixed_content.py --media-mb 512 --tiny-files 100000
+"""
+import argparse
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py validates its configuration at import time
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('BOT_DEST', '0')
+
+import main  # noqa: E402
+from synthetic import make_content  # noqa: E402
+
+
+class CountingFile:
+    """Writes to a file while counting the bytes"""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def generate_mixed_volume(path, media_mb, log_mb, tiny_files, seed=0):
+    rng = random.Random(seed)
+    media_dir = os.path.join(path, "media")
+    os.makedirs(media_dir)
+    written = 0
+    index = 0
+    while written < media_mb * 1024 * 1024:
+        size = rng.randint(256 * 1024, 8 * 1024 * 1024)
+        # A third has no telling extension and is found by sampling
+        extension = ('.jpg', '.mp4', '.bin')[index % 3]
+        with open(os.path.join(media_dir, f"m{index:05d}{extension}"), 'wb') as f:
+            f.write(rng.randbytes(size))
+        written += size
+        index += 1
+    logs_dir = os.path.join(path, "logs")
+    os.makedirs(logs_dir)
+    for index in range(max(log_mb // 8, 1)):
+        with open(os.path.join(logs_dir, f"app{index}.log"), 'wb') as f:
+            f.write(make_content(rng, min(log_mb, 8) * 1024 * 1024, 1.0))
+    for index in range(tiny_files):
+        directory = os.path.join(path, "sessions", f"{index // 1000:04d}")
+        if index % 1000 == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f"s{index:07d}.json"), 'wb') as f:
+            f.write(make_content(rng, rng.randint(64, 2048), 0.9))
+
+
+def legacy_tar(volume_path, output_path, codec, level):
+    """The previous tarfile.add based writer, kept as the reference"""
+    output = CountingFile(output_path)
+    compressor = main.open_compressor(output, codec, level)
+    with tarfile.open(fileobj=compressor, mode='w|') as tar:
+        tar.add(volume_path, arcname=os.path.basename(volume_path))
+    compressor.close()
+    output.close()
+    return output.bytes_written, {}
+
+
+def current_tar(volume_path, output_path, codec, level):
+    output = CountingFile(output_path)
+    stats = {}
+    main.write_tar_stream(volume_path, output, codec=codec, level=level, stats=stats)
+    output.close()
+    return output.bytes_written, stats
+
+
+def measure(function, *args):
+    started_cpu = time.process_time()
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, time.process_time() - started_cpu, result
+
+
+def same_tree(left, right):
+    comparison = filecmp.dircmp(left, right)
+    if comparison.left_only or comparison.right_only or comparison.funny_files:
+        return False
+    for name in comparison.common_files:
+        if not filecmp.cmp(os.path.join(left, name), os.path.join(right, name), shallow=False):
+            return False
+    return all(same_tree(os.path.join(left, name), os.path.join(right, name)) for name in comparison.common_dirs)
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--media-mb', type=int, default=512, help="incompressible data in the volume")
+    parser.add_argument('--log-mb', type=int, default=64, help="text logs in the volume")
+    parser.add_argument('--tiny-files', type=int, default=100000, help="JSON files of 64 B to 2 KB")
+    parser.add_argument('--codec', default=main.COMPRESSION, choices=list(main.ARCHIVE_SUFFIXES))
+    parser.add_argument('--level', type=int, default=None, help="compression level (codec default if omitted)")
+    args = parser.parse_args()
+    level = args.level if args.level is not None else main.DEFAULT_COMPRESSION_LEVELS[args.codec]
+
+    work_dir = tempfile.mkdtemp(prefix="mixed-bench-")
+    try:
+        volume_path = os.path.join(work_dir, "volume")
+        generate_mixed_volume(volume_path, args.media_mb, args.log_mb, args.tiny_files)
+        print(f"Volume: {args.media_mb} MB media, {args.log_mb} MB logs, {args.tiny_files} tiny files, "
+              f"codec {args.codec} level {level}")
+        print(f"{'writer':<10}{'seconds':>10}{'cpu s':>10}{'MB out':>10}{'stored MB':>11}{'est. saved':>12}")
+        archives = {}
+        for name, function in (('tarfile', legacy_tar), ('current', current_tar)):
+            archives[name] = os.path.join(work_dir, f"{name}{main.ARCHIVE_SUFFIXES[args.codec]}")
+            seconds, cpu_seconds, (size, stats) = measure(function, volume_path, archives[name], args.codec, level)
+            print(f"{name:<10}{seconds:>10.2f}{cpu_seconds:>10.2f}{size / (1024 * 1024):>10.1f}"
+                  f"{stats.get('stored_bytes', 0) / (1024 * 1024):>11.1f}{stats.get('cpu_saved', 0):>11.2f}s")
+
+        for name, archive_path in archives.items():
+            target_dir = os.path.join(work_dir, f"restore-{name}")
+            os.makedirs(target_dir)
+            with open(archive_path, 'rb') as archive:
+                main.extract_archive_stream(main.open_decompressor(archive, archive_path), target_dir)
+            if not same_tree(volume_path, os.path.join(target_dir, "volume")):
+                sys.exit(f"The {name} archive does not restore the volume")
+        print("Both archives restore the volume")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_benchmark()
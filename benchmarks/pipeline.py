@@ -0,0 +1,416 @@
+"""
+End-to-end pipeline benchmark.
+
+Generates reproducible synthetic volumes, starts a local S3 stand-in (a moto
+server process, or any endpoint given with --endpoint) and runs a full
+main.py backup against it with a stubbed Telegram bot. Reports scan time,
+compression and upload MB/s, peak RSS and the temp-disk high-water mark, and
+appends the results to a JSON file, compared with the last run of the same
+setup:
+
+    python benchmarks/pipeline.py --volumes 4 --files 5000 --max-size 1048576 \\
+        --set COMPRESSION=zstd --set COMPRESS_WORKERS=4
+
+--change-percent rewrites part of the files after the first backup and runs
+a second one, which measures change detection and incremental backups.
+Settings of main.py are passed with --set and recorded with the results.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from synthetic import generate_volume, make_content  # noqa: E402
+
+# Settings of main.py recorded with every run, runs are only compared when they match
+RECORDED_SETTINGS = ('BACKUP_FORMAT', 'BACKUP_MODE', 'COMPRESSION', 'COMPRESSION_LEVEL', 'COMPRESSION_THREADS',
+                     'SKIP_COMPRESSION', 'STREAM_UPLOAD', 'COMPRESS_WORKERS', 'UPLOAD_WORKERS', 'SEGMENT_WORKERS',
+                     'LARGE_FILE_THRESHOLD', 'SCAN_WORKERS', 'MANIFEST_HASH', 'MAX_INFLIGHT_TMP_MB',
+                     'S3_MULTIPART_CHUNKSIZE_MB', 'S3_MAX_CONCURRENCY')
+# Phases that compress (and upload) in one pass, see RunMetrics
+COMBINED_PHASES = ('stream', 'segmented', 'chunked')
+
+
+class StubBot:
+    """Stands in for telebot.TeleBot, records the calls and answers after `delay` seconds"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self.longest_message = 0
+
+    def _answer(self, text=""):
+        time.sleep(self.delay)
+        self.calls += 1
+        self.longest_message = max(self.longest_message, len(text))
+        return types.SimpleNamespace(message_id=self.calls)
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        return self._answer(text)
+
+    def edit_message_text(self, text, chat_id, message_id, parse_mode=None):
+        return self._answer(text)
+
+    def send_document(self, chat_id, document):
+        return self._answer()
+
+
+class DiskSampler:
+    """Samples the disk space used by the files under `path` every `interval` seconds, keeping the peak"""
+
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _usage(self, path):
+        used = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            used += self._usage(entry.path)
+                        else:
+                            used += entry.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return used
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, self._usage(self.path))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_backup_process(connection, bot_delay):
+    """Child process: one `main.py backup` run, its metrics go back through `connection`"""
+    # Imported here, so main.py reads the settings the parent put in the environment
+    import main
+    bot = StubBot(bot_delay)
+    main.notifier.bot = bot
+    # The run ends by waiting for the Telegram queue, timed apart from the backup
+    flush = main.notifier.flush
+    flush_started = []
+    def timed_flush(timeout):
+        flush_started.append(time.perf_counter())
+        return flush(timeout)
+    main.notifier.flush = timed_flush
+    with DiskSampler(main.TMP_DIR) as sampler:
+        started = time.perf_counter()
+        main.run_backup(include_databases=False)
+        finished = time.perf_counter()
+    backup_finished = flush_started[0] if flush_started else finished
+    connection.send({
+        'seconds': backup_finished - started,
+        'telegram_wait_seconds': finished - backup_finished,
+        'report': main.run_metrics.report(),
+        'settings': {**{name: getattr(main, name) for name in RECORDED_SETTINGS},
+                     'ENCRYPTION_CIPHER': main.ENCRYPTION_CIPHER if main.encryption_key_id else None},
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        # Compression worker processes, reaped when their pool shut down
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'tmp_peak_mb': sampler.peak_bytes / (1024 * 1024),
+        'telegram_calls': bot.calls,
+        'longest_message': bot.longest_message,
+    })
+
+
+def run_backup(bot_delay):
+    """Run one backup in a fresh process, so peak RSS covers that run only"""
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_backup_process, args=(sender, bot_delay))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        sys.exit(f"The backup process failed (exit code {process.exitcode})")
+    return result
+
+
+def mb_per_s(size_bytes, seconds):
+    return size_bytes / (1024 * 1024) / seconds if seconds > 0 else 0
+
+
+def summarize(result, source_bytes, bucket, changed_bytes=None):
+    """
+    Headline numbers of a run. Phase seconds are summed over the volumes
+    processed in parallel, end to end MB/s covers all the volume data
+    """
+    phases = result['report']['phases']
+    combined = next((phase for phase in COMBINED_PHASES if phase in phases), None)
+    compress = phases.get('compress') or phases.get(combined)
+    upload = phases.get('upload')
+    return {
+        'seconds': result['seconds'],
+        'source_mb': source_bytes / (1024 * 1024),
+        'changed_mb': changed_bytes / (1024 * 1024) if changed_bytes is not None else None,
+        'end_to_end_mb_per_s': mb_per_s(source_bytes, result['seconds']),
+        'scan_seconds': phases.get('scan', {}).get('seconds', 0),
+        # Tar stream read per second of compression
+        'compression_mb_per_s': mb_per_s(compress['bytes_in'], compress['seconds']) if compress else None,
+        # Compressed bytes sent per second of upload, part of the combined phase when there is one
+        'upload_mb_per_s': mb_per_s(upload['bytes_out'], upload['seconds']) if upload else None,
+        'combined_phase': combined,
+        'stored_mb': bucket['bytes'] / (1024 * 1024),
+        'objects': bucket['objects'],
+        'peak_rss_mb': result['peak_rss_mb'],
+        'peak_worker_rss_mb': result['peak_worker_rss_mb'],
+        'tmp_peak_mb': result['tmp_peak_mb'],
+        'telegram_calls': result['telegram_calls'],
+        'telegram_wait_seconds': result['telegram_wait_seconds'],
+        'counts': result['report']['counts'],
+        'phases': phases,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_moto_server():
+    """Start a moto S3 server in a process of its own, so its memory is not counted as the backup's"""
+    try:
+        import moto.server  # noqa: F401
+    except ImportError:
+        sys.exit("moto is not installed: pip install 'moto[server]', or pass --endpoint")
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    endpoint = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            urllib.request.urlopen(endpoint, timeout=1)
+            return server, endpoint
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                sys.exit("Cannot start the moto server")
+            time.sleep(0.2)
+
+
+def bucket_usage(s3_client, bucket, prefix):
+    usage = {'objects': 0, 'bytes': 0}
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            usage['objects'] += 1
+            usage['bytes'] += item['Size']
+    return usage
+
+
+def prepare_volumes(data_dir, args):
+    """Generate the volumes, or reuse the ones in `data_dir` generated with the same parameters"""
+    params = {'volumes': args.volumes, 'files': args.files, 'min_size': args.min_size, 'max_size': args.max_size,
+              'compressibility': args.compressibility, 'files_per_dir': args.files_per_dir, 'seed': args.seed}
+    params_file = os.path.join(data_dir, "params.json")
+    volumes_dir = os.path.join(data_dir, "volumes")
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            stored = json.load(f)
+        if stored['params'] == params:
+            print(f"Reusing {args.volumes} volumes in [{volumes_dir}]")
+            return volumes_dir, stored['bytes'], params
+    shutil.rmtree(volumes_dir, ignore_errors=True)
+    if os.path.exists(params_file):
+        os.remove(params_file)
+    started = time.perf_counter()
+    total_bytes = 0
+    for index in range(args.volumes):
+        total_bytes += generate_volume(os.path.join(volumes_dir, f"bench{index:03d}_data"), args.files,
+                                       args.min_size, args.max_size, args.compressibility, args.files_per_dir,
+                                       seed=args.seed + index)
+    print(f"Generated {args.volumes} volumes of {args.files} files, {total_bytes / (1024 * 1024):.1f} MB "
+          f"in {time.perf_counter() - started:.1f}s")
+    with open(params_file, 'w') as f:
+        json.dump({'params': params, 'bytes': total_bytes}, f)
+    return volumes_dir, total_bytes, params
+
+
+def change_files(volumes_dir, percent, compressibility, seed):
+    """Rewrite `percent` of the files with new content of the same size, returns the bytes rewritten"""
+    rng = random.Random(seed)
+    changed_bytes = 0
+    for root, dirs, files in os.walk(volumes_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if rng.random() * 100 >= percent:
+                continue
+            path = os.path.join(root, name)
+            size = os.path.getsize(path)
+            with open(path, 'wb') as f:
+                f.write(make_content(rng, size, compressibility))
+            changed_bytes += size
+    return changed_bytes
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_rate(value):
+    return f"{value:.1f}" if value is not None else "-"
+
+
+def print_run(name, summary):
+    print(f"{name}: {summary['source_mb']:.1f} MB in {summary['seconds']:.2f}s "
+          f"({summary['end_to_end_mb_per_s']:.1f} MB/s end to end), {summary['stored_mb']:.1f} MB in "
+          f"{summary['objects']} new objects, {summary['counts']['backed_up']} volumes backed up, "
+          f"{summary['counts']['failed']} failed, {summary['counts']['skipped']} skipped")
+    if summary['telegram_wait_seconds'] >= 0.1:
+        print(f"  then {summary['telegram_wait_seconds']:.1f}s waiting for {summary['telegram_calls']} Telegram calls")
+    compress_label = f"{summary['combined_phase']} MB/s" if summary['combined_phase'] else "compress MB/s"
+    print(f"  {'scan s':>8}{compress_label:>18}{'upload MB/s':>13}{'peak RSS MB':>13}{'workers MB':>12}"
+          f"{'tmp peak MB':>13}")
+    print(f"  {summary['scan_seconds']:>8.2f}{format_rate(summary['compression_mb_per_s']):>18}"
+          f"{format_rate(summary['upload_mb_per_s']):>13}{summary['peak_rss_mb']:>13.1f}"
+          f"{summary['peak_worker_rss_mb']:>12.1f}{summary['tmp_peak_mb']:>13.1f}")
+
+
+def compare_runs(previous, current):
+    """Print how the headline numbers moved since `previous`"""
+    print(f"Compared with the run of {previous['timestamp']} (commit {previous['commit']}):")
+    for name, summary in current['runs'].items():
+        before = previous['runs'].get(name)
+        if not before:
+            continue
+        changes = []
+        for field in ('seconds', 'scan_seconds', 'compression_mb_per_s', 'upload_mb_per_s', 'peak_rss_mb',
+                      'tmp_peak_mb'):
+            if before.get(field) and summary.get(field) is not None:
+                changes.append(f"{field} {(summary[field] / before[field] - 1) * 100:+.1f}%")
+        print(f"  {name}: " + ", ".join(changes))
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--volumes', type=int, default=4)
+    parser.add_argument('--files', type=int, default=2000, help="files per volume")
+    parser.add_argument('--min-size', type=int, default=512, help="smallest file in bytes")
+    parser.add_argument('--max-size', type=int, default=1024 * 1024, help="largest file in bytes (log-uniform)")
+    parser.add_argument('--compressibility', type=float, default=0.6, help="text-like share of the data, 0 - 1")
+    parser.add_argument('--files-per-dir', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=None, help="keep the generated volumes here and reuse them")
+    parser.add_argument('--change-percent', type=float, default=None,
+                        help="rewrite this share of the files after the first backup and back up again")
+    parser.add_argument('--set', dest='settings', action='append', default=[], metavar='NAME=VALUE',
+                        help="main.py setting for the run (repeatable)")
+    parser.add_argument('--bot-delay', type=float, default=0.0, help="seconds the stubbed Telegram API takes to answer")
+    parser.add_argument('--endpoint', default=None, help="S3 endpoint to use instead of a local moto server")
+    parser.add_argument('--results', default='benchmark_results.json', help="JSON file the results are appended to")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pipeline-bench-")
+    data_dir = args.data_dir or os.path.join(work_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    server = None
+    try:
+        volumes_dir, source_bytes, params = prepare_volumes(data_dir, args)
+        if args.endpoint is None:
+            server, args.endpoint = start_moto_server()
+        prefix = f"bench-{datetime.now().strftime('%Y%m%d_%H%M%S')}/"
+        # Everything main.py keeps between runs lives in the work folder
+        os.environ.update({
+            'BOT_TOKEN': '0:benchmark', 'BOT_DEST': '0', 'S3_ENABLED': 'true',
+            'S3_BUCKET': os.environ.get('S3_BUCKET', 'pipeline-benchmark'), 'S3_PREFIX': prefix,
+            'AWS_ENDPOINT_URL': args.endpoint, 'ROOT_DIR': volumes_dir, 'TMP_DIR': os.path.join(work_dir, "tmp"),
+            'CATALOG_FILE': os.path.join(work_dir, "catalog.db"),
+            'CHUNK_INDEX_FILE': os.path.join(work_dir, "chunk_index.db"),
+            'MANIFEST_DIR': os.path.join(work_dir, "manifests"),
+            'UPLOAD_CHECKPOINT_FILE': os.path.join(work_dir, "upload_checkpoints.json"),
+            'DOCKER_HOST': f"unix://{os.path.join(work_dir, 'no-docker.sock')}", 'DB_CONTAINERS': '',
+        })
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        for setting in args.settings:
+            name, _, value = setting.partition('=')
+            os.environ[name.strip()] = value.strip()
+
+        import boto3
+        # The stand-in only needs a bucket, created without a location constraint
+        s3_client = boto3.client('s3', endpoint_url=args.endpoint, region_name='us-east-1')
+        try:
+            s3_client.create_bucket(Bucket=os.environ['S3_BUCKET'])
+        except s3_client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+        results = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+                   'params': params,
+                   'bot_delay': args.bot_delay, 'change_percent': args.change_percent, 'runs': {}}
+        result = run_backup(args.bot_delay)
+        results['settings'] = result['settings']
+        results['runs']['first'] = summarize(result, source_bytes,
+                                             bucket_usage(s3_client, os.environ['S3_BUCKET'], prefix))
+        print_run("First backup", results['runs']['first'])
+
+        if args.change_percent is not None:
+            changed_bytes = change_files(volumes_dir, args.change_percent, args.compressibility, args.seed + 1)
+            if changed_bytes:
+                # The volumes no longer match their parameters
+                os.remove(os.path.join(data_dir, "params.json"))
+            before = bucket_usage(s3_client, os.environ['S3_BUCKET'], prefix)
+            result = run_backup(args.bot_delay)
+            after = bucket_usage(s3_client, os.environ['S3_BUCKET'], prefix)
+            results['runs']['second'] = summarize(result, source_bytes,
+                                                  {field: after[field] - before[field] for field in after}, changed_bytes)
+            print_run(f"Second backup, {args.change_percent:g}% of the files changed "
+                      f"({changed_bytes / (1024 * 1024):.1f} MB)", results['runs']['second'])
+
+        history = []
+        if os.path.exists(args.results):
+            with open(args.results) as f:
+                history = json.load(f)
+        previous = next((entry for entry in reversed(history)
+                         if all(entry.get(key) == results[key]
+                                for key in ('params', 'settings', 'bot_delay', 'change_percent'))), None)
+        if previous:
+            compare_runs(previous, results)
+        history.append(results)
+        with open(args.results, 'w') as f:
+            json.dump(history, f, indent=2)
+        print(f"Results appended to [{args.results}]")
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_benchmark()
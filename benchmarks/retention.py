@@ -0,0 +1,148 @@
+"""
+Retention benchmark.
+
+Fills a local S3 stand-in (moto, or any endpoint given with --endpoint) with
+tens of thousands of full and incremental archives and database dumps, then
+runs the retention engine twice: a dry run that must not delete anything and
+a real prune that must batch its deletes 1000 keys at a time and leave every
+kept incremental restorable:
+
+    python benchmarks/retention.py --volumes 50 --snapshots 600
+"""
+import argparse
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py validates its configuration at import time
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('BOT_DEST', '0')
+os.environ.setdefault('S3_ENABLED', 'true')
+os.environ.setdefault('S3_BUCKET', 'retention-benchmark')
+os.environ.setdefault('S3_PREFIX', 'docker-backups/')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('RETENTION_KEEP_LAST', '5')
+os.environ.setdefault('RETENTION_KEEP_DAILY', '7')
+os.environ.setdefault('RETENTION_KEEP_WEEKLY', '4')
+os.environ.setdefault('RETENTION_KEEP_MONTHLY', '6')
+work_dir = tempfile.mkdtemp(prefix="retention-bench-")
+# Keep the benchmark away from the real catalog and chunk index
+os.environ['CATALOG_FILE'] = os.path.join(work_dir, "catalog.db")
+os.environ['CHUNK_INDEX_FILE'] = os.path.join(work_dir, "chunk_index.db")
+
+import main  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_keys(volumes, snapshots, full_every, interval_hours):
+    """Archive keys like upload_volume_archive writes them, newest `interval_hours` apart ending now"""
+    now = datetime.now()
+    keys = []
+    for volume_index in range(volumes):
+        name = f"app{volume_index}_data"
+        for index in range(snapshots):
+            timestamp = (now - timedelta(hours=interval_hours * (snapshots - index))).strftime("%Y%m%d_%H%M%S")
+            if index % full_every == 0:
+                key = f"{main.S3_PREFIX}{name}-{timestamp}.tar.gz"
+                keys += [key, key + main.ARCHIVE_INDEX_SUFFIX]
+            else:
+                keys.append(f"{main.S3_PREFIX}{name}-{timestamp}-inc.tar.gz")
+        if volume_index % 10 == 0:
+            for index in range(snapshots // full_every):
+                timestamp = (now - timedelta(hours=interval_hours * full_every * index)).strftime("%Y%m%d_%H%M%S")
+                keys.append(f"{main.S3_PREFIX}databases/db{volume_index}_postgresql_{timestamp}.sql.gz")
+    return keys
+
+
+def list_all_keys(s3_client):
+    keys = set()
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=main.S3_BUCKET):
+        keys.update(item['Key'] for item in page.get('Contents', []))
+    return keys
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--volumes', type=int, default=50)
+    parser.add_argument('--snapshots', type=int, default=600, help="archives per volume")
+    parser.add_argument('--full-every', type=int, default=7, help="one full archive every N backups")
+    parser.add_argument('--interval-hours', type=int, default=6, help="time between two backups of a volume")
+    parser.add_argument('--endpoint', default=None, help="S3 endpoint to use instead of a local moto server")
+    parser.add_argument('--workers', type=int, default=32, help="threads used to fill the bucket")
+    args = parser.parse_args()
+
+    server = None
+    if args.endpoint is None:
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            sys.exit("moto is not installed: pip install 'moto[server]', or pass --endpoint")
+        port = free_port()
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        server.start()
+        args.endpoint = f"http://127.0.0.1:{port}"
+    os.environ['AWS_ENDPOINT_URL'] = args.endpoint
+    try:
+        s3_client = main.boto3.client('s3', endpoint_url=args.endpoint, region_name=main.AWS_REGION,
+                                      config=main.Config(max_pool_connections=args.workers))
+        s3_client.create_bucket(Bucket=main.S3_BUCKET)
+        keys = make_keys(args.volumes, args.snapshots, args.full_every, args.interval_hours)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.workers) as executor:
+            list(executor.map(lambda key: s3_client.put_object(Bucket=main.S3_BUCKET, Key=key, Body=b"x"), keys))
+        print(f"Stored {len(keys)} objects in {time.perf_counter() - started:.1f}s")
+
+        client = main.get_s3_client()
+        delete_calls = []
+        client.meta.events.register('provide-client-params.s3.DeleteObjects',
+                                    lambda params, **kwargs: delete_calls.append(len(params['Delete']['Objects'])))
+
+        started = time.perf_counter()
+        dry_run = main.prune_backups(client, dry_run=True)
+        print(f"Dry run: {dry_run['deleted']} of {len(keys)} objects to delete in {time.perf_counter() - started:.2f}s")
+        if delete_calls or list_all_keys(client) != set(keys):
+            sys.exit("Dry run changed the bucket")
+
+        started = time.perf_counter()
+        report = main.prune_backups(client)
+        seconds = time.perf_counter() - started
+        print(f"Prune: {report['deleted']} objects deleted in {seconds:.2f}s with {len(delete_calls)} "
+              f"DeleteObjects requests (largest {max(delete_calls, default=0)} keys)")
+        if report['failed'] or report['deleted'] != dry_run['deleted']:
+            sys.exit(f"Prune differs from the dry run or failed: {len(report['failed'])} failed")
+        if len(delete_calls) != math.ceil(report['deleted'] / main.S3_DELETE_BATCH):
+            sys.exit("Deletes were not batched")
+
+        kept = {entry['s3_key'] for _, keep, _ in report['volumes'] for entry in keep}
+        remaining = main.list_snapshots(client)
+        dumps = main.list_database_dumps(client)
+        listed = {entry['s3_key'] for entries in list(remaining.values()) + list(dumps.values()) for entry in entries}
+        if listed != kept:
+            sys.exit(f"Bucket holds {len(listed)} backups, retention kept {len(kept)}")
+        for name, snapshots in remaining.items():
+            for entry in snapshots:
+                if not main.get_restore_chain(snapshots, entry['timestamp']):
+                    sys.exit(f"Snapshot {entry['s3_key']} of {name} lost its full backup")
+        print(f"Kept {len(kept)} backups, all restorable "
+              f"({len(kept) / (args.volumes + len(dumps)):.1f} per volume)")
+    finally:
+        if server:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,103 @@
+"""
+Volume scan benchmark.
+
+Generates a synthetic tree of tiny files and compares the os.walk based scan
+main.py used to run with the current os.scandir scanner. Both must return the
+same change detection result:
+
+    python benchmarks/scan.py --files 1000000
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py validates its configuration at import time
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('BOT_DEST', '0')
+
+import main  # noqa: E402
+from synthetic import generate_volume  # noqa: E402
+
+
+def legacy_directory_info(directory_path, file_entries=None):
+    """The previous os.walk + os.stat scan, kept as the reference result"""
+    total_size = 0
+    file_count = 0
+    latest_mtime = 0
+    dir_hash = hashlib.md5()
+    for root, dirs, files in os.walk(directory_path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            try:
+                stat_info = os.stat(file_path)
+            except OSError:
+                continue
+            total_size += stat_info.st_size
+            file_count += 1
+            latest_mtime = max(latest_mtime, stat_info.st_mtime)
+            rel_path = os.path.relpath(file_path, directory_path)
+            dir_hash.update(f"{rel_path}:{stat_info.st_size}:{stat_info.st_mtime}".encode())
+            if file_entries is not None:
+                file_entries[rel_path] = (stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns)
+    return {
+        'size': total_size,
+        'file_count': file_count,
+        'latest_mtime': latest_mtime,
+        'content_hash': dir_hash.hexdigest()
+    }
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=1000000, help="number of files in the synthetic volume")
+    parser.add_argument('--files-per-dir', type=int, default=200)
+    parser.add_argument('--path', default=None, help="scan an existing tree instead of generating one")
+    parser.add_argument('--with-entries', action='store_true', help="also collect the per-file manifest entries")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = None
+    try:
+        volume_path = args.path
+        if volume_path is None:
+            work_dir = tempfile.mkdtemp(prefix="scan-bench-")
+            volume_path = os.path.join(work_dir, "volume")
+            started = time.perf_counter()
+            generate_volume(volume_path, args.files, min_size=1, max_size=64, compressibility=0,
+                            files_per_dir=args.files_per_dir, seed=args.seed)
+            print(f"Generated {args.files} files in {time.perf_counter() - started:.1f}s")
+
+        # Warm the dentry/inode cache so both scans see the same conditions
+        legacy_directory_info(volume_path)
+
+        legacy_entries = {} if args.with_entries else None
+        current_entries = {} if args.with_entries else None
+        legacy_seconds, legacy = timed(legacy_directory_info, volume_path, legacy_entries)
+        current_seconds, current = timed(main.get_directory_info, volume_path, current_entries)
+
+        print(f"{'scanner':<10}{'seconds':>10}{'files/s':>12}")
+        for name, seconds in (('os.walk', legacy_seconds), ('scandir', current_seconds)):
+            print(f"{name:<10}{seconds:>10.2f}{legacy['file_count'] / seconds:>12.0f}")
+        print(f"Speed-up: {legacy_seconds / current_seconds:.2f}x with {main.SCAN_WORKERS} scan workers")
+
+        if legacy != current or legacy_entries != current_entries:
+            sys.exit(f"Scan results differ:\n  os.walk: {legacy}\n  scandir: {current}")
+        print(f"Identical results: {current}")
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,47 @@
+"""
+Reproducible synthetic volume trees for benchmarks
+"""
+import os
+import random
+
+WORDS = [b"docker", b"volume", b"backup", b"telegram", b"archive", b"config", b"log", b"data",
+         b"INFO", b"DEBUG", b"request", b"user", b"session", b"2024-01-01T00:00:00Z", b"{", b"}"]
+
+
+# Function to build file content with a given compressibility
+def make_content(rng, size, compressibility):
+    """
+    Build `size` bytes where roughly `compressibility` (0.0 - 1.0) of the data is
+    text-like and the rest is random, so gzip ratios land in a realistic range
+    """
+    text_size = int(size * compressibility)
+    chunks = []
+    length = 0
+    while length < text_size:
+        line = b" ".join(rng.choice(WORDS) for _ in range(12)) + b"\n"
+        chunks.append(line)
+        length += len(line)
+    text = b"".join(chunks)[:text_size]
+    return text + rng.randbytes(size - text_size)
+
+
+# Function to generate a synthetic volume tree
+def generate_volume(path, file_count, min_size=512, max_size=256 * 1024, compressibility=0.6,
+                    files_per_dir=200, seed=0):
+    """
+    Create `file_count` files under `path`, spread over nested folders with
+    `files_per_dir` files each. Sizes follow a log-uniform distribution between
+    `min_size` and `max_size`. The same seed always produces the same tree.
+    Returns the total number of bytes written
+    """
+    rng = random.Random(seed)
+    total_bytes = 0
+    for index in range(file_count):
+        directory = os.path.join(path, f"d{index // files_per_dir // 100:03d}", f"s{index // files_per_dir % 100:02d}")
+        if index % files_per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        size = int(min_size * (max_size / min_size) ** rng.random())
+        with open(os.path.join(directory, f"f{index:07d}.dat"), 'wb') as f:
+            f.write(make_content(rng, size, compressibility))
+        total_bytes += size
+    return total_bytes
@@ -52,11 +52,6 @@ if [ "$S3_ENABLED" = "true" ]; then
     echo "✅ Backblaze B2 configuration validated"
 fi
 
-# Ensure Python dependencies are installed
-echo "📦 Installing Python dependencies..."
-pip3 install --no-cache-dir -r /app/requirements.txt
-echo "✅ Python dependencies installed"
-
 # Test Docker access
 echo "🐳 Testing Docker access..."
 if ! docker ps >/dev/null 2>&1; then
@@ -143,7 +138,11 @@ echo ""
 echo "🚀 Docker Backup Service Configuration:"
 echo "   📱 Telegram Bot: Configured"
 echo "   📁 Root Directory: $ROOT_DIR"
-echo "   ⏰ Schedule: Daily at 2:00 AM"
+if [ "$DAEMON_MODE" = "true" ]; then
+    echo "   ⏰ Schedule: ${BACKUP_SCHEDULE:-0 2 * * *} (daemon)"
+else
+    echo "   ⏰ Schedule: Daily at 2:00 AM"
+fi
 if [ "$S3_ENABLED" = "true" ]; then
     echo "   ☁️  Backblaze B2: Enabled ($S3_BUCKET)"
 else
@@ -154,5 +153,10 @@ echo "💡 Manual backup: docker exec <container> python /app/main.py"
 echo "📊 View logs: docker logs <container>"
 echo ""
 
+# Daemon mode replaces cron with the resident scheduler in main.py
+if [ "$DAEMON_MODE" = "true" ] && [ "$1" = "cron" ]; then
+    exec python3 /app/main.py daemon
+fi
+
 # Execute the main command
 exec "$@"
\ No newline at end of file
@@ -1,15 +1,59 @@
 import os
+import sys
+import io
+import argparse
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import tarfile
 import telebot
 import subprocess
+import socket
+import multiprocessing
+import http.client
+import urllib.parse
 import json
+import re
 import hashlib
+import base64
+import sqlite3
+import gzip
+import zlib
+import random
+import collections
+import bisect
+import queue
+import threading
+import signal
+import struct
+import errno
+import stat
+import pwd
+import grp
+import ctypes
+import fcntl
+import shutil
+import contextlib
+import cProfile
+import pstats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+import time
 import boto3
-from botocore.exceptions import ClientError, NoCredentialsError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 from dotenv import load_dotenv
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+except ImportError:
+    AESGCM = ChaCha20Poly1305 = InvalidTag = None
+
 # Load environment variables from .env file if it exists
 load_dotenv()
 
@@ -42,6 +86,14 @@ bot = telebot.TeleBot(TELEGRAM_API_TOKEN)
 # Custom message to send before files list
 TELEGRAM_BACKUP_MESSAGE: str = os.environ.get('CUST_MSG', "Docker Backup Started")
 
+# Telegram messages go out from a background thread, the backup never waits on them
+# Seconds between edits of the live progress message of a run, 0 = no progress message
+TELEGRAM_PROGRESS_INTERVAL = max(int(os.environ.get('TELEGRAM_PROGRESS_INTERVAL', '15')), 0)
+# Seconds the end of a run waits for the summary and log file to be sent
+TELEGRAM_FLUSH_TIMEOUT = max(int(os.environ.get('TELEGRAM_FLUSH_TIMEOUT', '120')), 0)
+logging.debug("TELEGRAM_PROGRESS_INTERVAL: [%d], TELEGRAM_FLUSH_TIMEOUT: [%d]",
+              TELEGRAM_PROGRESS_INTERVAL, TELEGRAM_FLUSH_TIMEOUT)
+
 # Get volumes root path
 DOCKER_VOLUME_DIRECTORIES: str = os.environ.get('ROOT_DIR')
 if not DOCKER_VOLUME_DIRECTORIES:
@@ -67,14 +119,100 @@ if not os.path.exists(TMP_DIR):
         TMP_DIR = os.getcwd()
 logging.debug("TMP_DIR: [%s]", TMP_DIR)
 
-# Backup state file to track previous backup info
+# Backup state file of older versions, imported into the catalog on first use
 BACKUP_STATE_FILE = os.path.join(os.path.dirname(__file__), "backup_state.json")
-logging.debug("BACKUP_STATE_FILE: [%s]", BACKUP_STATE_FILE)
+# Catalog (SQLite) of the volume state, every run and every backup
+CATALOG_FILE = os.environ.get('CATALOG_FILE', os.path.join(os.path.dirname(__file__), "backup_catalog.db"))
+logging.debug("CATALOG_FILE: [%s]", CATALOG_FILE)
+# The other local state (upload checkpoints, manifests, chunk index) defaults to the folder of the
+# catalog, so it is persisted wherever the catalog is
+STATE_DIR = os.path.dirname(os.path.abspath(CATALOG_FILE))
+# In-progress multipart uploads, so an interrupted upload can resume
+UPLOAD_CHECKPOINT_FILE = os.environ.get('UPLOAD_CHECKPOINT_FILE', os.path.join(STATE_DIR, "upload_checkpoints.json"))
+logging.debug("UPLOAD_CHECKPOINT_FILE: [%s]", UPLOAD_CHECKPOINT_FILE)
+
+# Per-volume file manifests (one SQLite file per volume) used for per-file change detection
+MANIFEST_DIR = os.environ.get('MANIFEST_DIR', os.path.join(STATE_DIR, "manifests"))
+MANIFEST_HASH = os.environ.get('MANIFEST_HASH', 'false').lower() == 'true'
+SCAN_WORKERS = max(int(os.environ.get('SCAN_WORKERS', '4')), 1)
+logging.debug("MANIFEST_DIR: [%s], MANIFEST_HASH: [%s], SCAN_WORKERS: [%d]", MANIFEST_DIR, MANIFEST_HASH, SCAN_WORKERS)
+
+# Incremental backup configuration
+BACKUP_MODE = os.environ.get('BACKUP_MODE', 'full').strip().lower()  # full or incremental
+FULL_BACKUP_EVERY_RUNS = int(os.environ.get('FULL_BACKUP_EVERY_RUNS', '7'))  # 0 = no run limit
+FULL_BACKUP_EVERY_DAYS = int(os.environ.get('FULL_BACKUP_EVERY_DAYS', '7'))  # 0 = no age limit
+# Archive member that carries the deleted files list of an incremental archive
+INCREMENTAL_MARKER = ".docker-backup-incremental.json"
+
+# Deduplicated chunk store configuration (BACKUP_FORMAT=chunked)
+BACKUP_FORMAT = os.environ.get('BACKUP_FORMAT', 'tar').strip().lower()  # tar, chunked or segmented
+if BACKUP_FORMAT not in ('tar', 'chunked', 'segmented'):
+    logging.error("Unknown BACKUP_FORMAT [%s], falling back to tar", BACKUP_FORMAT)
+    BACKUP_FORMAT = 'tar'
+CHUNK_TARGET_KB = max(int(os.environ.get('CHUNK_TARGET_KB', '1024')), 16)
+CHUNK_INDEX_FILE = os.environ.get('CHUNK_INDEX_FILE', os.path.join(STATE_DIR, "chunk_index.db"))
+logging.debug("BACKUP_FORMAT: [%s], CHUNK_TARGET_KB: [%d], CHUNK_INDEX_FILE: [%s]",
+              BACKUP_FORMAT, CHUNK_TARGET_KB, CHUNK_INDEX_FILE)
+logging.debug("BACKUP_MODE: [%s], full every [%d] runs / [%d] days",
+              BACKUP_MODE, FULL_BACKUP_EVERY_RUNS, FULL_BACKUP_EVERY_DAYS)
+
+# Client-side encryption configuration. ENCRYPTION_KEY is the base64 of a 32-byte master key
+# (`openssl rand -base64 32`). Every archive, segment, index and dump is encrypted with a data key
+# of its own, stored in its header wrapped by the master key. Master keys still needed to read
+# older backups go in ENCRYPTION_OLD_KEYS, comma-separated
+ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', '').strip()
+ENCRYPTION_OLD_KEYS = [key.strip() for key in os.environ.get('ENCRYPTION_OLD_KEYS', '').split(',') if key.strip()]
+ENCRYPTION_CIPHER_IDS = {'aes-gcm': 1, 'chacha20': 2}
+ENCRYPTION_CIPHER = os.environ.get('ENCRYPTION_CIPHER', 'aes-gcm').strip().lower()  # aes-gcm or chacha20
+if ENCRYPTION_CIPHER not in ENCRYPTION_CIPHER_IDS:
+    logging.error("Unknown ENCRYPTION_CIPHER [%s], falling back to aes-gcm", ENCRYPTION_CIPHER)
+    ENCRYPTION_CIPHER = 'aes-gcm'
+# Encrypted streams start with this header: magic, cipher, chunk size, ID of the master key, nonce and
+# data key wrapped by the master key, nonce prefix of the chunks. Chunks of plaintext follow, each
+# sealed with its own nonce and tag
+ENCRYPTION_MAGIC = b"DBKENC\x00\x01"
+ENCRYPTION_HEADER = struct.Struct(">8sBI8s12s48s8s")
+ENCRYPTION_CHUNK_SIZE = 1024 * 1024
+ENCRYPTION_TAG_SIZE = 16
+# Master key ID (first 8 bytes of its SHA-256) -> master key, the current one and ENCRYPTION_OLD_KEYS
+encryption_keys = {}
+encryption_key_id = None
+if ENCRYPTION_KEY or ENCRYPTION_OLD_KEYS:
+    if AESGCM is None:
+        logging.critical("Encryption requires the cryptography package!")
+        raise Exception("Invalid ENCRYPTION_KEY")
+    for key_name, key_value in ([('ENCRYPTION_KEY', ENCRYPTION_KEY)] if ENCRYPTION_KEY else []) + \
+            [('ENCRYPTION_OLD_KEYS', old_key) for old_key in ENCRYPTION_OLD_KEYS]:
+        try:
+            master_key = base64.b64decode(key_value, validate=True)
+        except ValueError:
+            master_key = b''
+        if len(master_key) != 32:
+            logging.critical("%s must be the base64 of 32 bytes!", key_name)
+            raise Exception(f"Invalid {key_name}")
+        encryption_keys[hashlib.sha256(master_key).digest()[:8]] = master_key
+        if key_name == 'ENCRYPTION_KEY':
+            encryption_key_id = hashlib.sha256(master_key).digest()[:8]
+# Chunks are shared between volumes and found by the hash of their plaintext, they cannot be encrypted
+if encryption_key_id and BACKUP_FORMAT == 'chunked':
+    logging.error("BACKUP_FORMAT=chunked cannot be encrypted, falling back to tar")
+    BACKUP_FORMAT = 'tar'
+logging.debug("ENCRYPTION: [%s], cipher [%s], key ID [%s], old keys [%d]", bool(encryption_key_id),
+              ENCRYPTION_CIPHER, encryption_key_id.hex() if encryption_key_id else None, len(ENCRYPTION_OLD_KEYS))
 
 # Database configuration
 DB_CONTAINERS = os.environ.get('DB_CONTAINERS', '').split(',') if os.environ.get('DB_CONTAINERS') else []
 DB_CONTAINERS = [container.strip() for container in DB_CONTAINERS if container.strip()]
 logging.debug("DB_CONTAINERS: [%s]", DB_CONTAINERS)
+DB_DUMP_WORKERS = max(int(os.environ.get('DB_DUMP_WORKERS', '2')), 1)  # concurrent dumps
+DB_DUMP_TIMEOUT = int(os.environ.get('DB_DUMP_TIMEOUT', '3600'))  # seconds per dump
+DB_DUMP_READ_SIZE = 1024 * 1024
+# Docker Engine API socket, DOCKER_HOST=unix:///path/to/docker.sock is honoured like the docker CLI does
+DOCKER_HOST = os.environ.get('DOCKER_HOST', '')
+DOCKER_SOCKET = DOCKER_HOST[len('unix://'):] if DOCKER_HOST.startswith('unix://') else '/var/run/docker.sock'
+DOCKER_API_VERSION = os.environ.get('DOCKER_API_VERSION', 'v1.41')
+logging.debug("DOCKER_SOCKET: [%s], DOCKER_API_VERSION: [%s]", DOCKER_SOCKET, DOCKER_API_VERSION)
+logging.debug("DB_DUMP_WORKERS: [%d], DB_DUMP_TIMEOUT: [%ds]", DB_DUMP_WORKERS, DB_DUMP_TIMEOUT)
 
 # S3 configuration
 S3_ENABLED = os.environ.get('S3_ENABLED', 'false').lower() == 'true'
@@ -83,100 +221,1548 @@ S3_PREFIX = os.environ.get('S3_PREFIX', 'docker-backups/')
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
-LARGE_FILE_THRESHOLD = int(os.environ.get('LARGE_FILE_THRESHOLD', '45'))  # MB
+# Segmented archives (BACKUP_FORMAT=segmented): MB of tar stream per segment, and segments of a volume
+# compressed and uploaded at the same time, each staged in TMP_DIR
+LARGE_FILE_THRESHOLD = max(int(os.environ.get('LARGE_FILE_THRESHOLD', '1024')), 1)  # MB
+SEGMENT_WORKERS = max(int(os.environ.get('SEGMENT_WORKERS', '4')), 1)
+
+# Streaming upload configuration (compress straight into S3 multipart upload)
+STREAM_UPLOAD = os.environ.get('STREAM_UPLOAD', 'false').lower() == 'true'
+S3_PART_SIZE_MB = max(int(os.environ.get('S3_PART_SIZE_MB', '64')), 5)  # S3 minimum part size is 5 MB
+S3_UPLOAD_QUEUE_PARTS = max(int(os.environ.get('S3_UPLOAD_QUEUE_PARTS', '4')), 1)
+
+# Parallel backup pipeline configuration
+COMPRESS_WORKERS = max(int(os.environ.get('COMPRESS_WORKERS', '1')), 1)  # processes
+UPLOAD_WORKERS = max(int(os.environ.get('UPLOAD_WORKERS', '1')), 1)  # threads
+MAX_INFLIGHT_TMP_MB = int(os.environ.get('MAX_INFLIGHT_TMP_MB', '0'))  # 0 = unlimited
+logging.debug("COMPRESS_WORKERS: [%d], UPLOAD_WORKERS: [%d], MAX_INFLIGHT_TMP_MB: [%d]",
+              COMPRESS_WORKERS, UPLOAD_WORKERS, MAX_INFLIGHT_TMP_MB)
+
+# S3 transfer tuning, shared by every upload of the run
+S3_MULTIPART_THRESHOLD_MB = max(int(os.environ.get('S3_MULTIPART_THRESHOLD_MB', '64')), 5)
+S3_MULTIPART_CHUNKSIZE_MB = max(int(os.environ.get('S3_MULTIPART_CHUNKSIZE_MB', '64')), 5)
+S3_MAX_CONCURRENCY = max(int(os.environ.get('S3_MAX_CONCURRENCY', '10')), 1)
+# Every upload worker may run S3_MAX_CONCURRENCY (or S3_UPLOAD_QUEUE_PARTS) requests at once,
+# per segment in segmented mode, and so may every concurrent database dump
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS',
+                                             max(max(S3_MAX_CONCURRENCY, S3_UPLOAD_QUEUE_PARTS) * UPLOAD_WORKERS *
+                                                 (SEGMENT_WORKERS if BACKUP_FORMAT == 'segmented' else 1),
+                                                 S3_UPLOAD_QUEUE_PARTS * DB_DUMP_WORKERS) + 2))
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+logging.debug("S3 transfer: threshold [%d MB], chunk [%d MB], concurrency [%d], pool [%d]",
+              S3_MULTIPART_THRESHOLD_MB, S3_MULTIPART_CHUNKSIZE_MB, S3_MAX_CONCURRENCY, S3_MAX_POOL_CONNECTIONS)
+UPLOAD_RETRIES = max(int(os.environ.get('UPLOAD_RETRIES', '3')), 0)  # resumed attempts after a failed upload
+ORPHAN_UPLOAD_MAX_AGE_HOURS = int(os.environ.get('ORPHAN_UPLOAD_MAX_AGE_HOURS', '24'))  # 0 = never abort
+logging.debug("UPLOAD_RETRIES: [%d], ORPHAN_UPLOAD_MAX_AGE_HOURS: [%d]", UPLOAD_RETRIES, ORPHAN_UPLOAD_MAX_AGE_HOURS)
+
+# Restores download archives as parallel ranged GETs
+RESTORE_WORKERS = max(int(os.environ.get('RESTORE_WORKERS', '4')), 1)  # concurrent GETs per archive
+RESTORE_PART_SIZE_MB = max(int(os.environ.get('RESTORE_PART_SIZE_MB', '16')), 1)
+logging.debug("RESTORE_WORKERS: [%d], RESTORE_PART_SIZE_MB: [%d MB]", RESTORE_WORKERS, RESTORE_PART_SIZE_MB)
+# Read each volume from a frozen view: off, auto, btrfs, zfs, lvm, reflink or pause
+SNAPSHOT_MODE = os.environ.get('SNAPSHOT_MODE', 'off').strip().lower()
+if SNAPSHOT_MODE not in ('off', 'auto', 'btrfs', 'zfs', 'lvm', 'reflink', 'pause'):
+    logging.error("Unknown SNAPSHOT_MODE [%s], reading volumes live", SNAPSHOT_MODE)
+    SNAPSHOT_MODE = 'off'
+# Where btrfs snapshots, reflink copies and LVM mounts go, on the volumes' filesystem.
+# Defaults to a .backup-snapshots folder next to each ROOT_DIR entry
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '')
+# Longest time containers stay paused (pause mode, and while a reflink copy is made)
+SNAPSHOT_PAUSE_TIMEOUT = int(os.environ.get('SNAPSHOT_PAUSE_TIMEOUT', '60'))
+# Copy-on-write space of LVM snapshots, passed to lvcreate -l (with %) or -L
+SNAPSHOT_LVM_SIZE = os.environ.get('SNAPSHOT_LVM_SIZE', '10%ORIGIN')
+logging.debug("SNAPSHOT_MODE: [%s], SNAPSHOT_DIR: [%s], SNAPSHOT_PAUSE_TIMEOUT: [%ds]",
+              SNAPSHOT_MODE, SNAPSHOT_DIR, SNAPSHOT_PAUSE_TIMEOUT)
+# Backups checked at the same time by `main.py verify`, each one read with RESTORE_WORKERS ranged GETs
+VERIFY_WORKERS = max(int(os.environ.get('VERIFY_WORKERS', '2')), 1)
+# Object metadata key holding the SHA-256 of the stored bytes (x-amz-meta-sha256)
+CHECKSUM_METADATA_KEY = 'sha256'
+
+# Retention, applied after every run and by `main.py prune`. Counts of snapshots to keep, 0 = rule off
+RETENTION_KEEP_LAST = int(os.environ.get('RETENTION_KEEP_LAST', '0'))
+RETENTION_KEEP_DAILY = int(os.environ.get('RETENTION_KEEP_DAILY', '0'))
+RETENTION_KEEP_WEEKLY = int(os.environ.get('RETENTION_KEEP_WEEKLY', '0'))
+RETENTION_KEEP_MONTHLY = int(os.environ.get('RETENTION_KEEP_MONTHLY', '0'))
+RETENTION_MAX_AGE_DAYS = int(os.environ.get('RETENTION_MAX_AGE_DAYS', '0'))  # delete older snapshots, 0 = no limit
+# Per-volume (or database container) policies, "volume=last:3,daily:7,weekly:4,monthly:12,max_age:365;..."
+RETENTION_POLICIES = os.environ.get('RETENTION_POLICIES', '').strip()
+# Unreferenced chunks younger than this are kept, a running backup may be about to reference them
+CHUNK_GC_GRACE_HOURS = int(os.environ.get('CHUNK_GC_GRACE_HOURS', '24'))
+logging.debug("RETENTION: last [%d], daily [%d], weekly [%d], monthly [%d], max age [%d days], policies [%s]",
+              RETENTION_KEEP_LAST, RETENTION_KEEP_DAILY, RETENTION_KEEP_WEEKLY, RETENTION_KEEP_MONTHLY,
+              RETENTION_MAX_AGE_DAYS, RETENTION_POLICIES)
+
+# Compression configuration
+ARCHIVE_SUFFIXES = {'gzip': '.tar.gz', 'pgzip': '.tar.gz', 'zstd': '.tar.zst', 'none': '.tar'}
+DEFAULT_COMPRESSION_LEVELS = {'gzip': 6, 'pgzip': 6, 'zstd': 3, 'none': 0}
+COMPRESSION = os.environ.get('COMPRESSION', 'gzip').strip().lower()
+if COMPRESSION not in ARCHIVE_SUFFIXES:
+    logging.error("Unknown COMPRESSION [%s], falling back to gzip", COMPRESSION)
+    COMPRESSION = 'gzip'
+if COMPRESSION == 'zstd' and zstandard is None:
+    logging.error("COMPRESSION=zstd requires the zstandard package, falling back to pgzip")
+    COMPRESSION = 'pgzip'
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', DEFAULT_COMPRESSION_LEVELS[COMPRESSION]))
+COMPRESSION_THREADS = max(int(os.environ.get('COMPRESSION_THREADS', os.cpu_count() or 1)), 1)
+COMPRESSION_BLOCK_KB = max(int(os.environ.get('COMPRESSION_BLOCK_KB', '1024')), 64)
+ARCHIVE_SUFFIX = ARCHIVE_SUFFIXES[COMPRESSION]
+DUMP_SUFFIX = ARCHIVE_SUFFIX.replace('.tar', '.sql', 1)
+# Member offsets of every archive are uploaded next to it as `<archive key>.index.json.gz`.
+# Archives of these codecs can be read from any block, so single files restore without the whole stream
+ARCHIVE_INDEX_SUFFIX = ".index.json.gz"
+SEEKABLE_CODECS = ('pgzip', 'none')
+# Segmented archives are `<key>.partNNNNN<suffix>` objects listed by a `<key>.segments.json.gz` index
+SEGMENTS_SUFFIX = ".segments.json.gz"
+logging.debug("COMPRESSION: [%s] level [%d], threads [%d], suffix [%s]",
+              COMPRESSION, COMPRESSION_LEVEL, COMPRESSION_THREADS, ARCHIVE_SUFFIX)
+# Already compressed files (media, archives) are stored inside the archive instead of being compressed again
+SKIP_COMPRESSION = os.environ.get('SKIP_COMPRESSION', 'true').strip().lower() == 'true'
+# Smaller files are always compressed: every switch to storing starts a new gzip member or zstd frame
+SKIP_COMPRESSION_MIN_KB = max(int(os.environ.get('SKIP_COMPRESSION_MIN_KB', '256')), 1)
+# Files with other extensions are stored when zlib level 1 saves less than this share of a sample
+SKIP_COMPRESSION_MIN_SAVING = float(os.environ.get('SKIP_COMPRESSION_MIN_SAVING', '0.05'))
+logging.debug("SKIP_COMPRESSION: [%s], min size [%d KB], min saving [%.2f]",
+              SKIP_COMPRESSION, SKIP_COMPRESSION_MIN_KB, SKIP_COMPRESSION_MIN_SAVING)
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif', '.jxl',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.wmv', '.flv', '.ts',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.lzma', '.zip', '.7z', '.rar',
+    '.jar', '.war', '.apk', '.whl', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub',
+))
+# Bytes read from the middle of a file to test whether it compresses
+COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024
+# zstd level of stored stretches, negative levels skip nearly all match searching
+ZSTD_STORE_LEVEL = -1000
+# Files up to this size are read with one call; tar output reaches the compressor in writes of TAR_WRITE_SIZE
+TAR_SMALL_FILE_SIZE = 64 * 1024
+TAR_WRITE_SIZE = 1024 * 1024
+
+# Throttling configuration, limits in MB/s are shared by all workers (0 = unlimited)
+READ_RATE_LIMIT_MB = float(os.environ.get('READ_RATE_LIMIT_MB', '0'))
+UPLOAD_RATE_LIMIT_MB = float(os.environ.get('UPLOAD_RATE_LIMIT_MB', '0'))
+# Time-of-day overrides, "HH:MM-HH:MM=<read MB/s>/<upload MB/s>,...", e.g. "02:00-05:00=0/0"
+THROTTLE_PROFILES = os.environ.get('THROTTLE_PROFILES', '').strip()
+COMPRESS_NICE = int(os.environ.get('COMPRESS_NICE', '0'))
+COMPRESS_IONICE = os.environ.get('COMPRESS_IONICE', '').strip().lower()  # idle, best-effort or empty
+logging.debug("READ_RATE_LIMIT_MB: [%s], UPLOAD_RATE_LIMIT_MB: [%s], THROTTLE_PROFILES: [%s]",
+              READ_RATE_LIMIT_MB, UPLOAD_RATE_LIMIT_MB, THROTTLE_PROFILES)
+logging.debug("COMPRESS_NICE: [%d], COMPRESS_IONICE: [%s]", COMPRESS_NICE, COMPRESS_IONICE)
+
+# Metrics and profiling output, each one is disabled when empty
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE', '')  # Prometheus node_exporter textfile (.prom)
+METRICS_REPORT_FILE = os.environ.get('METRICS_REPORT_FILE', '')  # JSON run report
+PROFILE_FILE = os.environ.get('PROFILE_FILE', '')  # cProfile stats of the run, read with pstats
+logging.debug("METRICS_TEXTFILE: [%s], METRICS_REPORT_FILE: [%s], PROFILE_FILE: [%s]",
+              METRICS_TEXTFILE, METRICS_REPORT_FILE, PROFILE_FILE)
+
+# Daemon mode schedules (`main.py daemon`), standard 5-field cron expressions in local time
+BACKUP_SCHEDULE = os.environ.get('BACKUP_SCHEDULE', '0 2 * * *')
+# Volumes with their own schedule, "volume=cron;volume=cron", e.g. "postgres_data=0 */6 * * *"
+VOLUME_SCHEDULES = os.environ.get('VOLUME_SCHEDULES', '').strip()
+SCHEDULE_JITTER_SECONDS = max(int(os.environ.get('SCHEDULE_JITTER_SECONDS', '0')), 0)
+# Read the latest backups back and check them, empty = only with `main.py verify`
+VERIFY_SCHEDULE = os.environ.get('VERIFY_SCHEDULE', '').strip()
+logging.debug("BACKUP_SCHEDULE: [%s], VOLUME_SCHEDULES: [%s], SCHEDULE_JITTER_SECONDS: [%d], VERIFY_SCHEDULE: [%s]",
+              BACKUP_SCHEDULE, VOLUME_SCHEDULES, SCHEDULE_JITTER_SECONDS, VERIFY_SCHEDULE)
+# Track changed files with inotify in daemon mode, so clean volumes are not walked
+WATCH_VOLUMES = os.environ.get('WATCH_VOLUMES', 'false').lower() == 'true'
+logging.debug("WATCH_VOLUMES: [%s]", WATCH_VOLUMES)
 
 logging.debug("S3_ENABLED: [%s]", S3_ENABLED)
 if S3_ENABLED:
     logging.debug("S3_BUCKET: [%s]", S3_BUCKET)
     logging.debug("S3_PREFIX: [%s]", S3_PREFIX)
     logging.debug("AWS_REGION: [%s]", AWS_REGION)
-    logging.debug("LARGE_FILE_THRESHOLD: [%d MB]", LARGE_FILE_THRESHOLD)
+    logging.debug("LARGE_FILE_THRESHOLD: [%d MB], SEGMENT_WORKERS: [%d]", LARGE_FILE_THRESHOLD, SEGMENT_WORKERS)
+    logging.debug("STREAM_UPLOAD: [%s]", STREAM_UPLOAD)
+    if STREAM_UPLOAD:
+        logging.debug("S3_PART_SIZE_MB: [%d MB]", S3_PART_SIZE_MB)
+        logging.debug("S3_UPLOAD_QUEUE_PARTS: [%d]", S3_UPLOAD_QUEUE_PARTS)
+
 
+# Function to parse the time-of-day throttle profiles
+def parse_throttle_profiles(value):
+    """
+    Parse "HH:MM-HH:MM=<read MB/s>/<upload MB/s>,..." into a list of
+    (start minute, end minute, read MB/s, upload MB/s). Windows may wrap
+    around midnight; invalid entries are logged and skipped
+    """
+    profiles = []
+    for entry in filter(None, (item.strip() for item in value.split(','))):
+        try:
+            window, limits = entry.split('=')
+            start, end = (int(hours) * 60 + int(minutes)
+                          for hours, minutes in (point.split(':') for point in window.split('-')))
+            read_limit, upload_limit = (float(limit) for limit in limits.split('/'))
+            profiles.append((start, end, read_limit, upload_limit))
+        except ValueError:
+            logging.error("Invalid THROTTLE_PROFILES entry [%s], expected HH:MM-HH:MM=read/upload", entry)
+    return profiles
 
+throttle_profiles = parse_throttle_profiles(THROTTLE_PROFILES)
+_rate_limits_cache = [0.0, (0, 0)]
 
-# Function to get directory size and modification info
-def get_directory_info(directory_path):
+# Function to get the rate limits in effect right now
+def current_rate_limits():
+    """
+    Return (read, upload) limits in bytes per second for the current time of
+    day, 0 meaning unlimited. Re-evaluated at most once per second
+    """
+    now = time.monotonic()
+    if now - _rate_limits_cache[0] < 1:
+        return _rate_limits_cache[1]
+    read_limit, upload_limit = READ_RATE_LIMIT_MB, UPLOAD_RATE_LIMIT_MB
+    local_time = datetime.now()
+    minute = local_time.hour * 60 + local_time.minute
+    for start, end, profile_read, profile_upload in throttle_profiles:
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            read_limit, upload_limit = profile_read, profile_upload
+            break
+    limits = (read_limit * 1024 * 1024, upload_limit * 1024 * 1024)
+    _rate_limits_cache[:] = [now, limits]
+    return limits
+
+# Rate limiter shared by threads and forked worker processes
+class TokenBucket:
+    """
+    Token bucket whose state lives in shared memory, so a single limit holds
+    for all upload threads and compression processes together. Callers take
+    tokens for what they are about to move and sleep off any deficit, which
+    keeps the average rate at the limit with bursts of at most one second.
+    `rate_function` returns the current limit in bytes per second, 0 = unlimited
+    """
+
+    def __init__(self, rate_function):
+        self.rate_function = rate_function
+        # Available tokens and time of the last refill
+        self._state = multiprocessing.Array('d', [0.0, time.monotonic()])
+
+    def consume(self, amount):
+        rate = self.rate_function()
+        if rate <= 0 or amount <= 0:
+            return
+        with self._state.get_lock():
+            now = time.monotonic()
+            tokens = min(self._state[0] + (now - self._state[1]) * rate, rate) - amount
+            self._state[0] = tokens
+            self._state[1] = now
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+read_throttle = TokenBucket(lambda: current_rate_limits()[0])
+upload_throttle = TokenBucket(lambda: current_rate_limits()[1])
+
+# Write-through file object that applies a rate limit
+class ThrottledWriter:
+    """Passes writes to `fileobj`, taking tokens from `bucket` for every byte"""
+
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bucket.consume(len(data))
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+# Write-through file object that hashes what goes through it
+class HashingWriter:
+    """Passes writes to `fileobj` and keeps the SHA-256 of everything written"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+# Read-through file object that hashes what goes through it
+class HashingReader:
+    """Passes reads from `fileobj` on and keeps the SHA-256 and size of everything read"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+# Function to create the data key of an encrypted stream
+def new_data_key():
+    """Return a random data key, None if ENCRYPTION_KEY is not set and backups are not encrypted"""
+    return os.urandom(32) if encryption_key_id else None
+
+# Function to get the cipher of an encrypted stream
+def get_cipher(cipher_id, key):
+    """Return the AEAD cipher for a cipher ID of ENCRYPTION_CIPHER_IDS"""
+    if AESGCM is None:
+        raise RuntimeError("cryptography package is required to read encrypted backups")
+    if cipher_id == ENCRYPTION_CIPHER_IDS['aes-gcm']:
+        return AESGCM(key)
+    if cipher_id == ENCRYPTION_CIPHER_IDS['chacha20']:
+        return ChaCha20Poly1305(key)
+    raise IOError(f"unknown cipher {cipher_id} in encrypted stream")
+
+# Function to read the header of an encrypted stream
+def open_encryption_header(header):
     """
-    Get directory size and modification time info for change detection
+    Unwrap the data key in an ENCRYPTION_HEADER with the master key it names.
+    Returns the cipher of the data key, the chunk size and the nonce prefix
     """
     try:
-        total_size = 0
-        file_count = 0
-        latest_mtime = 0
-        
-        # Create a hash of directory structure and sizes
-        dir_hash = hashlib.md5()
-        
-        for root, dirs, files in os.walk(directory_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    stat_info = os.stat(file_path)
-                    file_size = stat_info.st_size
-                    file_mtime = stat_info.st_mtime
-                    
-                    total_size += file_size
-                    file_count += 1
-                    latest_mtime = max(latest_mtime, file_mtime)
-                    
-                    # Add file info to hash (relative path + size + mtime)
-                    rel_path = os.path.relpath(file_path, directory_path)
-                    dir_hash.update(f"{rel_path}:{file_size}:{file_mtime}".encode())
-                    
-                except (OSError, IOError) as e:
-                    logging.warning("Cannot access file [%s]: %s", file_path, str(e))
-                    continue
-        
+        magic, cipher_id, chunk_size, key_id, wrap_nonce, wrapped_key, nonce_prefix = ENCRYPTION_HEADER.unpack(header)
+    except struct.error:
+        raise IOError("encrypted stream ends inside its header")
+    if magic != ENCRYPTION_MAGIC:
+        raise IOError("not an encrypted stream")
+    master_key = encryption_keys.get(key_id)
+    if master_key is None:
+        raise IOError(f"encrypted with master key {key_id.hex()}, set it in ENCRYPTION_KEY or ENCRYPTION_OLD_KEYS")
+    try:
+        data_key = get_cipher(cipher_id, master_key).decrypt(wrap_nonce, wrapped_key, ENCRYPTION_MAGIC)
+    except InvalidTag:
+        raise IOError(f"cannot unwrap the data key with master key {key_id.hex()}, the header is corrupt")
+    return get_cipher(cipher_id, data_key), chunk_size, nonce_prefix
+
+# Function to read an exact number of bytes
+def read_exact(fileobj, size):
+    """Read `size` bytes from `fileobj`, fewer only at its end"""
+    data = fileobj.read(size)
+    if len(data) == size or not data:
+        return data
+    chunks = [data]
+    size -= len(data)
+    while size > 0:
+        data = fileobj.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+# Write-through file object that encrypts what goes through it
+class EncryptingWriter:
+    """
+    Encrypts everything written to it with `data_key` (see new_data_key)
+    into `fileobj`, behind an ENCRYPTION_HEADER that holds the data key
+    wrapped by the master key. Plaintext is sealed in ENCRYPTION_CHUNK_SIZE
+    chunks as it arrives, so nothing is buffered beyond one chunk. The last
+    chunk is authenticated as the last, a stream cut short at a chunk
+    boundary fails to decrypt. close() writes it but leaves `fileobj` open
+    """
+
+    def __init__(self, fileobj, data_key):
+        self.fileobj = fileobj
+        self.bytes_written = 0
+        cipher_id = ENCRYPTION_CIPHER_IDS[ENCRYPTION_CIPHER]
+        wrap_nonce = os.urandom(12)
+        wrapped_key = get_cipher(cipher_id, encryption_keys[encryption_key_id]).encrypt(wrap_nonce, data_key,
+                                                                                       ENCRYPTION_MAGIC)
+        self._nonce_prefix = os.urandom(8)
+        header = ENCRYPTION_HEADER.pack(ENCRYPTION_MAGIC, cipher_id, ENCRYPTION_CHUNK_SIZE, encryption_key_id,
+                                        wrap_nonce, wrapped_key, self._nonce_prefix)
+        self._cipher = get_cipher(cipher_id, data_key)
+        # Every chunk is bound to the header and flagged as last or not
+        self._aad = (header + b'\x00', header + b'\x01')
+        self._chunk = 0
+        self._buffer = bytearray()
+        self._closed = False
+        self._write(header)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+
+    def _seal(self, data, last):
+        nonce = self._nonce_prefix + struct.pack('>I', self._chunk)
+        self._write(self._cipher.encrypt(nonce, data, self._aad[last]))
+        self._chunk += 1
+
+    def write(self, data):
+        view = memoryview(data)
+        if len(self._buffer) + len(view) <= ENCRYPTION_CHUNK_SIZE:
+            self._buffer += view
+            return len(data)
+        # A full chunk is only sealed once more data follows, close() seals the last one
+        if self._buffer:
+            fill = ENCRYPTION_CHUNK_SIZE - len(self._buffer)
+            self._buffer += view[:fill]
+            self._seal(self._buffer, False)
+            self._buffer = bytearray()
+            view = view[fill:]
+        # Whole chunks are sealed straight from `data`, without copying them
+        while len(view) > ENCRYPTION_CHUNK_SIZE:
+            self._seal(view[:ENCRYPTION_CHUNK_SIZE], False)
+            view = view[ENCRYPTION_CHUNK_SIZE:]
+        self._buffer += view
+        return len(data)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._seal(self._buffer, True)
+            self._buffer = bytearray()
+
+# Read-through file object that decrypts a stream written by EncryptingWriter
+class DecryptingReader:
+    """
+    Readable plaintext of an encrypted stream. Each chunk is authenticated
+    before any of it is returned, a changed, reordered or truncated stream
+    raises IOError. The header is read from `fileobj` unless given as
+    `header`. For a ranged read, `fileobj` starts at chunk `first_chunk` and
+    `last_chunk` is the number of the last chunk of the whole stream
+    """
+
+    def __init__(self, fileobj, header=None, first_chunk=0, last_chunk=None):
+        self.fileobj = fileobj
+        if header is None:
+            header = read_exact(fileobj, ENCRYPTION_HEADER.size)
+        self._cipher, self._chunk_size, self._nonce_prefix = open_encryption_header(header)
+        self._aad = (header + b'\x00', header + b'\x01')
+        self._chunk = first_chunk
+        self._last_chunk = last_chunk
+        # Without last_chunk the next record is read ahead, the last one is the one nothing follows
+        self._next = None
+        self._done = False
+        self._buffer = b''
+        self._position = 0
+
+    def _open_next(self):
+        record_size = self._chunk_size + ENCRYPTION_TAG_SIZE
+        if self._last_chunk is not None:
+            record = read_exact(self.fileobj, record_size)
+            if not record:
+                return b''
+            last = self._chunk == self._last_chunk
+        else:
+            record = self._next if self._next is not None else read_exact(self.fileobj, record_size)
+            if not record:
+                raise IOError("encrypted stream ends before its last chunk")
+            self._next = read_exact(self.fileobj, record_size) if len(record) == record_size else b''
+            last = not self._next
+        nonce = self._nonce_prefix + struct.pack('>I', self._chunk)
+        try:
+            data = self._cipher.decrypt(nonce, record, self._aad[last])
+        except InvalidTag:
+            raise IOError(f"encrypted chunk {self._chunk} does not authenticate, the stream is corrupt or truncated")
+        self._chunk += 1
+        self._done = last
+        return data
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._position == len(self._buffer):
+                self._buffer = b'' if self._done else self._open_next()
+                self._position = 0
+                if not self._buffer:
+                    break
+            available = len(self._buffer) - self._position
+            count = available if size < 0 else min(size, available)
+            chunks.append(self._buffer[self._position:self._position + count])
+            self._position += count
+            if size > 0:
+                size -= count
+        return b''.join(chunks)
+
+    def close(self):
+        self.fileobj.close()
+
+# Readable stream that gives back bytes already read from it first
+class PrefixedReader:
+    """Returns `prefix`, then the rest of `fileobj`"""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if 0 <= size < len(self.prefix):
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            return data
+        data, self.prefix = self.prefix, b''
+        return data + self.fileobj.read(size - len(data) if size > 0 else size)
+
+    def close(self):
+        self.fileobj.close()
+
+# Function to decrypt a stream if it is encrypted
+def open_decrypted(fileobj):
+    """Return a DecryptingReader over `fileobj` if it starts with an encryption header, else its data as it is"""
+    head = read_exact(fileobj, len(ENCRYPTION_MAGIC))
+    if head == ENCRYPTION_MAGIC:
+        return DecryptingReader(fileobj, head + read_exact(fileobj, ENCRYPTION_HEADER.size - len(head)))
+    return PrefixedReader(head, fileobj)
+
+# Function to lower the CPU and I/O priority of the current process
+def lower_process_priority():
+    """Apply COMPRESS_NICE and COMPRESS_IONICE, used as compression worker initializer"""
+    if COMPRESS_NICE:
+        try:
+            os.nice(COMPRESS_NICE)
+        except OSError as e:
+            logging.warning("Cannot change nice level: %s", str(e))
+    if COMPRESS_IONICE:
+        ionice_cmd = {'idle': ['-c', '3'], 'best-effort': ['-c', '2', '-n', '7']}.get(COMPRESS_IONICE)
+        if not ionice_cmd:
+            logging.warning("Unknown COMPRESS_IONICE [%s], expected idle or best-effort", COMPRESS_IONICE)
+            return
+        try:
+            # I/O priority is per thread, threads started afterwards inherit it
+            subprocess.run(['ionice'] + ionice_cmd + ['-p', str(os.getpid())], check=True,
+                           capture_output=True, timeout=10)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.warning("Cannot change I/O priority: %s", str(e))
+
+# Timings and volumes of every phase of a backup run
+class RunMetrics:
+    """
+    Collects one record per phase (scan, compress, upload, stream, chunked,
+    segmented, dump) and volume or container: duration, bytes in and out, files and
+    outcome. Phases in progress are kept in `active` for the progress message.
+    Thread-safe; exported as a JSON report and a Prometheus textfile
+    """
+
+    PHASE_METRICS = (
+        ('duration_seconds', 'seconds', "Time spent in the phase"),
+        ('bytes_in', 'bytes_in', "Bytes read by the phase"),
+        ('bytes_out', 'bytes_out', "Bytes written or uploaded by the phase"),
+        ('files', 'files', "Files processed by the phase"),
+        ('throughput_bytes_per_second', 'throughput', "Bytes read per second of the phase"),
+        ('cpu_saved_seconds', 'cpu_saved', "Estimated CPU time saved by storing incompressible files"),
+        ('success', 'success', "1 if the phase succeeded"),
+    )
+    SUMMED_FIELDS = ('seconds', 'bytes_in', 'bytes_out', 'files', 'cpu_saved')
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self.counts = {}
+        self.active = {}
+        self._lock = threading.Lock()
+
+    def begin(self, phase, name):
+        """Mark a phase of a volume as started, until its record comes in"""
+        with self._lock:
+            self.active[name] = (phase, time.monotonic())
+
+    def record(self, phase, name, seconds, bytes_in=0, bytes_out=0, files=0, success=True, cpu_saved=0):
+        with self._lock:
+            self.records.append({'phase': phase, 'name': name, 'seconds': seconds, 'bytes_in': bytes_in,
+                                 'bytes_out': bytes_out, 'files': files, 'success': bool(success),
+                                 'cpu_saved': cpu_saved})
+            if self.active.get(name, (None,))[0] == phase:
+                del self.active[name]
+
+    @contextlib.contextmanager
+    def measure(self, phase, name):
+        """Time the block and record it, the yielded dict takes bytes_in, bytes_out, files, cpu_saved and success"""
+        values = {'bytes_in': 0, 'bytes_out': 0, 'files': 0, 'success': True, 'cpu_saved': 0}
+        self.begin(phase, name)
+        started = time.monotonic()
+        try:
+            yield values
+        except BaseException:
+            values['success'] = False
+            raise
+        finally:
+            self.record(phase, name, time.monotonic() - started, **values)
+
+    def volume_seconds(self, name):
+        """Time spent on one volume or container across all phases"""
+        with self._lock:
+            return sum(record['seconds'] for record in self.records if record['name'] == name)
+
+    def volume_cpu_saved(self, name):
+        """Estimated compression CPU time one volume saved by storing incompressible files"""
+        with self._lock:
+            return sum(record['cpu_saved'] for record in self.records if record['name'] == name)
+
+    def volume_progress(self, name):
+        """Return (phase in progress and its seconds so far or None, records of one volume so far)"""
+        with self._lock:
+            active = self.active.get(name)
+            records = [record for record in self.records if record['name'] == name]
+        return (active[0], time.monotonic() - active[1]) if active else None, records
+
+    def phase_totals(self, records=None):
+        """Return phase -> summed seconds, bytes, files and record count, in first-seen order"""
+        totals = {}
+        for record in records if records is not None else self.records:
+            total = totals.setdefault(record['phase'], {'seconds': 0, 'bytes_in': 0, 'bytes_out': 0, 'files': 0,
+                                                        'cpu_saved': 0, 'count': 0, 'failed': 0})
+            for field in self.SUMMED_FIELDS:
+                total[field] += record[field]
+            total['count'] += 1
+            total['failed'] += not record['success']
+        return totals
+
+    def report(self):
+        finished = time.time()
+        with self._lock:
+            records = list(self.records)
         return {
-            'size': total_size,
-            'file_count': file_count,
-            'latest_mtime': latest_mtime,
-            'content_hash': dir_hash.hexdigest()
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'finished': datetime.fromtimestamp(finished).isoformat(),
+            'duration_seconds': finished - self.started,
+            'counts': dict(self.counts),
+            'phases': self.phase_totals(records),
+            'records': records,
         }
-    except Exception as e:
-        logging.error("Error getting directory info for [%s]: %s", directory_path, str(e))
+
+    def write_report(self, path):
+        write_file_atomic(path, json.dumps(self.report(), indent=2))
+        logging.info("Metrics report written to [%s]", path)
+
+    def write_prometheus(self, path):
+        """Write the run in the Prometheus text format, for the node_exporter textfile collector"""
+        report = self.report()
+        # One sample per phase and volume, repeated phases (retries) are summed
+        samples = {}
+        for record in report['records']:
+            sample = samples.setdefault((record['phase'], record['name']),
+                                        {'seconds': 0, 'bytes_in': 0, 'bytes_out': 0, 'files': 0, 'cpu_saved': 0,
+                                         'success': 1})
+            for field in self.SUMMED_FIELDS:
+                sample[field] += record[field]
+            sample['success'] = min(sample['success'], int(record['success']))
+        lines = []
+        for metric, field, help_text in self.PHASE_METRICS:
+            lines += [f"# HELP docker_backup_phase_{metric} {help_text}",
+                      f"# TYPE docker_backup_phase_{metric} gauge"]
+            for (phase, name), sample in samples.items():
+                if field == 'throughput':
+                    value = sample['bytes_in'] / sample['seconds'] if sample['seconds'] > 0 else 0
+                else:
+                    value = sample[field]
+                lines.append(f'docker_backup_phase_{metric}{{phase="{phase}",volume="{prometheus_label(name)}"}} '
+                             f'{value:.6g}')
+        lines += ["# HELP docker_backup_volumes Volumes and databases by outcome of the last run",
+                  "# TYPE docker_backup_volumes gauge"]
+        lines += [f'docker_backup_volumes{{status="{status}"}} {count}' for status, count in report['counts'].items()]
+        lines += ["# HELP docker_backup_run_duration_seconds Duration of the last run",
+                  "# TYPE docker_backup_run_duration_seconds gauge",
+                  f"docker_backup_run_duration_seconds {report['duration_seconds']:.6g}",
+                  "# HELP docker_backup_last_run_timestamp_seconds Unix time the last run finished",
+                  "# TYPE docker_backup_last_run_timestamp_seconds gauge",
+                  f"docker_backup_last_run_timestamp_seconds {time.time():.0f}"]
+        write_file_atomic(path, "\n".join(lines) + "\n")
+        logging.info("Prometheus metrics written to [%s]", path)
+
+# Function to escape a Prometheus label value
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Function to replace a file in one step
+def write_file_atomic(path, content):
+    """Write `content` next to `path` and rename it, readers never see a partial file"""
+    temp_file = path + ".tmp"
+    with open(temp_file, 'w') as f:
+        f.write(content)
+    os.replace(temp_file, path)
+
+run_metrics = RunMetrics()
+
+# Longest message Telegram accepts, in UTF-16 code units
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Function to split a message into parts Telegram accepts
+def split_telegram_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Split `text` at line breaks into parts of at most `limit` UTF-16 code
+    units, so Markdown kept on one line is never cut. Longer lines are cut
+    where they must
+    """
+    parts = []
+    current = None
+    current_units = 0
+    for line in text.split("\n"):
+        units = len(line.encode('utf-16-le')) // 2
+        if current is not None and current_units + 1 + units <= limit:
+            current += "\n" + line
+            current_units += 1 + units
+            continue
+        if current is not None:
+            parts.append(current)
+        while units > limit:
+            cut = 0
+            cut_units = 0
+            while cut_units + (2 if ord(line[cut]) > 0xFFFF else 1) <= limit:
+                cut_units += 2 if ord(line[cut]) > 0xFFFF else 1
+                cut += 1
+            parts.append(line[:cut])
+            line = line[cut:]
+            units -= cut_units
+        current, current_units = line, units
+    parts.append(current)
+    return parts
+
+# Background sender of Telegram notifications
+class TelegramNotifier:
+    """
+    Queue of Telegram messages and documents sent by a thread of its own,
+    so a slow or failing Bot API never holds up a backup. Messages queued
+    while the thread is busy are merged, then split again at
+    TELEGRAM_MESSAGE_LIMIT. A 429 answer is waited out for the retry_after
+    Telegram asks for, other errors are retried with backoff and then
+    dropped. While a run is in progress, one message is edited every
+    `progress_interval` seconds with what the render function returns
+    """
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, bot, chat_id, progress_interval=TELEGRAM_PROGRESS_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.progress_interval = progress_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # Render function, message ID and last text of the progress message
+        self._render = None
+        self._progress_id = None
+        self._progress_text = None
+        self._progress_due = 0
+
+    def _put(self, item):
+        # Started on first use, so importing main.py starts no thread
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="telegram", daemon=True)
+                self._thread.start()
+        self._queue.put(item)
+
+    def send_message(self, text, parse_mode=None):
+        self._put(('message', text, parse_mode))
+
+    def send_document(self, path):
+        self._put(('document', path, None))
+
+    def start_progress(self, render):
+        """Post a progress message and keep it updated with the text `render()` returns"""
+        if self.progress_interval > 0:
+            self._put(('progress', render, None))
+
+    def stop_progress(self):
+        """Update the progress message one last time and leave it as it is"""
+        if self.progress_interval > 0:
+            self._put(('progress', None, None))
+
+    def flush(self, timeout):
+        """Wait up to `timeout` seconds for everything queued so far, returns False if some of it is left"""
+        done = threading.Event()
+        self._put(('flush', done, None))
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            timeout = max(self._progress_due - time.monotonic(), 0) if self._render else None
+            try:
+                items = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+            # Everything queued meanwhile goes out together
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._deliver(items)
+                if self._render and time.monotonic() >= self._progress_due:
+                    self._update_progress()
+            except Exception as e:
+                logging.error("Telegram notifier error: [%s]", str(e))
+
+    def _deliver(self, items):
+        pending = []
+        for kind, value, parse_mode in items:
+            if kind == 'message':
+                if pending and pending[-1][1] == parse_mode:
+                    pending[-1][0] += "\n\n" + value
+                else:
+                    pending.append([value, parse_mode])
+                continue
+            self._send_messages(pending)
+            pending = []
+            if kind == 'document':
+                self._call("send " + os.path.basename(value), lambda: self._send_file(value))
+            elif kind == 'progress':
+                if self._render:
+                    self._update_progress()
+                self._render = value
+                self._progress_id = self._progress_text = None
+                self._progress_due = 0
+            elif kind == 'flush':
+                value.set()
+        self._send_messages(pending)
+
+    def _send_messages(self, messages):
+        for text, parse_mode in messages:
+            for part in split_telegram_message(text):
+                self._call("send message", lambda: self.bot.send_message(self.chat_id, part, parse_mode=parse_mode))
+
+    def _send_file(self, path):
+        with open(path, 'rb') as document:
+            return self.bot.send_document(self.chat_id, document)
+
+    def _update_progress(self):
+        self._progress_due = time.monotonic() + self.progress_interval
+        try:
+            text = split_telegram_message(self._render())[0]
+        except Exception as e:
+            logging.error("Cannot render the progress message: [%s]", str(e))
+            return
+        if self._progress_id is None:
+            message = self._call("send the progress message",
+                                 lambda: self.bot.send_message(self.chat_id, text, parse_mode='Markdown'))
+            if message:
+                self._progress_id, self._progress_text = message.message_id, text
+        elif text != self._progress_text:
+            if self._call("update the progress message",
+                          lambda: self.bot.edit_message_text(text, self.chat_id, self._progress_id,
+                                                             parse_mode='Markdown')):
+                self._progress_text = text
+
+    def _call(self, description, function):
+        """Run a Bot API call, waiting out rate limits and retrying failures, returns None if it failed"""
+        error = None
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                return function()
+            except telebot.apihelper.ApiTelegramException as e:
+                error = e
+                if e.error_code == 429:
+                    delay = (e.result_json.get('parameters') or {}).get('retry_after', 5)
+                    logging.warning("Telegram rate limit, trying to %s again in %ds", description, delay)
+                    time.sleep(delay)
+                    continue
+                # Other client errors, like Markdown Telegram cannot parse, fail the same way again
+                if e.error_code < 500:
+                    break
+            except Exception as e:
+                error = e
+            if attempt + 1 < self.MAX_ATTEMPTS:
+                time.sleep(2 ** attempt)
+        logging.error("Cannot %s: [%s]", description, str(error))
         return None
 
+notifier = TelegramNotifier(bot, TELEGRAM_DEST_CHAT)
+
+
+# Function to scan the files of a single folder
+def scan_folder(folder, prefix, records, file_entries):
+    """
+    List one folder with os.scandir, reusing the DirEntry stat data. Appends
+    a hash record per file to `records` and returns (total size, file count,
+    latest mtime, sub-folders to visit). Symlinked folders are not followed,
+    like os.walk
+    """
+    total_size = 0
+    file_count = 0
+    latest_mtime = 0
+    subfolders = []
+    try:
+        scandir_it = os.scandir(folder)
+    except OSError:
+        # os.walk silently skips folders it cannot list
+        return total_size, file_count, latest_mtime, subfolders
+    with scandir_it:
+        for entry in scandir_it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    subfolders.append((entry.path, prefix + entry.name + os.sep))
+                continue
+            try:
+                stat_info = entry.stat()
+            except OSError as e:
+                logging.warning("Cannot access file [%s]: %s", entry.path, str(e))
+                continue
+            rel_path = prefix + entry.name
+            file_size = stat_info.st_size
+            file_mtime = stat_info.st_mtime
+            total_size += file_size
+            file_count += 1
+            if file_mtime > latest_mtime:
+                latest_mtime = file_mtime
+            # Add file info to hash (relative path + size + mtime)
+            records.append(f"{rel_path}:{file_size}:{file_mtime}")
+            if file_entries is not None:
+                file_entries[rel_path] = (stat_info.st_ino, file_size, stat_info.st_mtime_ns)
+    return total_size, file_count, latest_mtime, subfolders
+
+# Function to scan a folder tree
+def scan_tree(directory_path, prefix, file_entries):
+    """
+    Scan every file under `directory_path` in os.walk order (a folder's files,
+    then each sub-folder in turn) so the change detection hash stays identical.
+    Returns (hash records, total size, file count, latest mtime)
+    """
+    records = []
+    total_size = 0
+    file_count = 0
+    latest_mtime = 0
+    # Explicit stack instead of recursion, pushed in reverse to keep os.walk order
+    stack = [(directory_path, prefix)]
+    while stack:
+        folder, folder_prefix = stack.pop()
+        size, count, mtime, subfolders = scan_folder(folder, folder_prefix, records, file_entries)
+        total_size += size
+        file_count += count
+        latest_mtime = max(latest_mtime, mtime)
+        stack.extend(reversed(subfolders))
+    # One string per sub-tree instead of one hash update per file
+    return "".join(records).encode(), total_size, file_count, latest_mtime
+
+# Thread pool shared by all scans, sub-trees are listed and stat'ed in parallel
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+
+# Function to get the sub-tree scan pool
+def get_scan_pool():
+    """Return the thread pool used to scan the sub-trees of a volume"""
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            _scan_pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="scan")
+        return _scan_pool
+
+# Function to get directory size and modification info
+def get_directory_info(directory_path, file_entries=None):
+    """
+    Get directory size and modification time info for change detection.
+    Top-level sub-folders are scanned in parallel and merged in os.walk order.
+    If `file_entries` is a dict it is filled with relative path -> (inode, size, mtime_ns)
+    """
+    with run_metrics.measure('scan', os.path.basename(directory_path)) as metrics:
+        try:
+            # Files directly in the volume come first, like os.walk
+            records = []
+            total_size, file_count, latest_mtime, subfolders = scan_folder(directory_path, "", records, file_entries)
+            
+            # Create a hash of directory structure and sizes
+            dir_hash = hashlib.md5("".join(records).encode())
+            
+            # Sub-trees share file_entries, each thread only adds its own distinct paths
+            pool = get_scan_pool()
+            futures = [pool.submit(scan_tree, path, prefix, file_entries) for path, prefix in subfolders]
+            for future in futures:
+                subtree_records, size, count, mtime = future.result()
+                dir_hash.update(subtree_records)
+                total_size += size
+                file_count += count
+                latest_mtime = max(latest_mtime, mtime)
+            
+            metrics['files'] = file_count
+            return {
+                'size': total_size,
+                'file_count': file_count,
+                'latest_mtime': latest_mtime,
+                'content_hash': dir_hash.hexdigest()
+            }
+        except Exception as e:
+            logging.error("Error getting directory info for [%s]: %s", directory_path, str(e))
+            metrics['success'] = False
+            return None
+
+# Manifests loaded or committed during this process, keyed by volume name
+_manifest_cache = {}
+# Scanned file lists waiting for a successful backup before they become the new manifest
+_pending_manifests = {}
+
+# Function to get manifest location
+def get_manifest_path(volume_name):
+    """Return the manifest database path for a volume"""
+    return os.path.join(MANIFEST_DIR, f"{volume_name}.db")
+
+# Function to open (and create) a volume manifest
+def open_manifest(volume_name):
+    """Open the manifest database of a volume, creating the schema if needed"""
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    conn = sqlite3.connect(get_manifest_path(volume_name))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                 "path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, hash TEXT"
+                 ") WITHOUT ROWID")
+    return conn
+
+# Function to load a volume manifest
+def load_manifest(volume_name):
+    """
+    Load the manifest of the last successful backup as a dict of
+    relative path -> (inode, size, mtime_ns, hash). Empty if there is none yet
+    """
+    if volume_name in _manifest_cache:
+        return _manifest_cache[volume_name]
+    if not os.path.exists(get_manifest_path(volume_name)):
+        return {}
+    try:
+        conn = open_manifest(volume_name)
+        try:
+            manifest = {row[0]: row[1:] for row in conn.execute("SELECT path, inode, size, mtime_ns, hash FROM files")}
+        finally:
+            conn.close()
+        _manifest_cache[volume_name] = manifest
+        return manifest
+    except sqlite3.Error as e:
+        logging.warning("Cannot load manifest for volume [%s]: %s", volume_name, str(e))
+        return {}
+
+# Function to compare a scan with the previous manifest
+def diff_manifest(previous, current):
+    """Return lists of added, modified and deleted relative paths"""
+    added = []
+    modified = []
+    for path, entry in current.items():
+        previous_entry = previous.get(path)
+        if previous_entry is None:
+            added.append(path)
+        elif previous_entry[:3] != entry[:3]:
+            modified.append(path)
+    deleted = [path for path in previous if path not in current]
+    return {'added': added, 'modified': modified, 'deleted': deleted}
+
+# Function to hash file content for the manifest
+def hash_file(file_path):
+    """Return BLAKE2b hex digest of a file, None if it cannot be read"""
+    try:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                read_throttle.consume(len(block))
+                digest.update(block)
+        return digest.hexdigest()
+    except OSError as e:
+        logging.warning("Cannot hash file [%s]: %s", file_path, str(e))
+        return None
+
+# Function to store a scan as the new volume manifest
+def commit_manifest(volume_name, volume_path):
+    """
+    Make the files scanned for this volume the new manifest. Only the diff is
+    written, so an unchanged volume with millions of files costs nothing
+    """
+    pending = _pending_manifests.pop(volume_name, None)
+    if pending is None:
+        return
+    files, diff = pending
+    previous = load_manifest(volume_name)
+    manifest = {}
+    for path, entry in files.items():
+        previous_entry = previous.get(path)
+        file_hash = previous_entry[3] if previous_entry and previous_entry[:3] == entry else None
+        manifest[path] = entry + (file_hash,)
+    if MANIFEST_HASH:
+        for path in diff['added'] + diff['modified']:
+            manifest[path] = manifest[path][:3] + (hash_file(os.path.join(volume_path, path)),)
+    
+    try:
+        conn = open_manifest(volume_name)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO files (path, inode, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)",
+                                 ((path,) + manifest[path] for path in diff['added'] + diff['modified']))
+                conn.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in diff['deleted']))
+        finally:
+            conn.close()
+        _manifest_cache[volume_name] = manifest
+        logging.debug("Manifest updated for volume [%s]: [%s]", volume_name, get_manifest_path(volume_name))
+    except sqlite3.Error as e:
+        logging.error("Cannot save manifest for volume [%s]: %s", volume_name, str(e))
+
+CATALOG_SCHEMA_VERSION = 2
+
+# Function to open (and create) the backup catalog
+def open_catalog():
+    """
+    Open the catalog database, creating the schema if needed. `volume_state`
+    holds the change detection and chain info of each volume, `runs` and
+    `snapshots` the history of every run and of every archive, chunked
+    snapshot and database dump it produced, failed attempts included
+    """
+    conn = sqlite3.connect(CATALOG_FILE, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] < CATALOG_SCHEMA_VERSION:
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS volume_state ("
+                         "volume TEXT PRIMARY KEY, state TEXT NOT NULL, updated TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                         "id INTEGER PRIMARY KEY, started TEXT NOT NULL, finished TEXT, status TEXT NOT NULL, "
+                         "backed_up INTEGER, failed INTEGER, skipped INTEGER, seconds REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                         "id INTEGER PRIMARY KEY, run_id INTEGER REFERENCES runs (id), volume TEXT NOT NULL, "
+                         "kind TEXT NOT NULL, created TEXT NOT NULL, s3_key TEXT, size_bytes INTEGER, "
+                         "source_bytes INTEGER, codec TEXT, checksum TEXT, seconds REAL, "
+                         "success INTEGER NOT NULL, reason TEXT, deleted TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS snapshots_by_volume ON snapshots (volume, created)")
+            conn.execute("CREATE INDEX IF NOT EXISTS snapshots_by_key ON snapshots (s3_key)")
+            imported = import_legacy_state(conn)
+            conn.execute(f"PRAGMA user_version = {CATALOG_SCHEMA_VERSION}")
+        # Renamed once the import is committed, so it happens exactly once
+        if imported:
+            os.replace(BACKUP_STATE_FILE, BACKUP_STATE_FILE + ".migrated")
+    return conn
+
+# Function to import the backup_state.json of older versions
+def import_legacy_state(conn):
+    """Copy backup_state.json into a new catalog, returns True if there was one"""
+    if not os.path.exists(BACKUP_STATE_FILE):
+        return False
+    with open(BACKUP_STATE_FILE, 'r') as f:
+        state = json.load(f)
+    now = datetime.now().isoformat()
+    conn.executemany("INSERT OR REPLACE INTO volume_state (volume, state, updated) VALUES (?, ?, ?)",
+                     ((volume, json.dumps(entry), now) for volume, entry in state.items() if entry))
+    logging.info("Imported %d volumes from [%s] into the catalog", len(state), BACKUP_STATE_FILE)
+    return True
+
 # Function to load backup state
 def load_backup_state():
-    """Load previous backup state from JSON file"""
+    """Load the change detection and chain info of every volume from the catalog"""
     try:
-        if os.path.exists(BACKUP_STATE_FILE):
-            with open(BACKUP_STATE_FILE, 'r') as f:
-                return json.load(f)
-    except Exception as e:
+        conn = open_catalog()
+        try:
+            return {row['volume']: json.loads(row['state']) for row in conn.execute("SELECT volume, state FROM volume_state")}
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError, ValueError) as e:
         logging.warning("Cannot load backup state: %s", str(e))
     return {}
 
 # Function to save backup state
 def save_backup_state(state):
-    """Save current backup state to JSON file"""
+    """Save the info of every volume to the catalog, in one transaction"""
     try:
-        with open(BACKUP_STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-        logging.debug("Backup state saved to [%s]", BACKUP_STATE_FILE)
-    except Exception as e:
+        conn = open_catalog()
+        try:
+            now = datetime.now().isoformat()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO volume_state (volume, state, updated) VALUES (?, ?, ?)",
+                                 ((volume, json.dumps(entry), now) for volume, entry in state.items() if entry))
+        finally:
+            conn.close()
+        logging.debug("Backup state saved to [%s]", CATALOG_FILE)
+    except sqlite3.Error as e:
         logging.error("Cannot save backup state: %s", str(e))
 
+# Function to add a run to the catalog
+def start_catalog_run():
+    """Record the start of a backup run, returns its id (None if the catalog cannot be written)"""
+    try:
+        conn = open_catalog()
+        try:
+            with conn:
+                return conn.execute("INSERT INTO runs (started, status) VALUES (?, 'running')",
+                                    (datetime.now().isoformat(),)).lastrowid
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error("Cannot record run in the catalog: %s", str(e))
+        return None
+
+# Function to close a run in the catalog
+def finish_catalog_run(run_id, status, backed_up, failed, skipped, seconds):
+    """Record the outcome of a backup run. A run left `running` was interrupted"""
+    try:
+        conn = open_catalog()
+        try:
+            with conn:
+                conn.execute("UPDATE runs SET finished = ?, status = ?, backed_up = ?, failed = ?, skipped = ?, "
+                             "seconds = ? WHERE id = ?",
+                             (datetime.now().isoformat(), status, backed_up, failed, skipped, seconds, run_id))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error("Cannot record run in the catalog: %s", str(e))
+
+# Function to add a backup to the catalog
+def record_snapshot(run_id, volume_name, snapshot, state=None):
+    """
+    Add one backup or failed attempt to the catalog. `snapshot` holds kind
+    (full, incremental, chunked or dump), s3_key, size_bytes, source_bytes,
+    codec, checksum, seconds, success and reason. The new `state` of the
+    volume is saved in the same transaction, so a crash later in the run
+    keeps what is already in the bucket
+    """
+    try:
+        conn = open_catalog()
+        try:
+            now = datetime.now().isoformat()
+            with conn:
+                conn.execute("INSERT INTO snapshots (run_id, volume, kind, created, s3_key, size_bytes, source_bytes, "
+                             "codec, checksum, seconds, success, reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (run_id, volume_name, snapshot['kind'], now, snapshot.get('s3_key'),
+                              snapshot.get('size_bytes'), snapshot.get('source_bytes'), snapshot.get('codec'),
+                              snapshot.get('checksum'), snapshot.get('seconds'), int(bool(snapshot['success'])),
+                              snapshot.get('reason')))
+                if state is not None:
+                    conn.execute("INSERT OR REPLACE INTO volume_state (volume, state, updated) VALUES (?, ?, ?)",
+                                 (volume_name, json.dumps(state), now))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error("Cannot record backup of [%s] in the catalog: %s", volume_name, str(e))
+
+# Function to flag pruned backups in the catalog
+def mark_snapshots_deleted(s3_keys):
+    """Record that these backups were deleted from the bucket"""
+    try:
+        conn = open_catalog()
+        try:
+            now = datetime.now().isoformat()
+            with conn:
+                conn.executemany("UPDATE snapshots SET deleted = ? WHERE s3_key = ? AND deleted IS NULL",
+                                 ((now, s3_key) for s3_key in s3_keys))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error("Cannot record deleted backups in the catalog: %s", str(e))
+
+# Function to look up the checksums recorded at upload
+def get_recorded_checksums():
+    """Return s3_key -> SHA-256 of every backup the catalog has a checksum for"""
+    try:
+        conn = open_catalog()
+        try:
+            return {row['s3_key']: row['checksum'] for row in conn.execute(
+                "SELECT s3_key, checksum FROM snapshots WHERE success = 1 AND checksum IS NOT NULL")}
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.warning("Cannot read checksums from the catalog: %s", str(e))
+        return {}
+
+# Function to find the newest good backup of a volume
+def get_latest_snapshot(volume_name):
+    """Return the newest successful backup of a volume (or database container) as a dict, None if there is none"""
+    conn = open_catalog()
+    try:
+        row = conn.execute("SELECT * FROM snapshots WHERE volume = ? AND success = 1 AND deleted IS NULL "
+                           "ORDER BY created DESC LIMIT 1", (volume_name,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+# Function to sum the stored backups over time
+def get_stored_bytes(volume_name=None):
+    """
+    Return one row per volume and day with the backups taken that day, the
+    bytes they added and the running total still stored in the bucket
+    """
+    query = ("SELECT volume, substr(created, 1, 10) AS day, COUNT(*) AS snapshots, SUM(size_bytes) AS added_bytes, "
+             "SUM(SUM(size_bytes)) OVER (PARTITION BY volume ORDER BY substr(created, 1, 10)) AS total_bytes "
+             "FROM snapshots WHERE success = 1 AND deleted IS NULL{} GROUP BY volume, day ORDER BY volume, day")
+    conn = open_catalog()
+    try:
+        if volume_name:
+            rows = conn.execute(query.format(" AND volume = ?"), (volume_name,)).fetchall()
+        else:
+            rows = conn.execute(query.format("")).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+# Function to print the catalog history
+def print_history(volume_name=None):
+    """Print the latest good backup and the stored bytes per day of one or all volumes"""
+    rows = get_stored_bytes(volume_name)
+    if not rows:
+        print(f"No backups recorded for [{volume_name}]" if volume_name else "No backups recorded")
+        return False
+    for position, row in enumerate(rows):
+        if position == 0 or rows[position - 1]['volume'] != row['volume']:
+            latest = get_latest_snapshot(row['volume'])
+            print(f"{row['volume']} - latest: {latest['created'][:19]} {latest['kind']} [{latest['s3_key']}]")
+        print(f"  {row['day']}  {row['snapshots']:>4} backups  +{row['added_bytes'] / (1024 * 1024):>10.1f} MB  "
+              f"{row['total_bytes'] / (1024 * 1024):>10.1f} MB stored")
+    return True
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+VOLUME_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                     IN_CREATE | IN_DELETE | IN_ONLYDIR)
+ROOT_WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# Filesystem watcher of the daemon, None when WATCH_VOLUMES is off or inotify is unavailable
+volume_watcher = None
+
+# Changed paths of every volume, collected between runs
+class VolumeWatcher:
+    """
+    Watches every folder of the volumes under `root_dirs` with inotify and
+    records the changed files and folders of each volume. A volume needs a
+    full scan until its watches are in place, after the event queue
+    overflowed, and after a failed backup. Volumes that hit the inotify watch
+    limit are not tracked and are always scanned in full
+    """
+    
+    def __init__(self, root_dirs):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.lock = threading.Lock()
+        self.watches = {}  # watch descriptor -> (volume name, folder relative to the volume), volume None for a root folder
+        self.volumes = {}  # volume name -> {'path', 'files', 'folders', 'full_scan'}
+        threading.Thread(target=self.read_events, name="volume-watcher", daemon=True).start()
+        
+        for root_dir in root_dirs:
+            try:
+                self.watches[self.add_watch(root_dir, ROOT_WATCH_MASK)] = (None, root_dir)
+                volume_names = os.listdir(root_dir)
+            except OSError as e:
+                logging.warning("Cannot watch path [%s]: %s", root_dir, str(e))
+                continue
+            for volume_name in volume_names:
+                volume_path = os.path.join(root_dir, volume_name)
+                if os.path.isdir(volume_path):
+                    self.watch_volume(volume_name, volume_path)
+        logging.info("Watching %d volumes with %d inotify watches", len(self.volumes), len(self.watches))
+    
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+    
+    def watch_tree(self, volume_name, volume_path, rel_dir):
+        """Watch a folder of a volume and its sub-folders, symlinked folders are skipped like the scan does"""
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            folder = os.path.join(volume_path, rel_dir)
+            try:
+                wd = self.add_watch(folder, VOLUME_WATCH_MASK)
+                with os.scandir(folder) as scandir_it:
+                    subfolders = [entry.name for entry in scandir_it
+                                  if entry.is_dir() and not entry.is_symlink()]
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                # Gone or unreadable, the scan skips it as well
+                continue
+            with self.lock:
+                self.watches[wd] = (volume_name, rel_dir)
+            stack.extend(os.path.join(rel_dir, name) for name in subfolders)
+    
+    def watch_volume(self, volume_name, volume_path):
+        """Start tracking a volume, its first run is a full scan"""
+        try:
+            self.watch_tree(volume_name, volume_path, "")
+        except OSError as e:
+            logging.warning("Cannot watch volume [%s], it is scanned in full on every run "
+                            "(raise fs.inotify.max_user_watches?): %s", volume_name, str(e))
+            self.forget_volume(volume_name)
+            return
+        with self.lock:
+            self.volumes[volume_name] = {'path': volume_path, 'files': set(), 'folders': set(), 'full_scan': True}
+    
+    def forget_volume(self, volume_name):
+        with self.lock:
+            self.volumes.pop(volume_name, None)
+            for wd in [wd for wd, (name, _) in self.watches.items() if name == volume_name]:
+                del self.watches[wd]
+    
+    def read_events(self):
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                start = offset + INOTIFY_EVENT.size
+                name = os.fsdecode(data[start:start + length].rstrip(b'\0'))
+                offset = start + length
+                try:
+                    self.handle_event(wd, mask, name)
+                except Exception as e:
+                    logging.error("Cannot handle inotify event for [%s]: %s", name, str(e))
+                    self.mark_full_scan()
+    
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("inotify event queue overflowed, all volumes will be scanned in full")
+            self.mark_full_scan()
+            return
+        with self.lock:
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                return
+            watch = self.watches.get(wd)
+        if watch is None:
+            return
+        volume_name, rel_dir = watch
+        is_folder = mask & IN_ISDIR
+        appeared = mask & (IN_CREATE | IN_MOVED_TO)
+        
+        if volume_name is None:
+            # A folder directly in ROOT_DIR is a volume
+            if is_folder and appeared:
+                self.watch_volume(name, os.path.join(rel_dir, name))
+            elif is_folder:
+                self.forget_volume(name)
+            return
+        
+        with self.lock:
+            state = self.volumes.get(volume_name)
+            if state is None:
+                return
+            volume_path = state['path']
+            rel_path = os.path.join(rel_dir, name)
+            if not is_folder:
+                state['files'].add(rel_path)
+            elif mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                # Files below a created, moved or deleted folder are listed at scan time
+                state['folders'].add(rel_path)
+        if is_folder and appeared:
+            try:
+                self.watch_tree(volume_name, volume_path, rel_path)
+            except OSError as e:
+                logging.warning("Cannot watch volume [%s], it is scanned in full on every run "
+                                "(raise fs.inotify.max_user_watches?): %s", volume_name, str(e))
+                self.forget_volume(volume_name)
+    
+    def take_changes(self, volume_name):
+        """
+        Return (changed files, changed folders) of a volume since the last
+        call, as paths relative to the volume. None means a full scan is needed
+        """
+        with self.lock:
+            state = self.volumes.get(volume_name)
+            if state is None:
+                return None
+            changes = (state['files'], state['folders'])
+            state['files'], state['folders'] = set(), set()
+            if state['full_scan']:
+                state['full_scan'] = False
+                return None
+            return changes
+    
+    def mark_full_scan(self, volume_names=None):
+        """Scan these volumes (all by default) in full on the next run"""
+        with self.lock:
+            for volume_name, state in self.volumes.items():
+                if volume_names is None or volume_name in volume_names:
+                    state['full_scan'] = True
+
+# Function to scan only the paths a volume watcher reported
+def get_changed_paths_info(volume_path, volume_name, changes, previous_info):
+    """
+    Build the file list of a volume from its manifest, stat'ing only the
+    changed files and listing only the changed folders. Returns the volume
+    info and the file list, like get_directory_info. The content hash of a
+    full scan cannot be computed this way and is left out
+    """
+    changed_files, changed_folders = changes
+    with run_metrics.measure('scan', volume_name) as metrics:
+        files = {path: entry[:3] for path, entry in load_manifest(volume_name).items()}
+        latest_mtime = previous_info.get('latest_mtime', 0)
+        for folder in changed_folders:
+            prefix = folder + os.sep
+            for path in [path for path in files if path.startswith(prefix)]:
+                del files[path]
+            folder_path = os.path.join(volume_path, folder)
+            if os.path.isdir(folder_path) and not os.path.islink(folder_path):
+                _, _, _, mtime = scan_tree(folder_path, prefix, files)
+                latest_mtime = max(latest_mtime, mtime)
+        for path in changed_files:
+            try:
+                stat_info = os.stat(os.path.join(volume_path, path))
+            except OSError:
+                files.pop(path, None)
+                continue
+            if stat.S_ISDIR(stat_info.st_mode):
+                continue
+            files[path] = (stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns)
+            latest_mtime = max(latest_mtime, stat_info.st_mtime)
+        metrics['files'] = len(changed_files)
+    return {
+        'size': sum(entry[1] for entry in files.values()),
+        'file_count': len(files),
+        'latest_mtime': latest_mtime,
+        'content_hash': None
+    }, files
 
 # Function to check if volume needs backup
 def volume_needs_backup(volume_path, volume_name, previous_state):
     """
     Check if volume has changed since last backup
     """
-    current_info = get_directory_info(volume_path)
+    has_manifest = os.path.exists(get_manifest_path(volume_name))
+    changes = volume_watcher.take_changes(volume_name) if volume_watcher else None
+    if changes is not None and has_manifest and volume_name in previous_state:
+        if not any(changes):
+            logging.info("Volume [%s] - no changes seen by the watcher, skipping backup", volume_name)
+            return False, {**previous_state[volume_name], 'changes': {'added': 0, 'modified': 0, 'deleted': 0}}
+        current_info, files = get_changed_paths_info(volume_path, volume_name, changes, previous_state[volume_name])
+    else:
+        changes = None
+        files = {}
+        current_info = get_directory_info(volume_path, files)
     if not current_info:
         logging.warning("Cannot get info for volume [%s], will backup anyway", volume_name)
         return True, current_info
     
+    # Per-file diff against the manifest of the last successful backup
+    diff = diff_manifest(load_manifest(volume_name), files)
+    if changes is not None and not any(diff.values()):
+        current_info['content_hash'] = previous_state[volume_name].get('content_hash')
+    _pending_manifests[volume_name] = (files, diff)
+    current_info['manifest'] = get_manifest_path(volume_name)
+    current_info['changes'] = {change: len(paths) for change, paths in diff.items()}
+    
     if volume_name not in previous_state:
         logging.info("Volume [%s] - first time backup", volume_name)
         return True, current_info
     
+    if has_manifest and any(diff.values()):
+        logging.info("Volume [%s] - files changed (%d added, %d modified, %d deleted)", volume_name,
+                     len(diff['added']), len(diff['modified']), len(diff['deleted']))
+        return True, current_info
+    
     prev_info = previous_state[volume_name]
     
-    # Check if content has changed
-    if current_info['content_hash'] != prev_info.get('content_hash'):
+    # Check if content has changed, runs with watcher changes leave no hash to compare with
+    if (current_info['content_hash'] is not None and prev_info.get('content_hash') is not None
+            and current_info['content_hash'] != prev_info.get('content_hash')):
         logging.info("Volume [%s] - content changed (hash: %s -> %s)", 
                     volume_name, prev_info.get('content_hash', 'none')[:8], 
                     current_info['content_hash'][:8])
@@ -202,211 +1788,3700 @@ def volume_needs_backup(volume_path, volume_name, previous_state):
     logging.info("Volume [%s] - no changes detected, skipping backup", volume_name)
     return False, current_info
 
+# Long-lived S3 client shared by every upload of the run
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
 # Function to initialize S3 client
 def get_s3_client():
-    """Initialize and return S3 client"""
-    try:
-        # Configure for Backblaze B2 S3-compatible API
-        endpoint_url = os.environ.get('AWS_ENDPOINT_URL', f'https://s3.{AWS_REGION}.backblazeb2.com')
-        
-        if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-            s3_client = boto3.client(
-                's3',
-                endpoint_url=endpoint_url,
-                aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                region_name=AWS_REGION
-            )
-        else:
-            # Use instance profile or default credentials
-            s3_client = boto3.client('s3', endpoint_url=endpoint_url, region_name=AWS_REGION)
-        
-        # Test connection
-        s3_client.head_bucket(Bucket=S3_BUCKET)
-        return s3_client
-    except NoCredentialsError:
-        logging.error("AWS credentials not found")
-        return None
-    except ClientError as e:
-        logging.error("S3 connection error: %s", str(e))
-        return None
-    except Exception as e:
-        logging.error("S3 client initialization error: %s", str(e))
-        return None
+    """
+    Return the run-wide S3 client, creating it on first use. The client is
+    thread-safe and keeps a connection pool sized for all upload workers, so
+    TLS setup, credential resolution and the bucket check happen only once
+    """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is not None:
+            return _s3_client
+        try:
+            # Configure for Backblaze B2 S3-compatible API
+            endpoint_url = os.environ.get('AWS_ENDPOINT_URL', f'https://s3.{AWS_REGION}.backblazeb2.com')
+            client_config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                   retries={'max_attempts': 5, 'mode': 'standard'})
+            
+            if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+                s3_client = boto3.client(
+                    's3',
+                    endpoint_url=endpoint_url,
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    region_name=AWS_REGION,
+                    config=client_config
+                )
+            else:
+                # Use instance profile or default credentials
+                s3_client = boto3.client('s3', endpoint_url=endpoint_url, region_name=AWS_REGION,
+                                         config=client_config)
+            
+            # Test connection
+            s3_client.head_bucket(Bucket=S3_BUCKET)
+            _s3_client = s3_client
+            logging.debug("S3 client initialized for [%s]", endpoint_url)
+            return s3_client
+        except NoCredentialsError:
+            logging.error("AWS credentials not found")
+            return None
+        except ClientError as e:
+            logging.error("S3 connection error: %s", str(e))
+            return None
+        except Exception as e:
+            logging.error("S3 client initialization error: %s", str(e))
+            return None
 
-# Function to upload file to S3
-def upload_to_s3(file_path, s3_key):
-    """Upload file to S3 bucket"""
-    try:
+# Function to summarize transfer speed
+def transfer_stats(size_bytes, seconds):
+    """Return size, duration and throughput of a transfer"""
+    return {
+        'bytes': size_bytes,
+        'seconds': seconds,
+        'mb_per_s': size_bytes / (1024 * 1024) / seconds if seconds > 0 else 0
+    }
+
+# Function to generate download link for an uploaded object
+def get_download_url(s3_client, s3_key):
+    """Generate presigned URL for download (expires in 7 days)"""
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET, 'Key': s3_key},
+        ExpiresIn=7*24*3600  # 7 days
+    )
+
+# Write-only file object backed by an S3 multipart upload
+class S3MultipartWriter:
+    """
+    File-like sink that slices everything written to it into fixed-size parts
+    and uploads them as an S3 multipart upload while the producer keeps writing.
+    At most `max_inflight` parts are buffered or uploading at the same time,
+    so memory stays bounded no matter how large the stream is. The SHA-256
+    of the stream is kept in `checksum`. A stream that fits in one part is
+    stored with a single PUT, which also carries the checksum as metadata;
+    a multipart upload is created before its checksum is known
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size, max_inflight):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self.upload_id = None
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._part_number = 0
+        self._parts = {}
+        self._futures = []
+        self._error = None
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight)
+
+    @property
+    def checksum(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        if self._error:
+            raise self._error
+        self._hash.update(data)
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def _submit(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            logging.debug("Multipart upload started: [%s] (id: %s)", self.key, self.upload_id)
+        # Blocks the producer once max_inflight parts are pending
+        self._slots.acquire()
+        self._part_number += 1
+        self._futures.append(self._executor.submit(self._upload_part, self._part_number, data))
+
+    def _upload_part(self, part_number, data):
+        try:
+            upload_throttle.consume(len(data))
+            response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, PartNumber=part_number,
+                                                  UploadId=self.upload_id, Body=data)
+            self._parts[part_number] = response['ETag']
+            logging.debug("Uploaded part %d of [%s] (%d bytes)", part_number, self.key, len(data))
+        except Exception as e:
+            self._error = e
+            raise
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Flush the last part and complete the multipart upload"""
+        if self.upload_id is None:
+            upload_throttle.consume(len(self._buffer))
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer),
+                                      Metadata={CHECKSUM_METADATA_KEY: self.checksum})
+            self._executor.shutdown(wait=True)
+            logging.debug("Uploaded [%s] in a single request (%d bytes)", self.key, self.bytes_written)
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        wait(self._futures)
+        self._executor.shutdown(wait=True)
+        if self._error:
+            raise self._error
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': self._parts[number]}
+                                       for number in sorted(self._parts)]}
+        )
+        logging.debug("Multipart upload completed: [%s] (%d parts)", self.key, self._part_number)
+
+    def abort(self):
+        """Drop pending parts and abort the multipart upload"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self.upload_id is None:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            logging.warning("Multipart upload aborted: [%s]", self.key)
+        except Exception as e:
+            logging.error("Cannot abort multipart upload [%s]: %s", self.key, str(e))
+
+# Set when the daemon is asked to stop, running uploads checkpoint and stop at the next part
+shutdown_requested = threading.Event()
+
+# Raised when an upload stops early because of a shutdown
+class UploadInterrupted(Exception):
+    pass
+
+# Lock around read-modify-write of the upload checkpoint file
+_upload_checkpoints_lock = threading.Lock()
+
+# Function to load the upload checkpoints
+def load_upload_checkpoints():
+    """Return the in-progress multipart uploads, keyed by S3 key"""
+    try:
+        if os.path.exists(UPLOAD_CHECKPOINT_FILE):
+            with open(UPLOAD_CHECKPOINT_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        logging.warning("Cannot load upload checkpoints: %s", str(e))
+    return {}
+
+# Function to save or drop the checkpoint of one upload
+def save_upload_checkpoint(s3_key, checkpoint):
+    """Store `checkpoint` for `s3_key`, or remove it when `checkpoint` is None"""
+    with _upload_checkpoints_lock:
+        checkpoints = load_upload_checkpoints()
+        if checkpoint is None:
+            if checkpoints.pop(s3_key, None) is None:
+                return
+        else:
+            checkpoints[s3_key] = checkpoint
+        try:
+            # A crash never leaves a half-written checkpoint file
+            write_file_atomic(UPLOAD_CHECKPOINT_FILE, json.dumps(checkpoints, indent=2))
+        except Exception as e:
+            logging.error("Cannot save upload checkpoint: %s", str(e))
+
+# Function to list the parts S3 has confirmed for a multipart upload
+def list_uploaded_parts(s3_client, s3_key, upload_id):
+    """Return part number -> ETag of every part stored for the upload"""
+    parts = {}
+    paginator = s3_client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = part['ETag']
+    return parts
+
+# Function to upload a file as a resumable multipart upload
+def upload_file_resumable(s3_client, file_path, s3_key, checkpoint_info=None, metadata=None):
+    """
+    Upload a file in parts, recording the upload ID and every confirmed part
+    in UPLOAD_CHECKPOINT_FILE. If a checkpoint for the same key and file exists,
+    the upload continues after the parts S3 has already confirmed.
+    `checkpoint_info` is stored with the checkpoint, `metadata` with the
+    object. Returns the bytes sent
+    """
+    stat_info = os.stat(file_path)
+    file_size = stat_info.st_size
+    # S3 allows at most 10000 parts per upload
+    part_size = max(S3_MULTIPART_CHUNKSIZE_MB * 1024 * 1024, -(-file_size // 10000))
+    part_count = max(-(-file_size // part_size), 1)
+    
+    checkpoint = load_upload_checkpoints().get(s3_key)
+    parts = {}
+    if checkpoint and (checkpoint.get('archive_path'), checkpoint.get('archive_size'),
+                       checkpoint.get('archive_mtime_ns'), checkpoint.get('part_size')) == \
+            (file_path, file_size, stat_info.st_mtime_ns, part_size):
+        try:
+            confirmed = list_uploaded_parts(s3_client, s3_key, checkpoint['upload_id'])
+            parts = {int(number): etag for number, etag in checkpoint['parts'].items()
+                     if confirmed.get(int(number)) == etag}
+            logging.info("Resuming upload of [%s] from part %d (%d of %d parts confirmed)",
+                         s3_key, min(set(range(1, part_count + 1)) - set(parts), default=part_count),
+                         len(parts), part_count)
+        except ClientError as e:
+            logging.warning("Cannot resume upload of [%s], starting over: %s", s3_key, str(e))
+            checkpoint = None
+    else:
+        checkpoint = None
+    
+    if checkpoint is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=S3_BUCKET, Key=s3_key, Metadata=metadata or {})['UploadId']
+        checkpoint = {**(checkpoint_info or {}), 'upload_id': upload_id, 'archive_path': file_path,
+                      'archive_size': file_size, 'archive_mtime_ns': stat_info.st_mtime_ns,
+                      'part_size': part_size, 'offset': 0, 'parts': {},
+                      'started': datetime.now().isoformat()}
+        save_upload_checkpoint(s3_key, checkpoint)
+    upload_id = checkpoint['upload_id']
+    parts_lock = threading.Lock()
+    
+    def upload_part(part_number):
+        if shutdown_requested.is_set():
+            raise UploadInterrupted("Shutting down, the upload resumes on the next run")
+        with open(file_path, 'rb') as f:
+            f.seek((part_number - 1) * part_size)
+            data = f.read(part_size)
+        upload_throttle.consume(len(data))
+        response = s3_client.upload_part(Bucket=S3_BUCKET, Key=s3_key, PartNumber=part_number,
+                                         UploadId=upload_id, Body=data)
+        with parts_lock:
+            parts[part_number] = response['ETag']
+            # Offset of the source archive up to which every part is confirmed
+            contiguous = 0
+            while contiguous + 1 in parts:
+                contiguous += 1
+            checkpoint['parts'] = {str(number): etag for number, etag in sorted(parts.items())}
+            checkpoint['offset'] = min(contiguous * part_size, file_size)
+            save_upload_checkpoint(s3_key, checkpoint)
+        return len(data)
+    
+    pending = [number for number in range(1, part_count + 1) if number not in parts]
+    with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as part_pool:
+        sent = sum(part_pool.map(upload_part, pending))
+    
+    s3_client.complete_multipart_upload(
+        Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': parts[number]} for number in sorted(parts)]}
+    )
+    save_upload_checkpoint(s3_key, None)
+    return sent
+
+# Function to upload file to S3
+def upload_to_s3(file_path, s3_key, checkpoint_info=None, metadata=None):
+    """
+    Upload file to S3 bucket with the shared transfer settings and optional
+    object `metadata`. Files above the multipart threshold are uploaded
+    resumably and failed uploads are retried UPLOAD_RETRIES times, continuing
+    from the last confirmed part. Returns (success, url or error message,
+    transfer stats)
+    """
+    try:
         s3_client = get_s3_client()
         if not s3_client:
-            return False, "S3 client initialization failed"
+            return False, "S3 client initialization failed", None
         
         file_size = os.path.getsize(file_path)
         file_size_mb = file_size / (1024 * 1024)
         
         logging.info("Uploading to S3: [%s] (%.1f MB)", s3_key, file_size_mb)
         
-        s3_client.upload_file(file_path, S3_BUCKET, s3_key)
+        started = time.monotonic()
+        sent_bytes = 0
+        for attempt in range(UPLOAD_RETRIES + 1):
+            try:
+                if file_size >= S3_MULTIPART_THRESHOLD_MB * 1024 * 1024:
+                    sent_bytes = upload_file_resumable(s3_client, file_path, s3_key, checkpoint_info, metadata)
+                else:
+                    s3_client.upload_file(file_path, S3_BUCKET, s3_key, ExtraArgs={'Metadata': metadata or {}},
+                                          Config=S3_TRANSFER_CONFIG, Callback=upload_throttle.consume)
+                    sent_bytes = file_size
+                break
+            except (ClientError, BotoCoreError, OSError) as e:
+                if attempt == UPLOAD_RETRIES or shutdown_requested.is_set():
+                    raise
+                delay = 5 * 2 ** attempt
+                logging.warning("Upload of [%s] failed (attempt %d of %d), resuming in %ds: %s",
+                                s3_key, attempt + 1, UPLOAD_RETRIES + 1, delay, str(e))
+                time.sleep(delay)
+        # Throughput only counts what was sent now, not parts confirmed by an earlier run
+        stats = transfer_stats(sent_bytes, time.monotonic() - started)
         
-        # Generate presigned URL for download (expires in 7 days)
-        download_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET, 'Key': s3_key},
-            ExpiresIn=7*24*3600  # 7 days
-        )
+        download_url = get_download_url(s3_client, s3_key)
         
-        logging.info("Successfully uploaded to S3: [%s]", s3_key)
-        return True, download_url
+        logging.info("Successfully uploaded to S3: [%s] (%.1f MB, %.1f MB sent in %.1fs, %.1f MB/s)",
+                     s3_key, file_size_mb, sent_bytes / (1024 * 1024), stats['seconds'], stats['mb_per_s'])
+        return True, download_url, stats
         
     except ClientError as e:
         error_msg = f"S3 upload failed: {str(e)}"
         logging.error(error_msg)
-        return False, error_msg
+        return False, error_msg, None
     except Exception as e:
         error_msg = f"Upload error: {str(e)}"
         logging.error(error_msg)
-        return False, error_msg
+        return False, error_msg, None
+
+# Function to abort multipart uploads nobody will complete
+def sweep_orphaned_uploads(s3_client, max_age_hours):
+    """
+    Abort multipart uploads under S3_PREFIX started more than `max_age_hours`
+    ago. Their parts are billed as storage but never show up as objects.
+    Checkpoints and kept archives of aborted uploads are dropped as well.
+    Returns the number of aborted uploads
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+    checkpoints = load_upload_checkpoints()
+    aborted = 0
+    paginator = s3_client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=S3_PREFIX):
+        for upload in page.get('Uploads', []):
+            if upload['Initiated'] >= cutoff:
+                continue
+            try:
+                s3_client.abort_multipart_upload(Bucket=S3_BUCKET, Key=upload['Key'], UploadId=upload['UploadId'])
+                aborted += 1
+                logging.info("Aborted orphaned multipart upload: [%s] (started %s)",
+                             upload['Key'], upload['Initiated'].isoformat())
+            except ClientError as e:
+                logging.warning("Cannot abort multipart upload [%s]: %s", upload['Key'], str(e))
+                continue
+            checkpoint = checkpoints.get(upload['Key'])
+            if checkpoint and checkpoint['upload_id'] == upload['UploadId']:
+                save_upload_checkpoint(upload['Key'], None)
+                if os.path.exists(checkpoint['archive_path']):
+                    os.remove(checkpoint['archive_path'])
+    return aborted
+
+# Function to upload the index of an archive
+def upload_archive_index(s3_client, s3_key, index_data):
+    """Store an archive index next to its archive. Restores work without it, so a failure is only logged"""
+    try:
+        s3_client.put_object(Bucket=S3_BUCKET, Key=s3_key + ARCHIVE_INDEX_SUFFIX, Body=index_data)
+        return True
+    except (ClientError, BotoCoreError) as e:
+        logging.warning("Cannot upload archive index of [%s]: %s", s3_key, str(e))
+        return False
+
+# Function to get file size in MB
+def get_file_size_mb(file_path):
+    """Get file size in MB"""
+    try:
+        return os.path.getsize(file_path) / (1024 * 1024)
+    except OSError:
+        return 0
+
+# Block-parallel gzip compressor
+class ParallelGzipWriter:
+    """
+    Splits the stream into fixed-size blocks and compresses each one into a
+    separate gzip member on a thread pool (zlib releases the GIL). Concatenated
+    members are a valid .gz file, so gzip, tar -xz and Python's gzip module
+    restore it like a regular single-stream archive. `member_offsets` holds
+    the compressed offset of every member, so the archive can be read from
+    any block boundary. Blocks mostly written while set_stored(True) was on
+    are stored at level 0, blocks keep their size so the offsets stay valid.
+    """
+
+    def __init__(self, fileobj, level, threads, block_size):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.stored = False
+        self.stored_bytes = 0
+        self._buffer = bytearray()
+        self._received = 0
+        self._submitted = 0
+        self._stored_ranges = collections.deque()  # [start, end) of stored writes in the stream
+        self._pending = collections.deque()
+        self._max_pending = threads * 2
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self.member_offsets = [0]
+
+    def set_stored(self, stored):
+        self.stored = stored
+
+    def write(self, data):
+        if self.stored and data:
+            end = self._received + len(data)
+            if self._stored_ranges and self._stored_ranges[-1][1] == self._received:
+                self._stored_ranges[-1][1] = end
+            else:
+                self._stored_ranges.append([self._received, end])
+        self._received += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _block_level(self, size):
+        """Level of the next block: 0 if at least half of it was written stored"""
+        start = self._submitted
+        end = self._submitted = start + size
+        stored = 0
+        while self._stored_ranges and self._stored_ranges[0][0] < end:
+            range_start, range_end = self._stored_ranges[0]
+            stored += min(range_end, end) - max(range_start, start)
+            if range_end > end:
+                break
+            self._stored_ranges.popleft()
+        if stored * 2 >= size:
+            self.stored_bytes += size
+            return 0
+        return self.level
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(gzip.compress, block, self._block_level(len(block)), mtime=0))
+        # Keep output ordered and memory bounded: flush the oldest block once the queue is full
+        while len(self._pending) >= self._max_pending:
+            self._write_member(self._pending.popleft().result())
+
+    def _write_member(self, member):
+        self.fileobj.write(member)
+        self.member_offsets.append(self.member_offsets[-1] + len(member))
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_member(self._pending.popleft().result())
+        self._executor.shutdown(wait=True)
+
+# Single-threaded gzip compressor
+class GzipMemberWriter:
+    """
+    gzip stream that can store parts of it uncompressed: set_stored() ends the
+    current gzip member and the next one is written at level 0 (or back at
+    `level`). Like the output of ParallelGzipWriter, the concatenated members
+    are a regular .gz file
+    """
+
+    def __init__(self, fileobj, level):
+        self.fileobj = fileobj
+        self.level = level
+        self.stored = False
+        self.stored_bytes = 0
+        self._member = None
+        self._members = 0
+
+    def set_stored(self, stored):
+        if stored != self.stored and self._member is not None:
+            self._member.close()
+            self._member = None
+        self.stored = stored
+
+    def write(self, data):
+        if self._member is None:
+            self._member = gzip.GzipFile(fileobj=self.fileobj, mode='wb', compresslevel=0 if self.stored else self.level,
+                                         mtime=0)
+            self._members += 1
+        if self.stored:
+            self.stored_bytes += len(data)
+        return self._member.write(data)
+
+    def close(self):
+        # An empty stream still gets one (empty) member
+        if self._member is None and not self._members:
+            self.write(b"")
+        if self._member is not None:
+            self._member.close()
+            self._member = None
+
+# Multithreaded zstd compressor
+class ZstdFrameWriter:
+    """
+    zstd stream that can store parts of it: set_stored() ends the current
+    frame and the next one is written at ZSTD_STORE_LEVEL. zstd restores the
+    concatenated frames as one stream
+    """
+
+    def __init__(self, fileobj, level, threads):
+        self.stored = False
+        self.stored_bytes = 0
+        self._writers = {False: zstandard.ZstdCompressor(level=level, threads=threads).stream_writer(fileobj, closefd=False),
+                         True: zstandard.ZstdCompressor(level=ZSTD_STORE_LEVEL).stream_writer(fileobj, closefd=False)}
+        self._frame_open = False
+        self._frames = 0
+
+    def set_stored(self, stored):
+        if stored != self.stored and self._frame_open:
+            self._writers[self.stored].flush(zstandard.FLUSH_FRAME)
+            self._frame_open = False
+        self.stored = stored
+
+    def write(self, data):
+        if not self._frame_open:
+            self._frame_open = True
+            self._frames += 1
+        if self.stored:
+            self.stored_bytes += len(data)
+        return self._writers[self.stored].write(data)
+
+    def close(self):
+        # Closing a writer ends its frame, or writes an empty one if nothing was written at all
+        if self._frame_open or not self._frames:
+            self._writers[self.stored].close()
+            self._frame_open = False
+
+# Pass-through "compressor" for data that is already compressed
+class PlainWriter:
+    """Writes the tar stream as-is"""
+
+    stored_bytes = 0
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def set_stored(self, stored):
+        pass
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+# Function to open the configured compressor on top of an output stream
+def open_compressor(fileobj, codec=None, level=None):
+    """
+    Return a write-only compressor for `codec` (defaults to COMPRESSION) that
+    writes into `fileobj`. Closing the compressor flushes it but leaves
+    `fileobj` open. `set_stored(True)` makes it store what follows without
+    compressing it, `stored_bytes` counts the bytes stored that way
+    """
+    codec = codec or COMPRESSION
+    level = COMPRESSION_LEVEL if level is None else level
+    if codec == 'gzip':
+        return GzipMemberWriter(fileobj, level)
+    if codec == 'pgzip':
+        return ParallelGzipWriter(fileobj, level, COMPRESSION_THREADS, COMPRESSION_BLOCK_KB * 1024)
+    if codec == 'zstd':
+        return ZstdFrameWriter(fileobj, level, COMPRESSION_THREADS)
+    return PlainWriter(fileobj)
+
+# Function to tell whether a file is worth compressing
+def is_incompressible(file_path, fd, size, stats=None):
+    """
+    True if the open file `fd` is not worth compressing: a known compressed
+    format by its extension, or a sample from its middle that zlib level 1
+    shrinks by less than SKIP_COMPRESSION_MIN_SAVING. Files under
+    SKIP_COMPRESSION_MIN_KB are always compressed. The CPU time spent on
+    samples is added to stats['sample_seconds']
+    """
+    if not SKIP_COMPRESSION or size < SKIP_COMPRESSION_MIN_KB * 1024:
+        return False
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    started = time.thread_time()
+    try:
+        sample = os.pread(fd, COMPRESSIBILITY_SAMPLE_SIZE, max(size // 2 - COMPRESSIBILITY_SAMPLE_SIZE // 2, 0))
+        return bool(sample) and len(zlib.compress(sample, 1)) > len(sample) * (1 - SKIP_COMPRESSION_MIN_SAVING)
+    except OSError:
+        return False
+    finally:
+        if stats is not None:
+            stats['sample_seconds'] = stats.get('sample_seconds', 0) + time.thread_time() - started
+
+# CPU seconds per byte of compressing and storing random data, keyed by (codec, level)
+_compression_costs = {}
+
+# Function to measure what compressing incompressible data costs
+def get_compression_costs(codec, level):
+    """
+    Return (compress, store) CPU seconds per byte of incompressible data for
+    `codec` ('zlib' for chunks) at `level`, measured once per process on
+    random data
+    """
+    key = (codec, level)
+    if key not in _compression_costs:
+        sample = os.urandom(1024 * 1024)
+        if codec == 'zstd':
+            functions = (zstandard.ZstdCompressor(level=level).compress,
+                         zstandard.ZstdCompressor(level=ZSTD_STORE_LEVEL).compress)
+        elif codec in ('gzip', 'pgzip', 'zlib'):
+            functions = (lambda data: zlib.compress(data, level), lambda data: zlib.compress(data, 0))
+        else:
+            functions = ()
+        costs = []
+        for function in functions:
+            started = time.thread_time()
+            function(sample)
+            costs.append((time.thread_time() - started) / len(sample))
+        _compression_costs[key] = tuple(costs) if costs else (0.0, 0.0)
+    return _compression_costs[key]
+
+# Function to estimate the CPU time storing incompressible files saved
+def estimate_cpu_saved(codec, level, stored_bytes, sample_seconds=0):
+    """Compressing `stored_bytes` at `level` minus storing them and sampling files, in CPU seconds"""
+    if not stored_bytes:
+        return 0.0
+    compress_cost, store_cost = get_compression_costs(codec, level)
+    return max(stored_bytes * (compress_cost - store_cost) - sample_seconds, 0.0)
+
+# Encoded pax extended headers by record size, see encode_tar_header
+_pax_headers = {}
+FAST_HEADER_TYPES = (tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.SYMTYPE, tarfile.LNKTYPE, tarfile.FIFOTYPE)
+
+# Function to encode one ustar header block
+def ustar_block(name, mode, uid, gid, size, mtime, typeflag, linkname=b"", uname=b"", gname=b""):
+    block = b"".join((name.ljust(100, b"\0"), b"%07o\0%07o\0%07o\0%011o\0%011o\0" % (mode, uid, gid, size, mtime),
+                      b"        ", typeflag, linkname.ljust(100, b"\0"), tarfile.POSIX_MAGIC,
+                      uname.ljust(32, b"\0"), gname.ljust(32, b"\0"))).ljust(tarfile.BLOCKSIZE, b"\0")
+    # The checksum is taken with the checksum field filled with spaces
+    return block[:148] + b"%06o\0" % sum(block) + block[155:]
+
+# Function to encode the header of a tar member
+def encode_tar_header(tarinfo):
+    """
+    Same bytes as tarinfo.tobuf() in the PAX format tarfile writes by default,
+    with a fast path for the entries volumes are made of: ASCII names that fit
+    the ustar fields, small ids and a float mtime that gets a pax record. The
+    rest goes through tarfile
+    """
+    name, linkname, uname, gname = tarinfo.name, tarinfo.linkname, tarinfo.uname, tarinfo.gname
+    if tarinfo.type == tarfile.DIRTYPE and not name.endswith('/'):
+        name += '/'
+    mtime = tarinfo.mtime
+    if (tarinfo.type not in FAST_HEADER_TYPES or tarinfo.pax_headers
+            or not (name.isascii() and linkname.isascii() and uname.isascii() and gname.isascii())
+            or len(name) > 100 or len(linkname) > 100 or len(uname) > 32 or len(gname) > 32
+            or not (type(tarinfo.uid) is int and type(tarinfo.gid) is int and type(tarinfo.size) is int)
+            or not (0 <= tarinfo.uid < 8 ** 7 and 0 <= tarinfo.gid < 8 ** 7 and 0 <= tarinfo.size < 8 ** 11)
+            or not (isinstance(mtime, (int, float)) and 0 <= round(mtime) < 8 ** 11)):
+        return tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape')
+    
+    header = ustar_block(name.encode('ascii'), tarinfo.mode & 0o7777, tarinfo.uid, tarinfo.gid, tarinfo.size,
+                         round(mtime), tarinfo.type, linkname.encode('ascii'), uname.encode('ascii'),
+                         gname.encode('ascii'))
+    if not isinstance(mtime, float):
+        return header
+    # Sub-second mtimes go to a pax record, "<record length> mtime=<value>\n"
+    value = str(mtime).encode('ascii')
+    length = record_length = len(value) + len(b" mtime=\n")
+    while length != record_length + len(str(length)):
+        length = record_length + len(str(length))
+    record = b"%d mtime=%s\n" % (length, value)
+    if len(record) not in _pax_headers:
+        _pax_headers[len(record)] = ustar_block(b"././@PaxHeader", 0, 0, 0, len(record), 0, tarfile.XHDTYPE)
+    return _pax_headers[len(record)] + record.ljust(tarfile.BLOCKSIZE, b"\0") + header
+
+# Tar writer for volume archives
+class TarStreamWriter:
+    """
+    Writes the same PAX tar stream as tarfile.add, without most of its
+    per-file cost, which dominates volumes of small files: owner names are
+    looked up once per uid and gid, headers are encoded by encode_tar_header,
+    small files are read with a single call and the output is gathered into
+    TAR_WRITE_SIZE writes. Large files that is_incompressible() flags are
+    written while `compressor` stores instead of compressing. `filter` is
+    called with each TarInfo right before its header is written, like the
+    filter of tarfile.add
+    """
+
+    def __init__(self, fileobj, compressor=None, filter=None, stats=None):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.filter = filter
+        self.stats = stats if stats is not None else {}
+        self.stats.setdefault('stored_files', 0)
+        self.stats.setdefault('sample_seconds', 0.0)
+        self.offset = 0
+        self.stored = False
+        self._buffer = bytearray()
+        self._inodes = {}
+        self._unames = {}
+        self._gnames = {}
+
+    def _write(self, data):
+        self._buffer += data
+        self.offset += len(data)
+        if len(self._buffer) >= TAR_WRITE_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.fileobj.write(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def set_stored(self, stored):
+        """Switch the compressor between compressing and storing, at the current position of the tar stream"""
+        if stored != self.stored and self.compressor is not None:
+            self.flush()
+            self.compressor.set_stored(stored)
+        self.stored = stored
+
+    def gettarinfo(self, path, arcname):
+        """TarFile.gettarinfo, including hard links, with cached owner names. None for sockets"""
+        file_stat = os.lstat(path)
+        arcname = arcname.replace(os.sep, '/').lstrip('/')
+        tarinfo = tarfile.TarInfo(arcname)
+        mode = file_stat.st_mode
+        if stat.S_ISREG(mode):
+            inode = (file_stat.st_ino, file_stat.st_dev)
+            if file_stat.st_nlink > 1 and inode in self._inodes and arcname != self._inodes[inode]:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = self._inodes[inode]
+            else:
+                tarinfo.type = tarfile.REGTYPE
+                tarinfo.size = file_stat.st_size
+                if inode[0]:
+                    self._inodes[inode] = arcname
+        elif stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(mode):
+            tarinfo.type = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            tarinfo.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+            tarinfo.devmajor = os.major(file_stat.st_rdev)
+            tarinfo.devminor = os.minor(file_stat.st_rdev)
+        else:
+            return None
+        tarinfo.mode = mode
+        tarinfo.uid = file_stat.st_uid
+        tarinfo.gid = file_stat.st_gid
+        tarinfo.mtime = file_stat.st_mtime
+        if tarinfo.uid not in self._unames:
+            try:
+                self._unames[tarinfo.uid] = pwd.getpwuid(tarinfo.uid)[0]
+            except KeyError:
+                self._unames[tarinfo.uid] = ""
+        if tarinfo.gid not in self._gnames:
+            try:
+                self._gnames[tarinfo.gid] = grp.getgrgid(tarinfo.gid)[0]
+            except KeyError:
+                self._gnames[tarinfo.gid] = ""
+        tarinfo.uname = self._unames[tarinfo.uid]
+        tarinfo.gname = self._gnames[tarinfo.gid]
+        return tarinfo
+
+    def add(self, path, arcname, recursive=True):
+        """Add a file, or a folder and (with `recursive`) everything below it in sorted order, like tarfile.add"""
+        tarinfo = self.gettarinfo(path, arcname)
+        if tarinfo is None:
+            logging.debug("Skipping unsupported file type: [%s]", path)
+            return
+        if tarinfo.isreg():
+            self.add_regular_file(path, tarinfo)
+            return
+        if self.filter is not None:
+            tarinfo = self.filter(tarinfo)
+            if tarinfo is None:
+                return
+        self.set_stored(False)
+        self.addfile(tarinfo)
+        if tarinfo.isdir() and recursive:
+            for name in sorted(os.listdir(path)):
+                self.add(os.path.join(path, name), os.path.join(arcname, name), recursive)
+
+    def add_regular_file(self, path, tarinfo):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if tarinfo.size <= TAR_SMALL_FILE_SIZE:
+                # Read before the header, so a file that changed size is archived as read
+                data = os.read(fd, tarinfo.size)
+                tarinfo.size = len(data)
+                if self.filter is not None:
+                    tarinfo = self.filter(tarinfo)
+                    if tarinfo is None:
+                        return
+                self.set_stored(False)
+                self.addfile(tarinfo, data)
+                return
+            
+            if self.filter is not None:
+                tarinfo = self.filter(tarinfo)
+                if tarinfo is None:
+                    return
+            stored = self.compressor is not None and is_incompressible(path, fd, tarinfo.size, self.stats)
+            self.set_stored(stored)
+            self.stats['stored_files'] += stored
+            self._write(encode_tar_header(tarinfo))
+            self._copy_file_data(fd, path, 0, tarinfo.size)
+            self._write_padding(tarinfo.size)
+        finally:
+            os.close(fd)
+
+    def _copy_file_data(self, fd, path, start, length):
+        """Write `length` bytes of `fd` from `start`, large ranges bypass the output buffer"""
+        if length > TAR_SMALL_FILE_SIZE:
+            self.flush()
+        position = start
+        end = start + length
+        while position < end:
+            data = os.pread(fd, min(end - position, TAR_WRITE_SIZE), position)
+            if not data:
+                # The header already promised `size` bytes
+                logging.warning("File shrank by %d bytes while being archived, padded with zeros: [%s]",
+                                end - position, path)
+                data = bytes(min(end - position, TAR_WRITE_SIZE))
+            if length > TAR_SMALL_FILE_SIZE:
+                self.fileobj.write(data)
+                self.offset += len(data)
+            else:
+                self._write(data)
+            position += len(data)
+
+    def write_raw(self, data):
+        """Write tar bytes encoded elsewhere, such as the headers laid out by SegmentPlanner"""
+        self.set_stored(False)
+        self._write(data)
+
+    def write_file_range(self, path, start, length, size):
+        """
+        Write bytes [start, start + length) of the data of a regular file whose
+        header promised `size` bytes. The range is stored if is_incompressible()
+        flags the file, a file that can no longer be read is written as zeros
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            logging.warning("Cannot read [%s] any more, archiving %d zero bytes instead: %s", path, length, str(e))
+            self.set_stored(False)
+            for position in range(0, length, TAR_WRITE_SIZE):
+                self._write(bytes(min(TAR_WRITE_SIZE, length - position)))
+            return
+        try:
+            stored = self.compressor is not None and is_incompressible(path, fd, size, self.stats)
+            self.set_stored(stored)
+            # A file split across segments counts once, in the segment with its start
+            self.stats['stored_files'] += stored and start == 0
+            self._copy_file_data(fd, path, start, length)
+        finally:
+            os.close(fd)
+
+    def addfile(self, tarinfo, data=b""):
+        """Add a member with its data as bytes"""
+        self._write(encode_tar_header(tarinfo))
+        if data:
+            self._write(data)
+            self._write_padding(len(data))
+
+    def _write_padding(self, size):
+        if size % tarfile.BLOCKSIZE:
+            self._write(bytes(tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+
+    def close(self):
+        """Write the end-of-archive blocks and fill the last record, like TarFile.close"""
+        self.set_stored(False)
+        self._write(bytes(tarfile.BLOCKSIZE * 2))
+        if self.offset % tarfile.RECORDSIZE:
+            self._write(bytes(tarfile.RECORDSIZE - self.offset % tarfile.RECORDSIZE))
+        self.flush()
+
+# Lays out the tar stream of a folder as independently writable segments
+class SegmentPlanner(TarStreamWriter):
+    """
+    Walks a folder like TarStreamWriter, but reads no file data: the tar
+    stream is laid out as pieces, bytearrays of headers and padding and
+    (path, start, length, file size) ranges of file data. Every
+    `segment_size` bytes of stream, the pieces are passed to `on_segment` as
+    {'number', 'tar_offset', 'tar_size', 'pieces'}. File data crossing a
+    segment boundary is split, so write_tar_segment can write any segment on
+    its own, in any order
+    """
+
+    def __init__(self, segment_size, on_segment, filter=None):
+        super().__init__(None, filter=filter)
+        self.segment_size = segment_size
+        self.on_segment = on_segment
+        self.segments = 0
+        self._pieces = []
+        self._segment_start = 0
+
+    def _room(self):
+        return self._segment_start + self.segment_size - self.offset
+
+    def _advance(self, count):
+        self.offset += count
+        if not self._room():
+            self._end_segment()
+
+    def _end_segment(self):
+        if self.offset > self._segment_start:
+            self.on_segment({'number': self.segments, 'tar_offset': self._segment_start,
+                             'tar_size': self.offset - self._segment_start, 'pieces': self._pieces})
+            self.segments += 1
+            self._pieces = []
+            self._segment_start = self.offset
+
+    def _write(self, data):
+        while data:
+            count = min(len(data), self._room())
+            if self._pieces and isinstance(self._pieces[-1], bytearray):
+                self._pieces[-1] += data[:count]
+            else:
+                self._pieces.append(bytearray(data[:count]))
+            data = data[count:]
+            self._advance(count)
+
+    def flush(self):
+        pass
+
+    def set_stored(self, stored):
+        pass
+
+    def add_regular_file(self, path, tarinfo):
+        if self.filter is not None:
+            tarinfo = self.filter(tarinfo)
+            if tarinfo is None:
+                return
+        self._write(encode_tar_header(tarinfo))
+        start = 0
+        while start < tarinfo.size:
+            count = min(tarinfo.size - start, self._room())
+            self._pieces.append((path, start, count, tarinfo.size))
+            start += count
+            self._advance(count)
+        self._write_padding(tarinfo.size)
+
+    def close(self):
+        """End the tar stream and pass on the last segment"""
+        super().close()
+        self._end_segment()
+
+# Function to add the members of a volume backup to a tar writer
+def add_volume_members(tar, source_dir, arcname, paths=None, deleted=None):
+    """Add all of `source_dir`, or only `paths` and the incremental marker listing the `deleted` files"""
+    if paths is None:
+        tar.add(source_dir, arcname)
+        return
+    for rel_path in paths:
+        try:
+            tar.add(os.path.join(source_dir, rel_path), os.path.join(arcname, rel_path), recursive=False)
+        except FileNotFoundError:
+            logging.warning("File vanished before it could be archived: [%s]", rel_path)
+    marker = json.dumps({'root': arcname, 'deleted': deleted or []}).encode()
+    marker_info = tarfile.TarInfo(INCREMENTAL_MARKER)
+    marker_info.size = len(marker)
+    marker_info.mtime = int(time.time())
+    tar.addfile(tar.filter(marker_info) if tar.filter is not None else marker_info, marker)
+
+# Function to write a folder as a compressed tar stream
+def write_tar_stream(source_dir, fileobj, codec=None, level=None, paths=None, deleted=None, index=None, arcname=None,
+                     stats=None, data_key=None):
+    """
+    Tar `source_dir` through the configured compressor into `fileobj`, under
+    `arcname` (the folder name by default). With `paths` only those files
+    (relative to `source_dir`) are archived and an incremental marker listing
+    the `deleted` files is added. With `data_key` the compressed stream is
+    encrypted on its way to `fileobj`. If `index` is a dict it is filled with
+    the archive index (see load_archive_index). If `stats` is a dict it gets
+    the files and bytes stored without compression and the estimated CPU
+    seconds that saved. Returns the size of the uncompressed tar stream
+    """
+    codec = codec or COMPRESSION
+    level = COMPRESSION_LEVEL if level is None else level
+    output = EncryptingWriter(fileobj, data_key) if data_key else fileobj
+    compressor = open_compressor(output, codec, level)
+    arcname = arcname or os.path.basename(source_dir)
+    # The uncompressed tar stream is what gets read from the volume
+    tar_output = ThrottledWriter(compressor, read_throttle)
+    members = []
+    
+    # Called right before a member's headers are written, so tar.offset is where it starts
+    def record_member(tarinfo):
+        members.append((tarinfo.name, tar.offset))
+        return tarinfo
+    
+    stats = stats if stats is not None else {}
+    tar = TarStreamWriter(tar_output, compressor if codec != 'none' else None, record_member, stats)
+    add_volume_members(tar, source_dir, arcname, paths, deleted)
+    tar.close()
+    compressor.close()
+    if data_key:
+        output.close()
+    stats.update({'stored_bytes': compressor.stored_bytes,
+                  'cpu_saved': estimate_cpu_saved(codec, level, compressor.stored_bytes, stats['sample_seconds'])})
+    
+    if index is not None:
+        index.update({'codec': codec, 'tar_size': tar_output.bytes_written, 'members': members,
+                      'block_size': None, 'blocks': None})
+        if codec == 'pgzip':
+            index.update({'block_size': compressor.block_size, 'blocks': compressor.member_offsets})
+        if data_key:
+            index['encrypted'] = True
+    return tar_output.bytes_written
+
+# Function to write one segment of a tar stream laid out by SegmentPlanner
+def write_tar_segment(pieces, fileobj, codec=None, level=None, stats=None, data_key=None):
+    """
+    Compress the pieces of one segment into `fileobj` as a complete stream
+    of its own, reading the file data now. Like write_tar_stream, large
+    incompressible files are stored and `stats` gets the files and bytes
+    stored that way, and the stream is encrypted with `data_key` if given.
+    Returns the size of the uncompressed segment
+    """
+    codec = codec or COMPRESSION
+    level = COMPRESSION_LEVEL if level is None else level
+    output = EncryptingWriter(fileobj, data_key) if data_key else fileobj
+    compressor = open_compressor(output, codec, level)
+    tar_output = ThrottledWriter(compressor, read_throttle)
+    stats = stats if stats is not None else {}
+    tar = TarStreamWriter(tar_output, compressor if codec != 'none' else None, stats=stats)
+    for piece in pieces:
+        if isinstance(piece, bytearray):
+            tar.write_raw(piece)
+        else:
+            tar.write_file_range(*piece)
+    tar.flush()
+    compressor.close()
+    if data_key:
+        output.close()
+    stats['stored_bytes'] = compressor.stored_bytes
+    return tar_output.bytes_written
+
+# Function to serialize an archive index
+def encode_archive_index(index, data_key=None):
+    """Return the gzipped JSON form an archive index is stored in, encrypted with `data_key` if given"""
+    body = gzip.compress(json.dumps(index, separators=(',', ':')).encode(), mtime=0)
+    if not data_key:
+        return body
+    output = io.BytesIO()
+    encryptor = EncryptingWriter(output, data_key)
+    encryptor.write(body)
+    encryptor.close()
+    return output.getvalue()
+
+# Function to deserialize an archive index
+def decode_archive_index(body):
+    """Decode an archive or segment index stored by encode_archive_index"""
+    if body.startswith(ENCRYPTION_MAGIC):
+        body = DecryptingReader(io.BytesIO(body)).read()
+    return json.loads(gzip.decompress(body))
+
+# Function to compress a folder
+def MakeTar(source_dir, output_filename, paths=None, deleted=None, arcname=None):
+    """
+    Returns the duration, uncompressed size, checksum and skipped compression
+    (see write_tar_stream) of the compression, None if it failed
+    """
+    logging.debug("Compressing: [%s] to: [%s]", source_dir, output_filename)
+    started = time.monotonic()
+    try:
+        index = {}
+        stats = {}
+        data_key = new_data_key()
+        with open(output_filename, 'wb') as output_file:
+            # The checksum is taken as the archive is written, the upload never reads it twice
+            hashing_output = HashingWriter(output_file)
+            tar_bytes = write_tar_stream(source_dir, hashing_output, paths=paths, deleted=deleted, index=index,
+                                         arcname=arcname, stats=stats, data_key=data_key)
+        index['sha256'] = hashing_output.hash.hexdigest()
+        # Uploaded with the archive, see upload_volume_archive
+        with open(output_filename + ARCHIVE_INDEX_SUFFIX, 'wb') as index_file:
+            index_file.write(encode_archive_index(index, data_key))
+        return {'seconds': time.monotonic() - started, 'bytes_in': tar_bytes, 'checksum': index['sha256'],
+                'stored_files': stats['stored_files'], 'stored_bytes': stats['stored_bytes'],
+                'cpu_saved': stats['cpu_saved']}
+    except Exception as e:
+        logging.error("Compression error for [%s]: %s", source_dir, str(e))
+        return None
+
+# Function to compress a folder straight into S3
+def stream_tar_to_s3(source_dir, s3_key, paths=None, deleted=None, arcname=None):
+    """
+    Compress a folder and upload it to S3 in a single pass, without staging the
+    archive in TMP_DIR. Returns (success, url or error message, transfer stats)
+    """
+    logging.debug("Streaming: [%s] to S3: [%s]", source_dir, s3_key)
+    s3_client = get_s3_client()
+    if not s3_client:
+        return False, "S3 client initialization failed", None
+    
+    writer = None
+    try:
+        started = time.monotonic()
+        writer = S3MultipartWriter(s3_client, S3_BUCKET, s3_key,
+                                   S3_PART_SIZE_MB * 1024 * 1024, S3_UPLOAD_QUEUE_PARTS)
+        index = {}
+        tar_stats = {}
+        data_key = new_data_key()
+        tar_bytes = write_tar_stream(source_dir, writer, paths=paths, deleted=deleted, index=index, arcname=arcname,
+                                     stats=tar_stats, data_key=data_key)
+        writer.close()
+        stats = transfer_stats(writer.bytes_written, time.monotonic() - started)
+        stats.update(tar_stats)
+        stats.update({'tar_bytes': tar_bytes, 'checksum': writer.checksum})
+        # Large streams went up as multipart uploads without metadata, the index keeps their checksum
+        index['sha256'] = writer.checksum
+        upload_archive_index(s3_client, s3_key, encode_archive_index(index, data_key))
+        
+        download_url = get_download_url(s3_client, s3_key)
+        logging.info("Successfully streamed to S3: [%s] (%.1f MB in %.1fs, %.1f MB/s)",
+                     s3_key, writer.bytes_written / (1024 * 1024), stats['seconds'], stats['mb_per_s'])
+        return True, download_url, stats
+    except Exception as e:
+        error_msg = f"Streaming upload failed: {str(e)}"
+        logging.error(error_msg)
+        if writer:
+            writer.abort()
+        return False, error_msg, None
+
+# Function to build the substitution tables of the content-defined chunker
+def make_chunk_tables(count, seed=0x636463):
+    """
+    Return `count` fixed 256-byte substitution tables, so chunk boundaries stay
+    stable across runs. The last one is chosen so the XOR of all tables is
+    never zero for any byte value: a run of one repeated byte must not hash
+    to zero, or zero-filled regions would be cut into minimum-size chunks
+    """
+    rng = random.Random(seed)
+    tables = [bytearray(rng.randbytes(256)) for _ in range(count)]
+    for value in range(256):
+        combined = 0
+        for table in tables[:-1]:
+            combined ^= table[value]
+        tables[-1][value] = combined ^ rng.randrange(1, 256)
+    return [bytes(table) for table in tables]
+
+CHUNK_TABLES = make_chunk_tables(4)
+CHUNK_BLOCKS = 3  # odd, see make_chunk_tables; window = 4 tables * 3 blocks = 12 bytes
+
+# Function to hash every position of a buffer for chunking
+def rolling_hashes(data):
+    """
+    Return one hash byte per position of `data`, depending only on the last
+    12 bytes: each of the last 4 bytes goes through the table of its offset,
+    and three such 4-byte groups are XORed together. The whole buffer is
+    hashed with a few translate/shift/XOR operations on big integers, so no
+    Python code runs per byte
+    """
+    group = 0
+    for offset, table in enumerate(CHUNK_TABLES):
+        group ^= int.from_bytes(data.translate(table), 'little') << (8 * offset)
+    combined = group
+    for block in range(1, CHUNK_BLOCKS):
+        combined ^= group << (8 * len(CHUNK_TABLES) * block)
+    return combined.to_bytes(max((combined.bit_length() + 7) // 8, len(data)), 'little')[:len(data)]
+
+# Function to find the end of the next content-defined chunk
+def find_chunk_boundary(hashes, start, end, min_size, max_size, bits):
+    """
+    Return the end offset of the chunk starting at `start`: the first place
+    after `min_size` bytes where `bits` worth of consecutive hash bits are
+    zero, capped at `max_size` bytes and at `end`
+    """
+    limit = min(end, start + max_size)
+    position = start + min_size
+    if position >= limit:
+        return limit
+    zero_bytes, extra_bits = divmod(bits, 8)
+    pattern = b'\x00' * zero_bytes
+    tail = zero_bytes + (1 if extra_bits else 0)
+    extra_mask = (1 << extra_bits) - 1
+    while True:
+        position = hashes.find(pattern, position, limit - tail + zero_bytes)
+        if position < 0:
+            return limit
+        if not extra_bits or not hashes[position + zero_bytes] & extra_mask:
+            return position + tail
+        position += 1
+
+# Function to split a stream into content-defined chunks
+def iter_chunks(fileobj, target_size):
+    """Yield chunks averaging `target_size` bytes (min target/4, max target*4)"""
+    min_size = target_size // 4
+    max_size = target_size * 4
+    bits = max(target_size.bit_length() - 1, 8)
+    read_size = max(max_size * 4, 16 * 1024 * 1024)
+    buffer = b''
+    eof = False
+    while True:
+        if not eof:
+            block = fileobj.read(read_size)
+            read_throttle.consume(len(block))
+            eof = not block
+            buffer += block
+        if not buffer:
+            return
+        # Hash once per buffer fill and cut as many chunks as the buffer allows
+        hashes = rolling_hashes(buffer)
+        start = 0
+        while start < len(buffer) and (eof or len(buffer) - start >= max_size):
+            cut = find_chunk_boundary(hashes, start, len(buffer), min_size, max_size, bits)
+            yield buffer[start:cut]
+            start = cut
+        buffer = buffer[start:]
+        if eof and not buffer:
+            return
+
+# Chunks known to be in the bucket, shared by all volumes of the run
+_chunk_index = None
+_chunk_index_lock = threading.Lock()
+
+# Function to get S3 key of a chunk
+def get_chunk_key(chunk_hash):
+    """Return the S3 key a chunk is stored under"""
+    return f"{S3_PREFIX}chunks/{chunk_hash[:2]}/{chunk_hash}"
+
+# Function to load the local chunk index cache
+def load_chunk_index(s3_client):
+    """
+    Return the set of chunk hashes already stored in the bucket. The set is
+    cached in CHUNK_INDEX_FILE; when that file is missing it is rebuilt once
+    from a listing of the chunk prefix, so we never need a HEAD per chunk
+    """
+    global _chunk_index
+    with _chunk_index_lock:
+        if _chunk_index is not None:
+            return _chunk_index
+        conn = sqlite3.connect(CHUNK_INDEX_FILE)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY) WITHOUT ROWID")
+            _chunk_index = {row[0] for row in conn.execute("SELECT hash FROM chunks")}
+            if not _chunk_index:
+                logging.info("Chunk index is empty, rebuilding it from the bucket listing")
+                paginator = s3_client.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{S3_PREFIX}chunks/"):
+                    _chunk_index.update(item['Key'].rsplit('/', 1)[-1] for item in page.get('Contents', []))
+                with conn:
+                    conn.executemany("INSERT OR IGNORE INTO chunks (hash) VALUES (?)",
+                                     ((chunk_hash,) for chunk_hash in _chunk_index))
+        finally:
+            conn.close()
+        logging.debug("Chunk index loaded: %d chunks", len(_chunk_index))
+        return _chunk_index
+
+# Function to drop the loaded chunk index
+def reset_chunk_index():
+    """Make the next load_chunk_index read CHUNK_INDEX_FILE again, another process may have pruned chunks"""
+    global _chunk_index
+    with _chunk_index_lock:
+        _chunk_index = None
+
+# Context manager keeping backups and `main.py prune` apart
+@contextlib.contextmanager
+def chunk_store_lock(exclusive=False):
+    """
+    Lock on `CHUNK_INDEX_FILE.lock`, shared by backup runs and exclusive for
+    `main.py prune`, which deletes chunks a running backup may be about to
+    reuse. Backups wait for a prune to finish, a prune does not wait: it
+    yields None while a backup holds the lock, the lock file otherwise
+    """
+    with open(CHUNK_INDEX_FILE + ".lock", 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+        except BlockingIOError:
+            yield None
+            return
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Function to let a backup run collect chunks
+def upgrade_chunk_store_lock(lock_file):
+    """
+    Turn the shared chunk_store_lock of a backup run into an exclusive one,
+    returns False while another backup holds it. flock drops the shared lock
+    when this fails, so only call it once the run has stored its chunks
+    """
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+# Function to persist newly uploaded chunks in the local index
+def save_chunk_index(chunk_hashes):
+    """Add confirmed chunk hashes to CHUNK_INDEX_FILE"""
+    with _chunk_index_lock:
+        conn = sqlite3.connect(CHUNK_INDEX_FILE)
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO chunks (hash) VALUES (?)",
+                                 ((chunk_hash,) for chunk_hash in chunk_hashes))
+        finally:
+            conn.close()
+
+# Function to drop deleted chunks from the local index
+def forget_chunks(chunk_hashes):
+    """Remove chunk hashes from CHUNK_INDEX_FILE and the loaded index, so they are uploaded again if needed"""
+    with _chunk_index_lock:
+        conn = sqlite3.connect(CHUNK_INDEX_FILE)
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY) WITHOUT ROWID")
+                conn.executemany("DELETE FROM chunks WHERE hash = ?", ((chunk_hash,) for chunk_hash in chunk_hashes))
+        finally:
+            conn.close()
+        if _chunk_index is not None:
+            _chunk_index.difference_update(chunk_hashes)
+
+# Function to load a chunked snapshot manifest
+def load_snapshot(s3_client, snapshot_key):
+    """Download and decode a snapshot manifest"""
+    body = s3_client.get_object(Bucket=S3_BUCKET, Key=snapshot_key)['Body'].read()
+    return json.loads(gzip.decompress(body))
+
+# Function to back up a volume into the deduplicated chunk store
+def backup_volume_chunked(volume, previous_snapshot_key=None):
+    """
+    Split every file of the volume into content-defined chunks, upload the
+    chunks the bucket doesn't have yet and write a snapshot manifest that
+    lists the chunk hashes of each file. Files whose inode, size and mtime
+    match the previous snapshot reuse its chunk list without being read.
+    The files are read from a frozen view of the volume (see frozen_volume).
+    Returns the per-volume result dict used by the backup summary
+    """
+    volume_name = volume['name']
+    started = time.monotonic()
+    s3_client = get_s3_client()
+    if not s3_client:
+        return {'success': False, 'size_mb': 0, 'url': None, 's3_key': None, 'mb_per_s': 0,
+                'reason': 'S3 client initialization failed'}
+    run_metrics.begin('chunked', volume_name)
+    
+    submitted = []
+    uploaded = []
+    try:
+        with frozen_volume(volume) as (source_dir, snapshot_method):
+            known_chunks = load_chunk_index(s3_client)
+            previous_files = {}
+            if previous_snapshot_key:
+                try:
+                    previous_files = {entry['path']: entry for entry in load_snapshot(s3_client, previous_snapshot_key)['files']}
+                except Exception as e:
+                    logging.warning("Cannot load previous snapshot [%s], reading all files: %s", previous_snapshot_key, str(e))
+            
+            snapshot = {'volume': volume_name, 'root': os.path.basename(volume['path']),
+                        'created': datetime.now().isoformat(), 'target_kb': CHUNK_TARGET_KB,
+                        'dirs': [], 'files': [], 'symlinks': []}
+            upload_futures = []
+            stats = {'read_bytes': 0, 'new_bytes': 0, 'stored_bytes': 0, 'reused_files': 0,
+                     'stored_files': 0, 'uncompressed_bytes': 0, 'sample_seconds': 0.0}
+            # A reflink copy has inodes of its own, unchanged files are recognized by size and mtime
+            reuse_fields = ('size', 'mtime_ns') if snapshot_method == 'reflink' else ('inode', 'size', 'mtime_ns')
+            
+            def upload_chunk(chunk_hash, data, level):
+                body = zlib.compress(data, level)
+                upload_throttle.consume(len(body))
+                s3_client.put_object(Bucket=S3_BUCKET, Key=get_chunk_key(chunk_hash), Body=body)
+                return chunk_hash, len(body)
+            
+            with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as chunk_pool:
+                for root, dirs, files in os.walk(source_dir):
+                    rel_root = os.path.relpath(root, source_dir)
+                    for name in dirs:
+                        dir_path = os.path.join(root, name)
+                        if os.path.islink(dir_path):
+                            files.append(name)
+                            continue
+                        dir_stat = os.lstat(dir_path)
+                        snapshot['dirs'].append({'path': os.path.normpath(os.path.join(rel_root, name)),
+                                                 'mode': dir_stat.st_mode & 0o7777, 'mtime': dir_stat.st_mtime})
+                    for name in files:
+                        file_path = os.path.join(root, name)
+                        rel_path = os.path.normpath(os.path.join(rel_root, name))
+                        try:
+                            file_stat = os.lstat(file_path)
+                            if os.path.islink(file_path):
+                                snapshot['symlinks'].append({'path': rel_path, 'target': os.readlink(file_path)})
+                                continue
+                            entry = {'path': rel_path, 'mode': file_stat.st_mode & 0o7777, 'mtime': file_stat.st_mtime,
+                                     'mtime_ns': file_stat.st_mtime_ns, 'inode': file_stat.st_ino,
+                                     'size': file_stat.st_size, 'chunks': []}
+                            previous = previous_files.get(rel_path)
+                            if previous and all(previous.get(field) == entry[field] for field in reuse_fields):
+                                entry['chunks'] = previous['chunks']
+                                stats['reused_files'] += 1
+                                snapshot['files'].append(entry)
+                                continue
+                        
+                            with open(file_path, 'rb') as f:
+                                # Chunks of already compressed files are stored at level 0
+                                incompressible = is_incompressible(file_path, f.fileno(), file_stat.st_size, stats)
+                                stats['stored_files'] += incompressible
+                                for chunk in iter_chunks(f, CHUNK_TARGET_KB * 1024):
+                                    chunk_hash = hashlib.sha256(chunk).hexdigest()
+                                    entry['chunks'].append(chunk_hash)
+                                    stats['read_bytes'] += len(chunk)
+                                    with _chunk_index_lock:
+                                        is_new = chunk_hash not in known_chunks
+                                        known_chunks.add(chunk_hash)
+                                    if is_new:
+                                        stats['new_bytes'] += len(chunk)
+                                        if incompressible:
+                                            stats['uncompressed_bytes'] += len(chunk)
+                                        submitted.append(chunk_hash)
+                                        upload_futures.append(chunk_pool.submit(upload_chunk, chunk_hash, chunk,
+                                                                                0 if incompressible else 6))
+                                        # Keep a bounded number of chunks in memory
+                                        if len(upload_futures) >= S3_MAX_CONCURRENCY * 2:
+                                            chunk_hash_done, stored = upload_futures.pop(0).result()
+                                            uploaded.append(chunk_hash_done)
+                                            stats['stored_bytes'] += stored
+                            snapshot['files'].append(entry)
+                        except (OSError, IOError) as e:
+                            logging.warning("Cannot read file [%s]: %s", file_path, str(e))
+            
+                for future in upload_futures:
+                    chunk_hash_done, stored = future.result()
+                    uploaded.append(chunk_hash_done)
+                    stats['stored_bytes'] += stored
+            save_chunk_index(uploaded)
+            
+            snapshot_key = f"{S3_PREFIX}snapshots/{volume_name}-{datetime.now().strftime('%Y%m%d_%H%M%S')}.json.gz"
+            snapshot_body = gzip.compress(json.dumps(snapshot).encode(), mtime=0)
+            checksum = hashlib.sha256(snapshot_body).hexdigest()
+            s3_client.put_object(Bucket=S3_BUCKET, Key=snapshot_key, Body=snapshot_body,
+                                 Metadata={CHECKSUM_METADATA_KEY: checksum})
+            stats['stored_bytes'] += len(snapshot_body)
+            
+            transfer = transfer_stats(stats['stored_bytes'], time.monotonic() - started)
+            logging.info("Chunked snapshot [%s]: %d files (%d unchanged), %.1f MB read, %.1f MB new, %d chunks uploaded",
+                         snapshot_key, len(snapshot['files']), stats['reused_files'], stats['read_bytes'] / (1024 * 1024),
+                         stats['new_bytes'] / (1024 * 1024), len(uploaded))
+            cpu_saved = estimate_cpu_saved('zlib', 6, stats['uncompressed_bytes'], stats['sample_seconds'])
+            log_skipped_compression(volume_name, {'stored_files': stats['stored_files'], 'cpu_saved': cpu_saved,
+                                                  'stored_bytes': stats['uncompressed_bytes']})
+            run_metrics.record('chunked', volume_name, transfer['seconds'], bytes_in=stats['read_bytes'],
+                               bytes_out=stats['stored_bytes'], files=len(snapshot['files']), cpu_saved=cpu_saved)
+            return {'success': True, 'size_mb': stats['stored_bytes'] / (1024 * 1024), 'url': get_download_url(s3_client, snapshot_key),
+                    's3_key': snapshot_key, 'mb_per_s': transfer['mb_per_s'], 'reason': None, 'checksum': checksum}
+    except Exception as e:
+        error_msg = f"Chunked backup failed: {str(e)}"
+        logging.error(error_msg)
+        run_metrics.record('chunked', volume_name, time.monotonic() - started, success=False)
+        # Chunks uploaded so far stay valid, forget the ones that never made it
+        with _chunk_index_lock:
+            if _chunk_index is not None:
+                _chunk_index.difference_update(set(submitted) - set(uploaded))
+        save_chunk_index(uploaded)
+        return {'success': False, 'size_mb': 0, 'url': None, 's3_key': None, 'mb_per_s': 0, 'reason': error_msg}
+
+# HTTP connection to the Docker Engine over its unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that connects to a unix socket instead of a TCP port"""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+# Error returned by the Docker Engine API
+class DockerAPIError(Exception):
+    pass
+
+# Minimal Docker Engine API client
+class DockerClient:
+    """
+    Talks to the Docker Engine API over its unix socket, so listing containers
+    or running `exec` doesn't fork the docker CLI every time. Every request uses
+    its own connection, so one client can be shared between threads
+    """
+
+    def __init__(self, socket_path, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, method, path, body=None, timeout=None):
+        """Send a request and return the open response, raise DockerAPIError on HTTP errors"""
+        connection = UnixHTTPConnection(self.socket_path, timeout=timeout or self.timeout)
+        headers = {'Host': 'docker'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        connection.request(method, f"/{DOCKER_API_VERSION}{path}", body=payload, headers=headers)
+        response = connection.getresponse()
+        if response.status >= 400:
+            message = response.read().decode(errors='replace')
+            connection.close()
+            try:
+                message = json.loads(message).get('message', message)
+            except ValueError:
+                pass
+            raise DockerAPIError(f"{method} {path} failed with HTTP {response.status}: {message}")
+        return response
+
+    def request_json(self, method, path, body=None):
+        response = self.request(method, path, body)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        return json.loads(data) if data else None
+
+    def list_containers(self, all=False):
+        """Containers with their image, state and mounts, in a single call"""
+        return self.request_json('GET', f"/containers/json?all={int(all)}")
+
+    def inspect_container(self, container_name):
+        return self.request_json('GET', f"/containers/{urllib.parse.quote(container_name)}/json")
+
+    def pause(self, container_id):
+        self.request_json('POST', f"/containers/{urllib.parse.quote(container_id)}/pause")
+
+    def unpause(self, container_id):
+        self.request_json('POST', f"/containers/{urllib.parse.quote(container_id)}/unpause")
+
+    def exec_stream(self, container_name, cmd, timeout=None):
+        """Start `cmd` in a running container and return a DockerExecStream of its output"""
+        created = self.request_json('POST', f"/containers/{urllib.parse.quote(container_name)}/exec",
+                                    {'Cmd': cmd, 'AttachStdout': True, 'AttachStderr': True, 'Tty': False})
+        response = self.request('POST', f"/exec/{created['Id']}/start", {'Detach': False, 'Tty': False},
+                                timeout=timeout)
+        return DockerExecStream(self, created['Id'], response)
+
+    def exec_run(self, container_name, cmd):
+        """Run `cmd` in a container, returns (exit code, stdout bytes, stderr text)"""
+        stream = self.exec_stream(container_name, cmd)
+        output = stream.read()
+        return stream.wait(), output, stream.stderr_text()
+
+# Output of a command started with DockerClient.exec_stream
+class DockerExecStream:
+    """
+    Readable stdout of an exec session. Docker multiplexes stdout and stderr
+    into frames with an 8-byte header; stdout frames are returned by read()
+    and the tail of stderr is kept for error messages
+    """
+
+    STDERR_LIMIT = 64 * 1024
+
+    def __init__(self, client, exec_id, response):
+        self.client = client
+        self.exec_id = exec_id
+        self.response = response
+        self.stderr = bytearray()
+        self._frame_type = None
+        self._frame_remaining = 0
+
+    def _read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.response.read(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def read(self, size=-1):
+        """Return up to `size` bytes of stdout (all of it if negative), b'' at the end"""
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(1024 * 1024), b""))
+        while True:
+            if not self._frame_remaining:
+                header = self._read_exact(8)
+                if header is None:
+                    return b""
+                self._frame_type = header[0]
+                self._frame_remaining = int.from_bytes(header[4:8], 'big')
+                continue
+            data = self.response.read(min(size, self._frame_remaining))
+            if not data:
+                return b""
+            self._frame_remaining -= len(data)
+            if self._frame_type == 1:
+                return data
+            if self._frame_type == 2:
+                self.stderr += data
+                del self.stderr[:-self.STDERR_LIMIT]
+
+    def stderr_text(self):
+        return self.stderr.decode(errors='replace').strip()
+
+    def close(self):
+        """Stop reading, unblocks a read() running in another thread"""
+        try:
+            self.response.fp.raw._sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        self.response.close()
+
+    def wait(self, timeout=10):
+        """Drain the output and return the exit code of the command"""
+        while self.read(1024 * 1024):
+            pass
+        self.response.close()
+        deadline = time.monotonic() + timeout
+        while True:
+            info = self.client.request_json('GET', f"/exec/{self.exec_id}/json")
+            if not info.get('Running') or time.monotonic() > deadline:
+                return info.get('ExitCode')
+            time.sleep(0.05)
+
+docker_client = DockerClient(DOCKER_SOCKET)
+
+# Function to detect database volumes and containers
+def detect_database_volumes():
+    """
+    Detect database containers and their volumes with a single container
+    listing from the Docker Engine API
+    """
+    db_info = []
+    
+    try:
+        # Get all Docker containers, mounts included
+        containers = docker_client.list_containers(all=True)
+        
+        for container in containers:
+            container_name = (container.get('Names') or [container['Id']])[0].lstrip('/')
+            image = container.get('Image', '').lower()
+            
+            # Check if container image suggests it's a database
+            is_db = any(db_type in image for db_type in ['mysql', 'mariadb', 'postgres', 'mongo', 'redis'])
+            
+            if is_db and container.get('State') == 'running':
+                volumes = [{'source': mount.get('Source', ''), 'destination': mount.get('Destination', '')}
+                           for mount in container.get('Mounts') or []]
+                db_info.append({
+                    'container': container_name,
+                    'image': image,
+                    'volumes': volumes
+                })
+                logging.info("Found database container: [%s] with image [%s]", container_name, image)
+        
+    except Exception as e:
+        logging.error("Error detecting database volumes: %s", str(e))
+    
+    return db_info
+
+# Function to detect how a database container is dumped
+def get_dump_command(container_name):
+    """
+    Return (database type, dump command) for a running database container,
+    or None if it is not running or its database type is unknown
+    """
+    # Check if container exists and is running
+    try:
+        container = docker_client.inspect_container(container_name)
+    except DockerAPIError as e:
+        logging.warning("Container [%s] doesn't exist: %s", container_name, str(e))
+        return None
+    if not container.get('State', {}).get('Running'):
+        logging.warning("Container [%s] is not running", container_name)
+        return None
+    
+    # Detect database type by checking running processes
+    exit_code, output, _ = docker_client.exec_run(container_name, ['ps', 'aux'])
+    if exit_code != 0:
+        logging.warning("Cannot list processes of container [%s]", container_name)
+        return None
+    
+    processes = output.decode(errors='replace').lower()
+    if 'mysqld' in processes or 'mariadb' in processes:
+        # MySQL/MariaDB dump
+        return 'mysql', ['mysqldump', '--all-databases', '--single-transaction', '--routines', '--triggers']
+    if 'postgres' in processes:
+        # PostgreSQL dump
+        return 'postgres', ['pg_dumpall', '-U', 'postgres']
+    
+    logging.warning("Unknown database type in container [%s]", container_name)
+    return None
+
+# Function to create the result dict of a database dump
+def make_dump_result(container_name, reason=None):
+    """Result of a dump that has not succeeded (yet), with every field the summary and catalog read"""
+    return {'container': container_name, 'success': False, 'size_mb': 0, 'raw_mb': 0, 'seconds': 0,
+            'mb_per_s': 0, 'url': None, 's3_key': None, 'reason': reason, 'checksum': None}
+
+# Function to dump database
+def dump_database(container_name):
+    """
+    Dump database from Docker container straight into S3.
+    The exec output is piped through the configured compressor into a
+    multipart upload, so the plain SQL never touches disk.
+    Supports MySQL/MariaDB and PostgreSQL containers.
+    Returns a result dict with the dump size, duration and throughput
+    """
+    result = make_dump_result(container_name)
+    writer = None
+    try:
+        dump = get_dump_command(container_name)
+        if not dump:
+            result['reason'] = 'Not running or unknown database type'
+            return result
+        db_type, dump_cmd = dump
+        
+        s3_client = get_s3_client()
+        if not s3_client:
+            result['reason'] = 'S3 client initialization failed'
+            return result
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        s3_key = f"{S3_PREFIX}databases/{container_name}_{db_type}_{timestamp}{DUMP_SUFFIX}"
+        
+        # Execute dump command
+        logging.info("Dumping database from container [%s] to S3: [%s]", container_name, s3_key)
+        started = time.monotonic()
+        raw_bytes = 0
+        writer = S3MultipartWriter(s3_client, S3_BUCKET, s3_key,
+                                   S3_PART_SIZE_MB * 1024 * 1024, S3_UPLOAD_QUEUE_PARTS)
+        stream = docker_client.exec_stream(container_name, dump_cmd, timeout=DB_DUMP_TIMEOUT)
+        timed_out = threading.Event()
+        
+        def stop_dump():
+            timed_out.set()
+            stream.close()
+        
+        timer = threading.Timer(DB_DUMP_TIMEOUT, stop_dump)
+        timer.start()
+        try:
+            data_key = new_data_key()
+            output = EncryptingWriter(writer, data_key) if data_key else writer
+            compressor = open_compressor(output)
+            while True:
+                data = stream.read(DB_DUMP_READ_SIZE)
+                if not data:
+                    break
+                raw_bytes += len(data)
+                compressor.write(data)
+            compressor.close()
+            if data_key:
+                output.close()
+            returncode = None if timed_out.is_set() else stream.wait()
+        except OSError:
+            # Reading fails once stop_dump shuts the socket down
+            if not timed_out.is_set():
+                raise
+        finally:
+            timer.cancel()
+            stream.close()
+        
+        if timed_out.is_set():
+            raise TimeoutError(f"No result after {DB_DUMP_TIMEOUT}s")
+        if returncode != 0:
+            logging.error("Database dump failed for [%s]: %s", container_name, stream.stderr_text())
+            writer.abort()
+            result['reason'] = f"Dump exited with code {returncode}"
+            return result
+        
+        writer.close()
+        stats = transfer_stats(raw_bytes, time.monotonic() - started)
+        result.update({'success': True, 'size_mb': writer.bytes_written / (1024 * 1024),
+                       'raw_mb': raw_bytes / (1024 * 1024), 'seconds': stats['seconds'],
+                       'mb_per_s': stats['mb_per_s'], 'url': get_download_url(s3_client, s3_key),
+                       's3_key': s3_key, 'checksum': writer.checksum})
+        logging.info("Database dump successful: [%s] (%.1f MB SQL, %.1f MB compressed in %.1fs, %.1f MB/s)",
+                     s3_key, result['raw_mb'], result['size_mb'], stats['seconds'], stats['mb_per_s'])
+        return result
+    
+    except TimeoutError:
+        logging.error("Database dump timed out for container [%s]", container_name)
+        result['reason'] = 'Timed out'
+    except Exception as e:
+        logging.error("Error dumping database from [%s]: %s", container_name, str(e))
+        result['reason'] = str(e)
+    if writer:
+        writer.abort()
+    return result
+
+# Function to dump several databases at once
+def dump_databases(container_names):
+    """
+    Dump the given containers concurrently, at most DB_DUMP_WORKERS at a time.
+    Returns one result dict per container, in order
+    """
+    if not container_names:
+        return []
+    if not (S3_ENABLED and S3_BUCKET):
+        logging.warning("S3 not configured - database dumps cannot be uploaded")
+        return [make_dump_result(name, 'S3 not configured') for name in container_names]
+    
+    def timed_dump(container_name):
+        with run_metrics.measure('dump', container_name) as metrics:
+            result = dump_database(container_name)
+            metrics.update(bytes_in=round(result['raw_mb'] * 1024 * 1024),
+                           bytes_out=round(result['size_mb'] * 1024 * 1024), success=result['success'])
+            return result
+    
+    with ThreadPoolExecutor(max_workers=DB_DUMP_WORKERS, thread_name_prefix="db-dump") as dump_pool:
+        return list(dump_pool.map(timed_dump, container_names))
+
+
+# Fields of a volume's state entry that describe its backup chain
+CHAIN_FIELDS = ('chain', 'last_full')
+
+# Function to decide between a full and an incremental archive
+def plan_volume_backup(volume_name, volume_path, volume_info, previous_entry):
+    """
+    Return the pipeline job for a changed volume. In incremental mode only
+    added/modified files are archived, unless a new full backup is due
+    (no chain yet, no manifest to diff against, FULL_BACKUP_EVERY_RUNS or
+    FULL_BACKUP_EVERY_DAYS reached)
+    """
+    volume = {'name': volume_name, 'path': volume_path, 'info': volume_info, 'backup_type': 'full',
+              'paths': None, 'deleted': None, 'reserve_bytes': (volume_info or {}).get('size', 0)}
+    chain = (previous_entry or {}).get('chain') or []
+    if BACKUP_FORMAT == 'chunked':
+        # Chunked snapshots are always complete, unchanged files are deduplicated instead
+        volume.update({'backup_type': 'chunked', 'reserve_bytes': 0,
+                       'previous_snapshot_key': chain[-1]['s3_key'] if chain and chain[-1]['type'] == 'chunked' else None})
+        return volume
+    if BACKUP_MODE != 'incremental':
+        return volume
+    
+    pending = _pending_manifests.get(volume_name)
+    reason = None
+    if not chain:
+        reason = "no previous full backup"
+    elif pending is None or not os.path.exists(get_manifest_path(volume_name)):
+        reason = "no manifest to compare with"
+    elif FULL_BACKUP_EVERY_RUNS > 0 and len(chain) >= FULL_BACKUP_EVERY_RUNS:
+        reason = f"{len(chain)} backups since last full"
+    elif FULL_BACKUP_EVERY_DAYS > 0:
+        last_full = datetime.fromisoformat(previous_entry.get('last_full') or chain[0]['timestamp'])
+        if (datetime.now() - last_full).days >= FULL_BACKUP_EVERY_DAYS:
+            reason = f"last full backup on {last_full:%Y-%m-%d}"
+    if reason:
+        logging.info("Volume [%s] - full backup (%s)", volume_name, reason)
+        return volume
+    
+    files, diff = pending
+    changed = diff['added'] + diff['modified']
+    volume.update({'backup_type': 'incremental', 'paths': changed, 'deleted': diff['deleted'],
+                   'reserve_bytes': sum(files[path][1] for path in changed)})
+    logging.info("Volume [%s] - incremental backup (%d changed, %d deleted files)",
+                 volume_name, len(changed), len(diff['deleted']))
+    return volume
+
+# Function to build the state entry of a successfully backed up volume
+def record_volume_backup(volume, result, previous_entry):
+    """Return the new state entry, extending or restarting the backup chain"""
+    now = datetime.now().isoformat()
+    chain = list((previous_entry or {}).get('chain') or []) if volume['backup_type'] == 'incremental' else []
+    chain.append({'s3_key': result['s3_key'], 'type': volume['backup_type'], 'timestamp': now,
+                  'checksum': result.get('checksum')})
+    last_full = now if volume['backup_type'] != 'incremental' else (previous_entry or {}).get('last_full')
+    return {**(volume['info'] or {}), 'last_backup': now, 'chain': chain, 'last_full': last_full}
+
+# ioctl that makes a file share the extents of another one (XFS, btrfs)
+FICLONE = 0x40049409
+# Every snapshot, clone and mount this tool creates is named `<prefix><volume>-<timestamp>-<pid>`,
+# so leftovers of a run that is gone can be told from the snapshots of a running one and of anyone else
+SNAPSHOT_PREFIX = "docker-backup-snapshot-"
+SNAPSHOT_NAME_PATTERN = re.compile(re.escape(SNAPSHOT_PREFIX) + r'(?P<volume>.+)-\d{8}_\d{6}-(?P<pid>\d+)')
+
+# Function to find the mount a path lives on
+def find_mount(path):
+    """Return (mount point, filesystem type, mount source) of the filesystem holding `path`"""
+    path = os.path.realpath(path)
+    best = ('/', '', '')
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            separator = fields.index('-')
+            # Spaces and other special characters in mount points are octal escaped
+            mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[4])
+            if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best[0]):
+                best = (mount_point, fields[separator + 1], fields[separator + 2])
+    return best
+
+# Function to get the folder snapshots of a volume go to
+def get_snapshot_base(volume_path):
+    """
+    SNAPSHOT_DIR, or a .backup-snapshots folder next to the ROOT_DIR entry
+    holding the volume: on the same filesystem, but not scanned as a volume
+    """
+    if SNAPSHOT_DIR:
+        return SNAPSHOT_DIR
+    volume_path = os.path.normpath(volume_path)
+    root_dir = os.path.dirname(volume_path)
+    for directory in DOCKER_VOLUME_DIRECTORIES:
+        directory = os.path.normpath(directory)
+        if volume_path.startswith(directory + os.sep):
+            root_dir = directory
+            break
+    return os.path.join(os.path.dirname(root_dir), ".backup-snapshots")
+
+# Function to run a snapshot tool
+def run_snapshot_command(args):
+    """Run btrfs, zfs, lvm or mount, raising with their error output if they fail"""
+    completed = subprocess.run(args, capture_output=True, text=True, timeout=300)
+    if completed.returncode != 0:
+        raise OSError(f"{' '.join(args)} failed: {completed.stderr.strip() or completed.returncode}")
+    return completed.stdout
+
+# Function to pick how a volume is frozen
+def get_snapshot_method(volume_path):
+    """Return the snapshot method for a volume: SNAPSHOT_MODE, or for `auto` the one its filesystem supports (None if none)"""
+    if SNAPSHOT_MODE != 'auto':
+        return SNAPSHOT_MODE
+    mount_point, fs_type, source = find_mount(volume_path)
+    if fs_type == 'btrfs' and shutil.which('btrfs'):
+        return 'btrfs'
+    if fs_type == 'zfs' and shutil.which('zfs'):
+        return 'zfs'
+    if source.startswith('/dev/mapper/') and shutil.which('lvcreate'):
+        return 'lvm'
+    if fs_type == 'xfs':
+        return 'reflink'
+    return None
+
+# Function to pause the containers that use a volume
+def pause_volume_users(volume, cleanup):
+    """
+    Pause the running containers that mount the volume. Unpausing is added
+    to `cleanup` and also happens on its own after SNAPSHOT_PAUSE_TIMEOUT,
+    so a slow read never freezes a service for long. Returns the unpause function
+    """
+    volume_path = os.path.normpath(volume['path'])
+    paused = []
+    for container in docker_client.list_containers():
+        if container.get('State') != 'running':
+            continue
+        for mount in container.get('Mounts', []):
+            source = os.path.normpath(mount.get('Source') or '/')
+            if mount.get('Name') == volume['name'] or source == volume_path or source.startswith(volume_path + '/'):
+                docker_client.pause(container['Id'])
+                paused.append(container)
+                break
+    lock = threading.Lock()
+    
+    def unpause(timed_out=False):
+        with lock:
+            if timed_out and paused:
+                logging.warning("Volume [%s] still being read after %ds, unpausing its containers",
+                                volume['name'], SNAPSHOT_PAUSE_TIMEOUT)
+            while paused:
+                container = paused.pop()
+                try:
+                    docker_client.unpause(container['Id'])
+                except (DockerAPIError, OSError) as e:
+                    logging.error("Cannot unpause container [%s]: %s", container['Names'][0].lstrip('/'), str(e))
+    
+    timer = threading.Timer(SNAPSHOT_PAUSE_TIMEOUT, unpause, kwargs={'timed_out': True})
+    timer.daemon = True
+    timer.start()
+    cleanup.append(timer.cancel)
+    cleanup.append(unpause)
+    if paused:
+        logging.info("Paused %d container(s) using volume [%s]: %s", len(paused), volume['name'],
+                     ", ".join(container['Names'][0].lstrip('/') for container in paused))
+    return unpause
+
+# Function to clone a file without copying its data
+def reflink_file(source, target, file_stat):
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    os.chown(target, file_stat.st_uid, file_stat.st_gid)
+    os.chmod(target, stat.S_IMODE(file_stat.st_mode))
+    os.utime(target, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+# Function to clone a volume with reflinks
+def reflink_tree(source_dir, target_dir, paths=None):
+    """
+    Copy `source_dir` to `target_dir` sharing the file extents, so only
+    metadata is written. With `paths` only those files are cloned. Ownership,
+    modes and mtimes are kept, since the archive records them
+    """
+    folders = []
+    
+    def make_folder(rel_dir):
+        target = os.path.join(target_dir, rel_dir)
+        if os.path.isdir(target):
+            return
+        if rel_dir:
+            make_folder(os.path.dirname(rel_dir))
+        folder_stat = os.stat(os.path.join(source_dir, rel_dir))
+        os.mkdir(target)
+        os.chown(target, folder_stat.st_uid, folder_stat.st_gid)
+        os.chmod(target, stat.S_IMODE(folder_stat.st_mode))
+        folders.append((target, folder_stat))
+    
+    def clone(rel_path):
+        source = os.path.join(source_dir, rel_path)
+        target = os.path.join(target_dir, rel_path)
+        file_stat = os.lstat(source)
+        if stat.S_ISLNK(file_stat.st_mode):
+            os.symlink(os.readlink(source), target)
+            os.lchown(target, file_stat.st_uid, file_stat.st_gid)
+            os.utime(target, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns), follow_symlinks=False)
+        elif stat.S_ISREG(file_stat.st_mode):
+            reflink_file(source, target, file_stat)
+    
+    make_folder('')
+    if paths is None:
+        for root, dirs, files in os.walk(source_dir):
+            rel_root = os.path.relpath(root, source_dir)
+            rel_root = '' if rel_root == '.' else rel_root
+            for name in dirs:
+                if os.path.islink(os.path.join(root, name)):
+                    clone(os.path.join(rel_root, name))
+                else:
+                    make_folder(os.path.join(rel_root, name))
+            for name in files:
+                clone(os.path.join(rel_root, name))
+    else:
+        for rel_path in paths:
+            make_folder(os.path.dirname(rel_path))
+            try:
+                clone(rel_path)
+            except FileNotFoundError:
+                pass
+    # Folder mtimes last, adding their entries changed them
+    for target, folder_stat in reversed(folders):
+        os.utime(target, ns=(folder_stat.st_atime_ns, folder_stat.st_mtime_ns))
+
+# Function to freeze a volume with the configured snapshot method
+def take_volume_snapshot(volume, method, cleanup):
+    """
+    Create a frozen view of the volume and return the path to read it from.
+    Every step that needs undoing is appended to `cleanup`, so a failure
+    half-way can be rolled back
+    """
+    volume_path = os.path.realpath(volume['path'])
+    name = f"{SNAPSHOT_PREFIX}{volume['name']}-{datetime.now().strftime('%Y%m%d_%H%M%S')}-{os.getpid()}"
+    
+    if method == 'pause':
+        pause_volume_users(volume, cleanup)
+        return volume['path']
+    
+    if method == 'zfs':
+        mount_point, _, dataset = find_mount(volume_path)
+        run_snapshot_command(['zfs', 'snapshot', f"{dataset}@{name}"])
+        cleanup.append(lambda: run_snapshot_command(['zfs', 'destroy', f"{dataset}@{name}"]))
+        return os.path.join(mount_point, '.zfs', 'snapshot', name, os.path.relpath(volume_path, mount_point))
+    
+    base = get_snapshot_base(volume['path'])
+    os.makedirs(base, exist_ok=True)
+    target = os.path.join(base, name)
+    
+    if method == 'btrfs':
+        # Only subvolumes can be snapshotted, their root directory is always inode 256
+        subvolume = volume_path
+        while os.stat(subvolume).st_ino != 256 and subvolume != '/':
+            subvolume = os.path.dirname(subvolume)
+        run_snapshot_command(['btrfs', 'subvolume', 'snapshot', '-r', subvolume, target])
+        cleanup.append(lambda: run_snapshot_command(['btrfs', 'subvolume', 'delete', target]))
+        return os.path.join(target, os.path.relpath(volume_path, subvolume))
+    
+    if method == 'lvm':
+        mount_point, fs_type, device = find_mount(volume_path)
+        vg_name, lv_name = run_snapshot_command(['lvs', '--noheadings', '-o', 'vg_name,lv_name', device]).split()
+        size_option = '-l' if '%' in SNAPSHOT_LVM_SIZE else '-L'
+        run_snapshot_command(['lvcreate', '-s', '-n', name, size_option, SNAPSHOT_LVM_SIZE, f"{vg_name}/{lv_name}"])
+        cleanup.append(lambda: run_snapshot_command(['lvremove', '-f', f"{vg_name}/{name}"]))
+        os.mkdir(target)
+        cleanup.append(lambda: os.rmdir(target))
+        # XFS refuses to mount a second filesystem with the same UUID
+        options = 'ro,nouuid' if fs_type == 'xfs' else 'ro'
+        run_snapshot_command(['mount', '-o', options, f"/dev/{vg_name}/{name}", target])
+        cleanup.append(lambda: run_snapshot_command(['umount', target]))
+        return os.path.join(target, os.path.relpath(volume_path, mount_point))
+    
+    if method == 'reflink':
+        # Files are cloned one by one, the containers are paused so they all come from the same moment
+        unpause = pause_volume_users(volume, cleanup)
+        os.mkdir(target)
+        cleanup.append(lambda: shutil.rmtree(target, ignore_errors=True))
+        started = time.monotonic()
+        reflink_tree(volume_path, os.path.join(target, volume['name']), volume.get('paths'))
+        unpause()
+        logging.debug("Volume [%s] cloned in %.2fs", volume['name'], time.monotonic() - started)
+        return os.path.join(target, volume['name'])
+    
+    raise ValueError(f"Unknown SNAPSHOT_MODE [{method}]")
+
+# Function to undo the steps of a volume snapshot
+def release_volume_snapshot(volume, cleanup):
+    while cleanup:
+        step = cleanup.pop()
+        try:
+            step()
+        except Exception as e:
+            logging.error("Cannot clean up the snapshot of volume [%s]: %s", volume['name'], str(e))
+
+# Context manager reading a volume from a frozen view
+@contextlib.contextmanager
+def frozen_volume(volume):
+    """
+    Yield (path, method): where to read a planned volume backup from and the
+    snapshot method used. With SNAPSHOT_MODE set the path is a btrfs, ZFS or
+    LVM snapshot, a reflink copy or, in pause mode, the volume itself while
+    the containers using it are paused. If no snapshot can be taken the live
+    volume is read, as without SNAPSHOT_MODE, and the method is None
+    """
+    if SNAPSHOT_MODE == 'off':
+        yield volume['path'], None
+        return
+    cleanup = []
+    try:
+        method = get_snapshot_method(volume['path'])
+        read_path = volume['path']
+        if method:
+            try:
+                read_path = take_volume_snapshot(volume, method, cleanup)
+                logging.info("Reading volume [%s] from a %s snapshot", volume['name'], method)
+            except (OSError, subprocess.SubprocessError, DockerAPIError, ValueError) as e:
+                logging.warning("Cannot snapshot volume [%s] with %s, reading it live: %s", volume['name'], method, str(e))
+                release_volume_snapshot(volume, cleanup)
+                method = None
+                read_path = volume['path']
+        else:
+            logging.warning("No snapshot method for volume [%s], reading it live", volume['name'])
+        yield read_path, method
+    finally:
+        release_volume_snapshot(volume, cleanup)
+
+# Function to tell whether a snapshot was left behind by a run that is gone
+def is_stale_snapshot(name):
+    """True if `name` is a snapshot name of this tool whose process is no longer running"""
+    match = SNAPSHOT_NAME_PATTERN.fullmatch(name)
+    if not match:
+        return False
+    pid = int(match['pid'])
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+# Function to get the ZFS datasets the volumes live on
+def get_volume_datasets():
+    """Return the ZFS datasets holding the ROOT_DIR entries and the volumes in them"""
+    datasets = set()
+    for root_dir in DOCKER_VOLUME_DIRECTORIES:
+        try:
+            paths = [root_dir] + [entry.path for entry in os.scandir(root_dir) if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            continue
+        for path in paths:
+            _, fs_type, dataset = find_mount(path)
+            if fs_type == 'zfs':
+                datasets.add(dataset)
+    return datasets
+
+# Function to remove snapshots left behind by an interrupted run
+def remove_stale_snapshots():
+    """
+    Delete btrfs snapshots, reflink copies and ZFS snapshots of the volume
+    datasets that a killed run did not clean up. Only names this tool gives
+    (see SNAPSHOT_NAME_PATTERN) whose process is gone are touched. Leftover
+    LVM snapshots stay mounted and are only reported, they need `umount` and
+    `lvremove` by hand
+    """
+    bases = {get_snapshot_base(os.path.join(root_dir, 'volume')) for root_dir in DOCKER_VOLUME_DIRECTORIES}
+    for base in bases:
+        try:
+            entries = [entry for entry in os.scandir(base) if is_stale_snapshot(entry.name)]
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if os.path.ismount(entry.path):
+                    logging.warning("Leftover snapshot still mounted at [%s], unmount and remove it by hand", entry.path)
+                elif entry.is_dir(follow_symlinks=False) and entry.inode() == 256 and shutil.which('btrfs'):
+                    run_snapshot_command(['btrfs', 'subvolume', 'delete', entry.path])
+                else:
+                    shutil.rmtree(entry.path)
+                logging.info("Removed leftover snapshot [%s]", entry.path)
+            except OSError as e:
+                logging.error("Cannot remove leftover snapshot [%s]: %s", entry.path, str(e))
+    datasets = get_volume_datasets() if shutil.which('zfs') else set()
+    snapshot_names = set()
+    for dataset in datasets:
+        try:
+            # -r also lists the child datasets, volumes may be datasets of their own
+            snapshot_names.update(run_snapshot_command(['zfs', 'list', '-H', '-r', '-t', 'snapshot', '-o', 'name',
+                                                        dataset]).split('\n'))
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error("Cannot list the ZFS snapshots of [%s]: %s", dataset, str(e))
+    for snapshot_name in sorted(snapshot_names):
+        if not snapshot_name or not is_stale_snapshot(snapshot_name.split('@', 1)[-1]):
+            continue
+        try:
+            run_snapshot_command(['zfs', 'destroy', snapshot_name])
+            logging.info("Removed leftover snapshot [%s]", snapshot_name)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error("Cannot remove leftover snapshot [%s]: %s", snapshot_name, str(e))
+
+# Function to compress a planned volume backup, runs in a compression worker
+def compress_volume(volume, output_filename):
+    """MakeTar of the volume read from its frozen view, see frozen_volume"""
+    with frozen_volume(volume) as (read_path, _):
+        return MakeTar(read_path, output_filename, volume.get('paths'), volume.get('deleted'),
+                       os.path.basename(volume['path']))
+
+# Byte budget shared by the compression workers
+class TempSpaceBudget:
+    """
+    Caps the number of bytes that in-flight archives may occupy in TMP_DIR.
+    A limit of 0 disables the cap. A single reservation larger than the limit
+    is still admitted once nothing else is in flight, so big volumes can't deadlock.
+    """
+
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        if self.limit <= 0:
+            return
+        with self._condition:
+            while self.in_use > 0 and self.in_use + size > self.limit:
+                self._condition.wait()
+            self.in_use += size
+
+    def release(self, size):
+        if self.limit <= 0:
+            return
+        with self._condition:
+            self.in_use -= size
+            self._condition.notify_all()
+
+# Function to count the files that go into a volume backup
+def count_volume_files(volume):
+    """Files archived by a planned volume backup: the changed files of an incremental, else all of them"""
+    if volume.get('paths') is not None:
+        return len(volume['paths'])
+    return (volume.get('info') or {}).get('file_count', 0)
+
+# Function to build the S3 key of a volume archive
+def make_archive_key(volume, suffix=ARCHIVE_SUFFIX):
+    """Return `<prefix><volume>-<timestamp>[-inc]<suffix>` for a planned volume backup"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    kind = "-inc" if volume.get('backup_type') == 'incremental' else ""
+    return f"{S3_PREFIX}{volume['name']}-{timestamp}{kind}{suffix}"
+
+# Function to build the S3 key of one segment of a segmented archive
+def get_segment_key(index_key, number, codec=None):
+    """Return `<archive>.partNNNNN<suffix>` for segment `number` of the archive indexed at `index_key`"""
+    return f"{index_key[:-len(SEGMENTS_SUFFIX)]}.part{number:05d}{ARCHIVE_SUFFIXES[codec or COMPRESSION]}"
+
+# Function to abort an unfinished upload and drop its checkpoint
+def abort_checkpointed_upload(s3_key, checkpoint):
+    """Abort the multipart upload of `checkpoint` and remove it from the checkpoint file"""
+    s3_client = get_s3_client()
+    if s3_client:
+        try:
+            s3_client.abort_multipart_upload(Bucket=S3_BUCKET, Key=s3_key, UploadId=checkpoint['upload_id'])
+        except ClientError as e:
+            logging.debug("Cannot abort upload [%s]: %s", s3_key, str(e))
+    save_upload_checkpoint(s3_key, None)
+
+# Function to find an interrupted upload of a volume that can be resumed
+def find_resumable_upload(volume):
+    """
+    Return (archive path, S3 key) of an unfinished upload left by a previous
+    run for this exact volume content, or None. Checkpoints of the volume
+    whose archive no longer matches are aborted and dropped
+    """
+    volume_info = volume.get('info') or {}
+    for s3_key, checkpoint in load_upload_checkpoints().items():
+        if checkpoint.get('volume') != volume['name']:
+            continue
+        archive_path = checkpoint['archive_path']
+        try:
+            stat_info = os.stat(archive_path)
+            archive_matches = (stat_info.st_size, stat_info.st_mtime_ns) == \
+                (checkpoint['archive_size'], checkpoint['archive_mtime_ns'])
+        except OSError:
+            archive_matches = False
+        if archive_matches and checkpoint.get('content_hash') == volume_info.get('content_hash') \
+                and checkpoint.get('backup_type') == volume['backup_type']:
+            logging.info("Found interrupted upload of [%s] at %.1f MB: [%s]",
+                         volume['name'], checkpoint.get('offset', 0) / (1024 * 1024), s3_key)
+            return archive_path, s3_key
+        
+        # The volume changed since, or the archive is gone: this upload will never complete
+        logging.info("Dropping stale upload of [%s]: [%s]", volume['name'], s3_key)
+        abort_checkpointed_upload(s3_key, checkpoint)
+        for path in (archive_path, archive_path + ARCHIVE_INDEX_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+    return None
+
+# Function to upload a compressed volume and clean it up
+def upload_volume_archive(volume, archive_path, s3_key=None):
+    """
+    Upload a compressed volume archive to S3 and delete it afterwards.
+    An archive whose upload can be resumed is kept for the next run.
+    Returns the per-volume result dict used by the backup summary
+    """
+    volume_name = volume['name']
+    file_size_mb = get_file_size_mb(archive_path)
+    result = {'success': False, 'size_mb': file_size_mb, 'url': None, 's3_key': None, 'mb_per_s': 0,
+              'reason': 'S3 upload failed or not configured'}
+    
+    # Send ALL files to S3, no Telegram file uploads
+    if S3_ENABLED and S3_BUCKET:
+        s3_key = s3_key or make_archive_key(volume)
+        checkpoint_info = {'volume': volume_name, 'backup_type': volume['backup_type'],
+                           'content_hash': (volume.get('info') or {}).get('content_hash')}
+        # MakeTar left the checksum of the archive in its index, also for archives resumed from an earlier run
+        index_data = None
+        checksum = None
+        if os.path.exists(archive_path + ARCHIVE_INDEX_SUFFIX):
+            with open(archive_path + ARCHIVE_INDEX_SUFFIX, 'rb') as index_file:
+                index_data = index_file.read()
+            checksum = decode_archive_index(index_data).get('sha256')
+        metadata = {CHECKSUM_METADATA_KEY: checksum} if checksum else None
+        
+        with run_metrics.measure('upload', volume_name) as metrics:
+            success, upload_result, stats = upload_to_s3(archive_path, s3_key, checkpoint_info, metadata)
+            metrics.update(bytes_in=os.path.getsize(archive_path), bytes_out=stats['bytes'] if stats else 0,
+                           files=1, success=success)
+        if success:
+            result.update({'success': True, 'url': upload_result, 's3_key': s3_key,
+                           'mb_per_s': stats['mb_per_s'], 'reason': None, 'checksum': checksum})
+            logging.info("Document uploaded to S3: [%s] (%.1f MB)", volume_name, file_size_mb)
+            if index_data is not None:
+                upload_archive_index(get_s3_client(), s3_key, index_data)
+        else:
+            logging.error("S3 upload failed: %s", upload_result)
+            if s3_key in load_upload_checkpoints():
+                logging.warning("Keeping [%s] to resume its upload on the next run", archive_path)
+                return result
+    else:
+        logging.warning("S3 not configured - file [%s] cannot be uploaded", volume_name)
+    
+    # Delete archive
+    try:
+        os.remove(archive_path)
+        logging.debug("File: [" + archive_path + "] was deleted successfully")
+        if os.path.exists(archive_path + ARCHIVE_INDEX_SUFFIX):
+            os.remove(archive_path + ARCHIVE_INDEX_SUFFIX)
+    except Exception as retEx:
+        logging.error("Error while deleting: [" + str(retEx) + "]")
+    return result
+
+# Function to log what storing incompressible files saved on a volume
+def log_skipped_compression(volume_name, stats):
+    if stats.get('stored_bytes'):
+        logging.info("Volume [%s]: %d incompressible file(s), %.1f MB stored without compression, ~%.1fs CPU saved",
+                     volume_name, stats['stored_files'], stats['stored_bytes'] / (1024 * 1024), stats['cpu_saved'])
+
+# Function to stream a volume straight into S3
+def stream_volume(volume):
+    """Compress and upload a volume in one pass, returns the per-volume result dict"""
+    logging.info("Streaming changed volume to S3: [%s]", volume['name'])
+    s3_key = make_archive_key(volume)
+    
+    with run_metrics.measure('stream', volume['name']) as metrics, frozen_volume(volume) as (read_path, _):
+        success, upload_result, stats = stream_tar_to_s3(read_path, s3_key, volume.get('paths'), volume.get('deleted'),
+                                                         os.path.basename(volume['path']))
+        metrics.update(success=success, files=count_volume_files(volume))
+        if success:
+            metrics.update(bytes_in=stats['tar_bytes'], bytes_out=stats['bytes'], cpu_saved=stats['cpu_saved'])
+            log_skipped_compression(volume['name'], stats)
+    if success:
+        return {'success': True, 'size_mb': stats['bytes'] / (1024 * 1024), 'url': upload_result,
+                's3_key': s3_key, 'mb_per_s': stats['mb_per_s'], 'reason': None, 'checksum': stats['checksum']}
+    return {'success': False, 'size_mb': 0, 'url': None, 's3_key': None, 'mb_per_s': 0,
+            'reason': 'Streaming upload failed'}
+
+# Function to back up a volume as a segmented archive
+def backup_volume_segmented(volume):
+    """
+    Cut the tar stream of a volume into LARGE_FILE_THRESHOLD MB segments
+    (see SegmentPlanner), each compressed on its own into TMP_DIR and
+    uploaded by upload_to_s3, so a failed upload is retried and resumed for
+    that segment alone. SEGMENT_WORKERS segments are written and uploaded at
+    once while the walk lays out the next ones. The segment index goes up
+    last: without it the backup is not listed, and a failed backup deletes
+    the segments it uploaded. Returns the per-volume result dict used by the
+    backup summary
+    """
+    volume_name = volume['name']
+    started = time.monotonic()
+    s3_client = get_s3_client()
+    if not s3_client:
+        return {'success': False, 'size_mb': 0, 'url': None, 's3_key': None, 'mb_per_s': 0,
+                'reason': 'S3 client initialization failed'}
+    run_metrics.begin('segmented', volume_name)
+    
+    index_key = make_archive_key(volume, SEGMENTS_SUFFIX)
+    # One data key for the segments and index of the volume, each with its own header and nonces
+    data_key = new_data_key()
+    stats = {'stored_files': 0, 'stored_bytes': 0, 'sample_seconds': 0.0}
+    stats_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(SEGMENT_WORKERS)
+    futures = []
+    errors = []
+    members = []
+    
+    def write_and_upload(segment):
+        s3_key = get_segment_key(index_key, segment['number'])
+        segment_path = os.path.join(TMP_DIR, s3_key.rsplit('/', 1)[-1])
+        try:
+            segment_stats = {}
+            with open(segment_path, 'wb') as segment_file:
+                hashing_output = HashingWriter(segment_file)
+                write_tar_segment(segment['pieces'], hashing_output, stats=segment_stats, data_key=data_key)
+            checksum = hashing_output.hash.hexdigest()
+            size = os.path.getsize(segment_path)
+            success, upload_result, _ = upload_to_s3(segment_path, s3_key, metadata={CHECKSUM_METADATA_KEY: checksum})
+            if not success:
+                raise IOError(f"segment {segment['number']}: {upload_result}")
+            with stats_lock:
+                for field in stats:
+                    stats[field] += segment_stats[field]
+            return {'tar_offset': segment['tar_offset'], 'tar_size': segment['tar_size'], 'size': size,
+                    'sha256': checksum}
+        except Exception as e:
+            errors.append(e)
+            # Segment keys are new on every run, so a failed segment upload can never be resumed
+            checkpoint = load_upload_checkpoints().get(s3_key)
+            if checkpoint:
+                abort_checkpointed_upload(s3_key, checkpoint)
+            raise
+        finally:
+            if os.path.exists(segment_path):
+                os.remove(segment_path)
+            slots.release()
+    
+    # Called by the walk, waits while SEGMENT_WORKERS segments are in progress and stops it once one failed
+    def submit(segment):
+        slots.acquire()
+        if errors:
+            slots.release()
+            raise errors[0]
+        futures.append(segment_pool.submit(write_and_upload, segment))
+    
+    def record_member(tarinfo):
+        members.append((tarinfo.name, planner.offset))
+        return tarinfo
+    
+    try:
+        with ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix="segment") as segment_pool:
+            with frozen_volume(volume) as (read_path, _):
+                try:
+                    planner = SegmentPlanner(LARGE_FILE_THRESHOLD * 1024 * 1024, submit, record_member)
+                    add_volume_members(planner, read_path, os.path.basename(volume['path']), volume.get('paths'),
+                                       volume.get('deleted'))
+                    planner.close()
+                finally:
+                    # Segments read their files from the frozen view
+                    wait(futures)
+        segments = [future.result() for future in futures]
+        
+        index = {'codec': COMPRESSION, 'tar_size': planner.offset, 'members': members,
+                 'segment_size': planner.segment_size, 'segments': segments, 'encrypted': bool(data_key)}
+        index_body = encode_archive_index(index, data_key)
+        checksum = hashlib.sha256(index_body).hexdigest()
+        s3_client.put_object(Bucket=S3_BUCKET, Key=index_key, Body=index_body, Metadata={CHECKSUM_METADATA_KEY: checksum})
+    except Exception as e:
+        error_msg = f"Segmented backup failed: {str(e)}"
+        logging.error(error_msg)
+        run_metrics.record('segmented', volume_name, time.monotonic() - started, success=False)
+        uploaded = [get_segment_key(index_key, number) for number, future in enumerate(futures)
+                    if future.done() and not future.cancelled() and future.exception() is None]
+        if uploaded:
+            logging.info("Deleting %d uploaded segment(s) of [%s]", len(uploaded), index_key)
+            delete_s3_objects(s3_client, uploaded)
+        return {'success': False, 'size_mb': 0, 'url': None, 's3_key': None, 'mb_per_s': 0, 'reason': error_msg}
+    
+    stored_bytes = sum(segment['size'] for segment in segments) + len(index_body)
+    transfer = transfer_stats(stored_bytes, time.monotonic() - started)
+    stats['cpu_saved'] = estimate_cpu_saved(COMPRESSION, COMPRESSION_LEVEL, stats['stored_bytes'], stats['sample_seconds'])
+    logging.info("Segmented archive [%s]: %d segment(s), %.1f MB of tar stream stored as %.1f MB in %.1fs",
+                 index_key, len(segments), planner.offset / (1024 * 1024), stored_bytes / (1024 * 1024),
+                 transfer['seconds'])
+    log_skipped_compression(volume_name, stats)
+    run_metrics.record('segmented', volume_name, transfer['seconds'], bytes_in=planner.offset, bytes_out=stored_bytes,
+                       files=count_volume_files(volume), cpu_saved=stats['cpu_saved'])
+    return {'success': True, 'size_mb': stored_bytes / (1024 * 1024), 'url': get_download_url(s3_client, index_key),
+            's3_key': index_key, 'mb_per_s': transfer['mb_per_s'], 'reason': None, 'checksum': checksum}
+
+# Function to compress and upload volumes concurrently
+def run_backup_pipeline(volumes, on_result=None):
+    """
+    Compress volumes in a process pool (CPU bound) and upload them from a
+    thread pool (I/O bound) at the same time. Archives waiting in TMP_DIR are
+    limited by MAX_INFLIGHT_TMP_MB, reserved up front by the volume size.
+    `on_result(volume, result)` is called from the worker threads as soon as
+    a volume is done. Returns one result dict per volume, in the same order
+    as `volumes`
+    """
+    results = [None] * len(volumes)
+    if not volumes:
+        return results
+    
+    def report(volume, result):
+        if on_result:
+            try:
+                on_result(volume, result)
+            except Exception as e:
+                logging.error("Cannot record the backup of [%s]: %s", volume['name'], str(e))
+        return result
+    
+    # Chunked, segmented and streaming modes compress in this process, so it takes the compression worker priority
+    if (BACKUP_FORMAT != 'tar' or STREAM_UPLOAD) and S3_ENABLED and S3_BUCKET:
+        lower_process_priority()
+    
+    # Chunked mode: chunking, dedup and upload all happen in the upload threads
+    if BACKUP_FORMAT == 'chunked' and S3_ENABLED and S3_BUCKET:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_pool:
+            futures = [upload_pool.submit(lambda volume: report(volume, backup_volume_chunked(
+                volume, volume.get('previous_snapshot_key'))), volume) for volume in volumes]
+            return [future.result() for future in futures]
+    
+    # Segmented mode: each volume's segments are written and uploaded by a pool of its own
+    if BACKUP_FORMAT == 'segmented' and S3_ENABLED and S3_BUCKET:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_pool:
+            futures = [upload_pool.submit(lambda volume: report(volume, backup_volume_segmented(volume)), volume)
+                       for volume in volumes]
+            return [future.result() for future in futures]
+    
+    # Streaming mode: no archive touches the disk, compression happens in the upload threads
+    if STREAM_UPLOAD and S3_ENABLED and S3_BUCKET:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_pool:
+            futures = [upload_pool.submit(lambda volume: report(volume, stream_volume(volume)), volume)
+                       for volume in volumes]
+            return [future.result() for future in futures]
+    
+    budget = TempSpaceBudget(MAX_INFLIGHT_TMP_MB * 1024 * 1024)
+    remaining = [len(volumes)]
+    remaining_lock = threading.Lock()
+    all_done = threading.Event()
+    
+    def finish(index, result, reserved):
+        results[index] = report(volumes[index], result)
+        budget.release(reserved)
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                all_done.set()
+    
+    # Forked workers share the rate limiter state with this process
+    with ProcessPoolExecutor(max_workers=COMPRESS_WORKERS, mp_context=multiprocessing.get_context('fork'),
+                             initializer=lower_process_priority) as compress_pool, \
+            ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_pool:
+        
+        def upload_and_finish(index, archive_path, reserved, s3_key=None):
+            result = {'success': False, 'size_mb': 0, 'url': None, 's3_key': None, 'mb_per_s': 0,
+                      'reason': 'Upload error'}
+            try:
+                result = upload_volume_archive(volumes[index], archive_path, s3_key)
+            except Exception as e:
+                logging.error("Upload worker failed for [%s]: %s", volumes[index]['name'], str(e))
+            finally:
+                finish(index, result, reserved)
+        
+        # Runs as soon as an archive is ready, hands it straight to the upload pool
+        def on_compressed(index, archive_path, reserved, future):
+            try:
+                compressed = future.result()
+            except Exception as e:
+                logging.error("Compression worker failed for [%s]: %s", volumes[index]['name'], str(e))
+                compressed = None
+            # Compression ran in a worker process, its timing comes back with the result
+            run_metrics.record('compress', volumes[index]['name'], compressed['seconds'] if compressed else 0,
+                               bytes_in=compressed['bytes_in'] if compressed else 0,
+                               bytes_out=get_file_size_mb(archive_path) * 1024 * 1024 if compressed else 0,
+                               files=count_volume_files(volumes[index]), success=bool(compressed),
+                               cpu_saved=compressed['cpu_saved'] if compressed else 0)
+            if compressed:
+                logging.info("Successfully compressed: [" + archive_path + "]")
+                log_skipped_compression(volumes[index]['name'], compressed)
+                upload_pool.submit(upload_and_finish, index, archive_path, reserved)
+                return
+            logging.error("Cannot compress: [" + archive_path + "]")
+            for path in (archive_path, archive_path + ARCHIVE_INDEX_SUFFIX):
+                if os.path.exists(path):
+                    os.remove(path)
+            finish(index, {'success': False, 'size_mb': 0, 'url': None, 's3_key': None, 'mb_per_s': 0,
+                           'reason': 'Compression failed'}, reserved)
+        
+        for index, volume in enumerate(volumes):
+            # An archive whose upload was interrupted by a previous run only needs the rest uploaded
+            resumable = find_resumable_upload(volume) if S3_ENABLED and S3_BUCKET else None
+            if resumable:
+                upload_pool.submit(upload_and_finish, index, resumable[0], 0, resumable[1])
+                continue
+            
+            archiveName = volume['name'] + "-" + datetime.now().strftime("%Y%m%d_%H%M%S") + ARCHIVE_SUFFIX
+            outputPath = os.path.join(TMP_DIR, archiveName)
+            reserved = volume.get('reserve_bytes', 0)
+            budget.acquire(reserved)
+            
+            run_metrics.begin('compress', volume['name'])
+            future = compress_pool.submit(compress_volume, volume, outputPath)
+            future.add_done_callback(
+                lambda f, i=index, p=outputPath, r=reserved: on_compressed(i, p, r, f))
+        
+        all_done.wait()
+    
+    return results
 
-# Function to get file size in MB
-def get_file_size_mb(file_path):
-    """Get file size in MB"""
+
+# Function to map calls over a pool in order, with bounded look-ahead
+def map_ordered(executor, function, items, window):
+    """Like executor.map, but with at most `window` results in flight or waiting to be consumed"""
+    pending = collections.deque()
     try:
-        return os.path.getsize(file_path) / (1024 * 1024)
-    except OSError:
-        return 0
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
 
-# Function to compress a folder
-def MakeTar(source_dir, output_filename):
-    logging.debug("Compressing: [%s] to: [%s]", source_dir, output_filename)
+# Readable stream over an S3 object, downloaded in parallel
+class S3RangeReader:
+    """
+    Read-only stream over bytes [start, end) of an S3 object, downloaded as
+    ranged GETs of RESTORE_PART_SIZE_MB on `workers` (RESTORE_WORKERS)
+    threads. Parts are returned in order and at most `workers` * 2 are held
+    in memory
+    """
+
+    def __init__(self, s3_client, s3_key, start, end, workers=None):
+        self.s3_client = s3_client
+        self.s3_key = s3_key
+        workers = workers or RESTORE_WORKERS
+        part_size = RESTORE_PART_SIZE_MB * 1024 * 1024
+        ranges = [(offset, min(offset + part_size, end)) for offset in range(start, end, part_size)]
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="restore")
+        self._parts = map_ordered(self._executor, self._fetch, ranges, workers * 2)
+        self._buffer = b''
+        self._position = 0
+
+    def _fetch(self, byte_range):
+        start, end = byte_range
+        # botocore retries the request, not a body that breaks off half-way
+        for attempt in range(3):
+            try:
+                response = self.s3_client.get_object(Bucket=S3_BUCKET, Key=self.s3_key, Range=f"bytes={start}-{end - 1}")
+                data = response['Body'].read()
+                if len(data) != end - start:
+                    raise IOError(f"got {len(data)} of {end - start} bytes")
+                return data
+            except (BotoCoreError, OSError) as e:
+                if attempt == 2:
+                    raise
+                logging.warning("Ranged GET of [%s] at %d failed, retrying: %s", self.s3_key, start, str(e))
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._position == len(self._buffer):
+                self._buffer = next(self._parts, b'')
+                self._position = 0
+                if not self._buffer:
+                    break
+            available = len(self._buffer) - self._position
+            count = available if size < 0 else min(size, available)
+            chunks.append(self._buffer[self._position:self._position + count])
+            self._position += count
+            if size > 0:
+                size -= count
+        return b''.join(chunks)
+
+    def close(self):
+        self._parts.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# Readable tar stream over the segments of a segmented archive
+class SegmentReader:
+    """
+    Read-only stream of the tar data in segments `first` to `last` (all by
+    default) of the segmented archive indexed at `index_key`. RESTORE_WORKERS
+    segments are downloaded and decompressed at the same time, each at most
+    RESTORE_PART_SIZE_MB ahead of the reader. A segment read to its end must
+    match the size and SHA-256 in the index. `bytes_read` counts the
+    compressed bytes downloaded
+    """
+
+    def __init__(self, s3_client, index_key, index, first=0, last=None):
+        self.s3_client = s3_client
+        last = len(index['segments']) - 1 if last is None else last
+        self.bytes_read = 0
+        self._segments = collections.deque((get_segment_key(index_key, number, index['codec']), index['segments'][number])
+                                           for number in range(first, last + 1))
+        self._queues = collections.deque()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=RESTORE_WORKERS, thread_name_prefix="restore")
+        self._buffer = b''
+        self._position = 0
+        for _ in range(RESTORE_WORKERS):
+            self._start_next()
+
+    def _start_next(self):
+        if self._segments:
+            s3_key, segment = self._segments.popleft()
+            chunks = queue.Queue(maxsize=RESTORE_PART_SIZE_MB)
+            self._queues.append(chunks)
+            self._executor.submit(self._decompress, s3_key, segment, chunks)
+
+    def _put(self, chunks, item):
+        # Gives up once the reader is closed, nobody takes the item any more
+        while not self._closed.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self, s3_key, segment, chunks):
+        # One GET at a time per segment, the parallelism is across segments
+        reader = HashingReader(S3RangeReader(self.s3_client, s3_key, 0, segment['size'], workers=1))
+        try:
+            stream = open_decompressor(reader, s3_key)
+            tar_bytes = 0
+            while True:
+                data = stream.read(1024 * 1024)
+                if not data:
+                    break
+                tar_bytes += len(data)
+                if not self._put(chunks, data):
+                    return
+            while reader.read(1024 * 1024):
+                pass
+            with self._lock:
+                self.bytes_read += reader.bytes_read
+            if tar_bytes != segment['tar_size']:
+                raise IOError(f"[{s3_key}] holds {tar_bytes} of {segment['tar_size']} bytes")
+            if reader.hash.hexdigest() != segment['sha256']:
+                raise IOError(f"checksum mismatch in [{s3_key}]")
+            self._put(chunks, b'')
+        except Exception as e:
+            self._put(chunks, e)
+        finally:
+            reader.close()
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._position == len(self._buffer):
+                if not self._queues:
+                    break
+                item = self._queues[0].get()
+                if isinstance(item, Exception):
+                    raise item
+                if not item:
+                    # Segment done, start downloading the next one
+                    self._queues.popleft()
+                    self._start_next()
+                    continue
+                self._buffer = item
+                self._position = 0
+            available = len(self._buffer) - self._position
+            count = available if size < 0 else min(size, available)
+            chunks.append(self._buffer[self._position:self._position + count])
+            self._position += count
+            if size > 0:
+                size -= count
+        return b''.join(chunks)
+
+    def close(self):
+        self._closed.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# Window over a decompressed stream
+class StreamSlice:
+    """Readable window of `length` bytes that starts `skip` bytes into `fileobj`. Closing closes `source`"""
+
+    def __init__(self, fileobj, skip, length, source):
+        self.fileobj = fileobj
+        self.skip = skip
+        self.remaining = length
+        self.source = source
+
+    def read(self, size=-1):
+        while self.skip > 0:
+            data = self.fileobj.read(min(self.skip, 1024 * 1024))
+            if not data:
+                return b''
+            self.skip -= len(data)
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.source.close()
+
+# Function to open a decompressing reader for an archive
+def open_decompressor(fileobj, archive_name):
+    """
+    Return a readable stream of the tar data (or SQL of a dump), picking the
+    codec from the suffix. Encrypted streams are decrypted on the way
+    """
+    fileobj = open_decrypted(fileobj)
+    if archive_name.endswith('.gz'):
+        # GzipFile also reads the multi-member output of pgzip
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if archive_name.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError("zstandard package is required to read .zst backups")
+        # Stored stretches of an archive are separate frames
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    return fileobj
+
+# S3 keys of tar archives and segment indexes (see make_archive_key), segments (see get_segment_key)
+# and chunked snapshots, relative to their folder
+ARCHIVE_KEY_PATTERN = re.compile(r'(?P<volume>.+)-(?P<timestamp>\d{8}_\d{6})(?P<incremental>-inc)?'
+                                 r'(?:\.tar(?:\.gz|\.zst)?|(?P<segmented>\.segments\.json\.gz))')
+SEGMENT_KEY_PATTERN = re.compile(r'(?P<archive>.+-\d{8}_\d{6}(?:-inc)?)\.part\d{5,}\.tar(?:\.gz|\.zst)?')
+SNAPSHOT_KEY_PATTERN = re.compile(r'(?P<volume>.+)-(?P<timestamp>\d{8}_\d{6})\.json\.gz')
+
+# Function to list the backups stored in the bucket
+def list_snapshots(s3_client, volume_name=None):
+    """
+    List the backups in the bucket as a dict of volume name -> list of
+    {'s3_key', 'type', 'timestamp', 'size', 'indexed', 'segmented'}, oldest
+    first. A segmented archive is listed by its segment index, with the
+    `segment_keys` of its segments, and its size includes them. Needs no
+    local state, so it works on a fresh host
+    """
+    snapshots = collections.defaultdict(list)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for folder, pattern in (("", ARCHIVE_KEY_PATTERN), ("snapshots/", SNAPSHOT_KEY_PATTERN)):
+        prefix = S3_PREFIX + folder
+        # The delimiter keeps chunks/ and databases/ out of the listing
+        objects = {}
+        for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix + (volume_name or ""), Delimiter='/'):
+            for item in page.get('Contents', []):
+                objects[item['Key'][len(prefix):]] = item['Size']
+        segments = collections.defaultdict(list)
+        for name, size in objects.items():
+            match = SEGMENT_KEY_PATTERN.fullmatch(name)
+            if match:
+                segments[match['archive']].append((prefix + name, size))
+        for name, size in objects.items():
+            match = pattern.fullmatch(name)
+            if not match or (volume_name and match['volume'] != volume_name):
+                continue
+            backup_type = 'chunked' if folder else 'incremental' if match['incremental'] else 'full'
+            entry = {'s3_key': prefix + name, 'type': backup_type, 'timestamp': match['timestamp'], 'size': size,
+                     'indexed': name + ARCHIVE_INDEX_SUFFIX in objects, 'segmented': bool(not folder and match['segmented'])}
+            if entry['segmented']:
+                parts = sorted(segments.get(name[:-len(SEGMENTS_SUFFIX)], []))
+                entry['segment_keys'] = [s3_key for s3_key, _ in parts]
+                entry['size'] += sum(part_size for _, part_size in parts)
+            snapshots[match['volume']].append(entry)
+    for entries in snapshots.values():
+        entries.sort(key=lambda entry: entry['timestamp'])
+    return dict(snapshots)
+
+# Function to pick the backups needed to restore a snapshot
+def get_restore_chain(snapshots, timestamp=None):
+    """
+    Return the backups to replay, in order, to restore the snapshot taken at
+    `timestamp` (the latest by default): the last full archive or chunked
+    snapshot up to it and every incremental archive since. Empty if there is
+    no such snapshot or its full backup is gone
+    """
+    if timestamp:
+        snapshots = [entry for entry in snapshots if entry['timestamp'] <= timestamp]
+        if not snapshots or snapshots[-1]['timestamp'] != timestamp:
+            return []
+    chain = []
+    for entry in reversed(snapshots):
+        chain.insert(0, entry)
+        if entry['type'] != 'incremental':
+            return chain
+    return []
+
+# Function to build the filter of a selective restore
+def make_path_filter(paths):
+    """
+    Return a predicate that matches volume-relative paths equal to or below
+    one of `paths`, or None to restore everything
+    """
+    if not paths:
+        return None
+    prefixes = [os.path.normpath(path).strip('/') for path in paths]
+    
+    def wanted(rel_path):
+        return any(rel_path == prefix or rel_path.startswith(prefix + '/') for prefix in prefixes)
+    return wanted
+
+# Function to get the volume-relative path of an archive member
+def member_path(member_name):
+    """Archives store `<volume>/<path>`, return `<path>` ('' for the volume folder itself)"""
+    return member_name.partition('/')[2]
+
+# Function to find the parts of the tar stream a selective restore needs
+def get_member_ranges(index, wanted):
+    """
+    Return [start, end) tar offsets covering the `wanted` members of an
+    archive index and its incremental marker, runs of consecutive members
+    merged into one range
+    """
+    members = index['members']
+    ranges = []
+    for position, (name, offset) in enumerate(members):
+        if name != INCREMENTAL_MARKER and not wanted(member_path(name)):
+            continue
+        end = members[position + 1][1] if position + 1 < len(members) else index['tar_size']
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1][1] = end
+        else:
+            ranges.append([offset, end])
+    return ranges
+
+# Function to load the index of an archive
+def load_archive_index(s3_client, s3_key):
+    """
+    Return the index uploaded with an archive: its `codec`, the uncompressed
+    `tar_size`, `members` as [name, tar offset] pairs in archive order, the
+    `sha256` of the archive and, for pgzip, `blocks`: the compressed offset
+    of every `block_size` block of the tar stream plus the archive size.
+    None if the archive has no index
+    """
     try:
-        with tarfile.open(output_filename, "w:gz") as tar:
-            tar.add(source_dir, arcname=os.path.basename(source_dir))
-        return True
-    except:
+        body = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key + ARCHIVE_INDEX_SUFFIX)['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return decode_archive_index(body)
+
+# Function to read part of an object as it was written, before encryption
+def open_stored_range(s3_client, s3_key, start, end, plain_size=None):
+    """
+    Return a readable stream of bytes [start, end) of the data written to an
+    object. If it was encrypted, `plain_size` is the size of that data and
+    only the chunks holding the range are downloaded and decrypted
+    """
+    if plain_size is None:
+        return S3RangeReader(s3_client, s3_key, start, end)
+    header = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key,
+                                  Range=f"bytes=0-{ENCRYPTION_HEADER.size - 1}")['Body'].read()
+    chunk_size = open_encryption_header(header)[1]
+    record_size = chunk_size + ENCRYPTION_TAG_SIZE
+    first_chunk = start // chunk_size
+    last_chunk = max(plain_size - 1, 0) // chunk_size
+    object_size = ENCRYPTION_HEADER.size + plain_size + (last_chunk + 1) * ENCRYPTION_TAG_SIZE
+    reader = S3RangeReader(s3_client, s3_key, ENCRYPTION_HEADER.size + first_chunk * record_size,
+                           min(ENCRYPTION_HEADER.size + ((end - 1) // chunk_size + 1) * record_size, object_size))
+    return StreamSlice(DecryptingReader(reader, header, first_chunk, last_chunk), start - first_chunk * chunk_size,
+                       end - start, reader)
+
+# Function to read part of the tar stream of an archive
+def open_archive_range(s3_client, s3_key, index, start, end):
+    """Return a readable stream of tar bytes [start, end), downloading only the blocks that hold them"""
+    # The blocks are offsets in the stream before encryption
+    plain_size = None
+    if index.get('encrypted'):
+        plain_size = index['tar_size'] if index['codec'] == 'none' else index['blocks'][-1]
+    if index['codec'] == 'none':
+        return open_stored_range(s3_client, s3_key, start, end, plain_size)
+    block_size = index['block_size']
+    first_block = start // block_size
+    last_block = (end - 1) // block_size
+    # Every block is a complete gzip member, so decompression can start at any of them
+    reader = open_stored_range(s3_client, s3_key, index['blocks'][first_block], index['blocks'][last_block + 1],
+                               plain_size)
+    return StreamSlice(gzip.GzipFile(fileobj=reader, mode='rb'), start - first_block * block_size, end - start, reader)
+
+# Function to extract one archive stream
+def extract_archive_stream(fileobj, target_dir, wanted=None):
+    """
+    Extract a tar stream into `target_dir` and apply the deletions recorded in
+    an incremental archive. With `wanted` (see make_path_filter) only the
+    matching members and deletions are applied. Returns the number of
+    extracted members
+    """
+    marker = None
+    extracted = 0
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        # Keep permissions but refuse members that would escape target_dir
+        tar.extraction_filter = getattr(tarfile, 'tar_filter', None)
+        for member in tar:
+            if member.name == INCREMENTAL_MARKER:
+                marker = json.load(tar.extractfile(member))
+                continue
+            if wanted and not wanted(member_path(member.name)):
+                continue
+            tar.extract(member, target_dir)
+            extracted += 1
+    
+    if marker:
+        for rel_path in marker['deleted']:
+            if wanted and not wanted(rel_path):
+                continue
+            deleted_path = os.path.join(target_dir, marker['root'], rel_path)
+            if os.path.lexists(deleted_path) and not os.path.isdir(deleted_path):
+                os.remove(deleted_path)
+        logging.debug("Applied %d deletions from incremental archive", len(marker['deleted']))
+    return extracted
+
+# Function to restore one tar archive
+def restore_archive(s3_client, entry, target_dir, wanted=None):
+    """
+    Extract a tar archive listed by list_snapshots. A selective restore of
+    an indexed, seekable archive downloads and decompresses only the blocks
+    of the wanted members, anything else streams the whole archive.
+    Returns the number of extracted members
+    """
+    s3_key = entry['s3_key']
+    index = load_archive_index(s3_client, s3_key) if wanted and entry.get('indexed') else None
+    if index is None or index['codec'] not in SEEKABLE_CODECS:
+        reader = S3RangeReader(s3_client, s3_key, 0, entry['size'])
+        try:
+            return extract_archive_stream(open_decompressor(reader, s3_key), target_dir, wanted)
+        finally:
+            reader.close()
+    
+    # Runs of consecutive wanted members are read as one range, the marker holds the deletions
+    ranges = get_member_ranges(index, wanted)
+    extracted = 0
+    for start, end in ranges:
+        reader = open_archive_range(s3_client, s3_key, index, start, end)
+        try:
+            extracted += extract_archive_stream(reader, target_dir, wanted)
+        finally:
+            reader.close()
+    logging.info("Read %.1f of %.1f MB of [%s] through its index", sum(end - start for start, end in ranges) / (1024 * 1024),
+                 index['tar_size'] / (1024 * 1024), s3_key)
+    return extracted
+
+# Function to restore a segmented archive
+def restore_segmented_archive(s3_client, entry, target_dir, wanted=None):
+    """
+    Extract a segmented archive listed by list_snapshots, its segments
+    downloaded and decompressed in parallel by SegmentReader. A selective
+    restore reads only the segments holding the wanted members. Returns the
+    number of extracted members
+    """
+    s3_key = entry['s3_key']
+    index = decode_archive_index(s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)['Body'].read())
+    offsets = [segment['tar_offset'] for segment in index['segments']]
+    # Ranges that share a segment are read in one pass, extraction skips the members between them
+    spans = []
+    for start, end in (get_member_ranges(index, wanted) if wanted else [[0, index['tar_size']]]):
+        first = bisect.bisect_right(offsets, start) - 1
+        last = bisect.bisect_right(offsets, end - 1) - 1
+        if spans and first <= spans[-1][3]:
+            spans[-1][1] = end
+            spans[-1][3] = last
+        else:
+            spans.append([start, end, first, last])
+    
+    extracted = 0
+    for start, end, first, last in spans:
+        reader = SegmentReader(s3_client, s3_key, index, first, last)
+        try:
+            extracted += extract_archive_stream(StreamSlice(reader, start - offsets[first], end - start, reader),
+                                                target_dir, wanted)
+        finally:
+            reader.close()
+    if wanted:
+        logging.info("Read %d of %d segments of [%s] through its index",
+                     sum(last - first + 1 for _, _, first, last in spans), len(offsets), s3_key)
+    return extracted
+
+# Function to restore a chunked snapshot
+def restore_chunked_snapshot(s3_client, snapshot_key, target_dir, wanted=None):
+    """
+    Rebuild a volume, or its `wanted` paths, from a snapshot manifest and its
+    chunks. Chunks are downloaded on RESTORE_WORKERS threads. Returns the
+    number of restored files
+    """
+    snapshot = load_snapshot(s3_client, snapshot_key)
+    if wanted:
+        for kind in ('dirs', 'files', 'symlinks'):
+            snapshot[kind] = [entry for entry in snapshot[kind] if wanted(entry['path'])]
+    root = os.path.realpath(os.path.join(target_dir, snapshot['root']))
+    
+    def resolve(rel_path):
+        path = os.path.realpath(os.path.join(root, rel_path))
+        if path != root and not path.startswith(root + os.sep):
+            raise ValueError(f"Snapshot path escapes the target folder: {rel_path}")
+        return path
+    
+    def fetch_chunk(chunk_hash):
+        return zlib.decompress(s3_client.get_object(Bucket=S3_BUCKET, Key=get_chunk_key(chunk_hash))['Body'].read())
+    
+    os.makedirs(root, exist_ok=True)
+    for entry in snapshot['dirs']:
+        os.makedirs(resolve(entry['path']), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=RESTORE_WORKERS, thread_name_prefix="restore") as chunk_pool:
+        # One ordered stream of chunks across all files, so small files download in parallel too
+        chunks = map_ordered(chunk_pool, fetch_chunk,
+                             (chunk_hash for entry in snapshot['files'] for chunk_hash in entry['chunks']),
+                             RESTORE_WORKERS * 4)
+        for entry in snapshot['files']:
+            file_path = resolve(entry['path'])
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as f:
+                for _ in entry['chunks']:
+                    f.write(next(chunks))
+            os.chmod(file_path, entry['mode'])
+            os.utime(file_path, (entry['mtime'], entry['mtime']))
+    for entry in snapshot['symlinks']:
+        link_path = resolve(os.path.dirname(entry['path']))
+        link_path = os.path.join(link_path, os.path.basename(entry['path']))
+        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(entry['target'], link_path)
+    # Folder times last, writing files into them changes their mtime
+    for entry in reversed(snapshot['dirs']):
+        dir_path = resolve(entry['path'])
+        os.chmod(dir_path, entry['mode'])
+        os.utime(dir_path, (entry['mtime'], entry['mtime']))
+    return len(snapshot['files'])
+
+# Function to print the backups stored in the bucket
+def print_snapshots(volume_name=None):
+    """Print the snapshots of one or all volumes, restorable with `restore --snapshot`"""
+    s3_client = get_s3_client()
+    if not s3_client:
+        print("S3 client initialization failed")
+        return False
+    snapshots = list_snapshots(s3_client, volume_name)
+    if not snapshots:
+        print(f"No backups found for volume [{volume_name}]" if volume_name else "No backups found")
         return False
+    for name in sorted(snapshots):
+        print(name)
+        for entry in snapshots[name]:
+            indexed = "  indexed" if entry['indexed'] else ""
+            if entry['segmented']:
+                indexed = f"  {len(entry['segment_keys'])} segments"
+            print(f"  {entry['timestamp']}  {entry['type']:<11} {entry['size'] / (1024 * 1024):>10.1f} MB{indexed}")
+    return True
 
-# Function to detect database volumes and containers
-def detect_database_volumes():
+# Function to restore a volume
+def restore_volume(volume_name, target_dir, snapshot=None, paths=None):
     """
-    Detect database containers and their volumes by scanning Docker volumes
+    Restore a volume into `target_dir` as of `snapshot` (a timestamp shown by
+    print_snapshots, the latest by default) by replaying its full backup and
+    every incremental archive taken after it, in order, or by rebuilding a
+    chunked snapshot. The chain is read from the bucket. With `paths` only
+    those files and folders are restored
     """
-    db_info = []
+    s3_client = get_s3_client()
+    if not s3_client:
+        print("S3 client initialization failed")
+        return False
+    
+    chain = get_restore_chain(list_snapshots(s3_client, volume_name).get(volume_name, []), snapshot)
+    if not chain:
+        logging.error("No backup chain found for volume [%s]", volume_name)
+        print(f"No backups found for volume [{volume_name}]" + (f" at {snapshot}" if snapshot else ""))
+        return False
     
+    wanted = make_path_filter(paths)
+    os.makedirs(target_dir, exist_ok=True)
+    for entry in chain:
+        try:
+            logging.info("Restoring [%s] %s backup from [%s]", volume_name, entry['type'], entry['s3_key'])
+            if entry['type'] == 'chunked':
+                extracted = restore_chunked_snapshot(s3_client, entry['s3_key'], target_dir, wanted)
+            elif entry['segmented']:
+                extracted = restore_segmented_archive(s3_client, entry, target_dir, wanted)
+            else:
+                extracted = restore_archive(s3_client, entry, target_dir, wanted)
+            print(f"Restored {entry['type']} backup {entry['s3_key']} ({extracted} entries)")
+        except Exception as e:
+            logging.error("Restore of [%s] failed: %s", entry['s3_key'], str(e))
+            print(f"Restore of {entry['s3_key']} failed: {e}")
+            return False
+    
+    logging.info("Volume [%s] restored to [%s]", volume_name, target_dir)
+    return True
+
+# Function to decrypt a downloaded backup
+def decrypt_file(input_path, output_path=None):
+    """
+    Decrypt an archive, segment, index or dump downloaded from the bucket
+    (e.g. through its link) into `output_path`, stdout by default. The
+    output is what the suffix says, e.g. `decrypt x.tar.gz | tar xz`
+    """
+    if not encryption_keys:
+        print("Set ENCRYPTION_KEY (or ENCRYPTION_OLD_KEYS) to decrypt backups", file=sys.stderr)
+        return False
+    output = None
     try:
-        # Get all Docker containers
-        result = subprocess.run(['docker', 'ps', '-a', '--format', '{{.Names}}\t{{.Image}}\t{{.Status}}'], 
-                              capture_output=True, text=True, timeout=30)
-        
-        if result.returncode != 0:
-            logging.error("Failed to get Docker containers")
-            return db_info
-            
-        containers = result.stdout.strip().split('\n')
-        
-        for container_line in containers:
-            if not container_line.strip():
+        with open(input_path, 'rb') as source:
+            if read_exact(source, len(ENCRYPTION_MAGIC)) != ENCRYPTION_MAGIC:
+                print(f"{input_path} is not encrypted", file=sys.stderr)
+                return False
+            source.seek(0)
+            reader = DecryptingReader(source)
+            output = open(output_path, 'wb') if output_path else sys.stdout.buffer
+            shutil.copyfileobj(reader, output, ENCRYPTION_CHUNK_SIZE)
+            output.flush()
+    except (OSError, RuntimeError) as e:
+        logging.error("Cannot decrypt [%s]: %s", input_path, str(e))
+        print(f"Cannot decrypt {input_path}: {e}", file=sys.stderr)
+        return False
+    finally:
+        if output_path and output:
+            output.close()
+    return True
+
+# S3 keys of database dumps (see dump_database), relative to the databases/ folder
+DUMP_KEY_PATTERN = re.compile(r'(?P<volume>.+)_(?P<db_type>[a-z]+)_(?P<timestamp>\d{8}_\d{6})\.sql(?:\.gz|\.zst)?')
+RETENTION_RULES = ('last', 'daily', 'weekly', 'monthly', 'max_age')
+DEFAULT_RETENTION_POLICY = {'last': RETENTION_KEEP_LAST, 'daily': RETENTION_KEEP_DAILY, 'weekly': RETENTION_KEEP_WEEKLY,
+                            'monthly': RETENTION_KEEP_MONTHLY, 'max_age': RETENTION_MAX_AGE_DAYS}
+# Keys per DeleteObjects request, the S3 API limit
+S3_DELETE_BATCH = 1000
+
+# Function to list the database dumps stored in the bucket
+def list_database_dumps(s3_client, container_name=None):
+    """List the dumps in the bucket like list_snapshots, keyed by container name, with type 'dump'"""
+    dumps = collections.defaultdict(list)
+    prefix = f"{S3_PREFIX}databases/"
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix + (container_name or "")):
+        for item in page.get('Contents', []):
+            match = DUMP_KEY_PATTERN.fullmatch(item['Key'][len(prefix):])
+            if not match or (container_name and match['volume'] != container_name):
                 continue
-                
-            parts = container_line.split('\t')
-            if len(parts) >= 3:
-                container_name = parts[0]
-                image = parts[1].lower()
-                status = parts[2]
-                
-                # Check if container image suggests it's a database
-                is_db = any(db_type in image for db_type in ['mysql', 'mariadb', 'postgres', 'mongo', 'redis'])
-                
-                if is_db and 'up' in status.lower():
-                    # Get volume mounts for this container
-                    volume_result = subprocess.run(['docker', 'inspect', '--format', 
-                                                  '{{range .Mounts}}{{.Source}}:{{.Destination}}\n{{end}}', 
-                                                  container_name], 
-                                                 capture_output=True, text=True, timeout=10)
-                    
-                    if volume_result.returncode == 0:
-                        volumes = []
-                        for mount_line in volume_result.stdout.strip().split('\n'):
-                            if ':' in mount_line and mount_line.strip():
-                                source, dest = mount_line.split(':', 1)
-                                volumes.append({'source': source, 'destination': dest})
-                        
-                        db_info.append({
-                            'container': container_name,
-                            'image': image,
-                            'volumes': volumes
-                        })
-                        logging.info("Found database container: [%s] with image [%s]", container_name, image)
-        
-    except Exception as e:
-        logging.error("Error detecting database volumes: %s", str(e))
+            dumps[match['volume']].append({'s3_key': item['Key'], 'type': 'dump', 'timestamp': match['timestamp'],
+                                           'size': item['Size'], 'indexed': False})
+    for entries in dumps.values():
+        entries.sort(key=lambda entry: entry['timestamp'])
+    return dict(dumps)
+
+# Function to parse the per-volume retention policies
+def parse_retention_policies(value):
+    """
+    Parse RETENTION_POLICIES into volume -> policy. A volume's policy
+    replaces the default one, rules it doesn't list are off. Invalid entries
+    are logged and skipped
+    """
+    policies = {}
+    for item in value.split(';'):
+        if not item.strip():
+            continue
+        volume_name, _, rules = item.partition('=')
+        policy = dict.fromkeys(RETENTION_RULES, 0)
+        try:
+            for rule in rules.split(','):
+                name, _, count = rule.strip().partition(':')
+                if name not in RETENTION_RULES:
+                    raise ValueError(f"unknown rule '{name}'")
+                policy[name] = int(count)
+        except ValueError as e:
+            logging.error("Invalid retention policy [%s]: %s", item.strip(), str(e))
+            continue
+        policies[volume_name.strip()] = policy
+    return policies
+
+# Function to decide which snapshots of a volume to keep
+def apply_retention(snapshots, policy, now=None):
+    """
+    Split the snapshots of one volume (oldest first, as from list_snapshots)
+    into (keep, delete) lists. The `last` newest snapshots are kept, plus
+    the newest one of each of the `daily`, `weekly` and `monthly` most recent
+    days, ISO weeks and months that have one. Without any of these rules all
+    snapshots are kept. Snapshots older than `max_age` days are deleted
+    whatever the other rules say. The newest snapshot is always kept, and so
+    is every backup a kept incremental archive needs, back to its full backup
+    """
+    if not snapshots:
+        return [], []
+    now = now or datetime.now()
+    newest_first = list(reversed(snapshots))
+    taken = {entry['s3_key']: datetime.strptime(entry['timestamp'], "%Y%m%d_%H%M%S") for entry in snapshots}
     
-    return db_info
+    if any(policy[rule] for rule in ('last', 'daily', 'weekly', 'monthly')):
+        keep = {entry['s3_key'] for entry in newest_first[:policy['last']]}
+        for rule, period in (('daily', '%Y-%m-%d'), ('weekly', '%G-W%V'), ('monthly', '%Y-%m')):
+            periods = set()
+            for entry in newest_first:
+                if len(periods) >= policy[rule]:
+                    break
+                entry_period = taken[entry['s3_key']].strftime(period)
+                if entry_period not in periods:
+                    periods.add(entry_period)
+                    keep.add(entry['s3_key'])
+    else:
+        keep = set(taken)
+    if policy['max_age']:
+        cutoff = now - timedelta(days=policy['max_age'])
+        keep = {s3_key for s3_key in keep if taken[s3_key] >= cutoff}
+    keep.add(newest_first[0]['s3_key'])
+    
+    # An incremental restores on top of every backup before it, back to the last full one
+    needed = False
+    for entry in newest_first:
+        if needed:
+            keep.add(entry['s3_key'])
+        if entry['s3_key'] in keep:
+            needed = entry['type'] == 'incremental'
+    return ([entry for entry in snapshots if entry['s3_key'] in keep],
+            [entry for entry in snapshots if entry['s3_key'] not in keep])
 
-# Function to dump database
-def dump_database(container_name, output_dir):
+# Function to delete many objects
+def delete_s3_objects(s3_client, s3_keys):
+    """Delete keys with DeleteObjects requests of up to 1000 keys, returns the keys that could not be deleted"""
+    failed = []
+    for start in range(0, len(s3_keys), S3_DELETE_BATCH):
+        batch = s3_keys[start:start + S3_DELETE_BATCH]
+        try:
+            response = s3_client.delete_objects(Bucket=S3_BUCKET, Delete={
+                'Objects': [{'Key': s3_key} for s3_key in batch], 'Quiet': True})
+        except (ClientError, BotoCoreError) as e:
+            logging.error("Cannot delete %d objects: %s", len(batch), str(e))
+            failed.extend(batch)
+            continue
+        for error in response.get('Errors', []):
+            logging.error("Cannot delete [%s]: %s", error.get('Key'), error.get('Message'))
+            failed.append(error.get('Key'))
+    return failed
+
+# Function to find chunks no snapshot refers to
+def find_unreferenced_chunks(s3_client, deleted_snapshot_keys):
     """
-    Dump database from Docker container.
-    Supports MySQL/MariaDB and PostgreSQL containers.
+    Return the keys of chunks that only the deleted chunked snapshots used,
+    or that no snapshot ever finished with. Chunks younger than
+    CHUNK_GC_GRACE_HOURS are left alone
     """
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    referenced = set()
+    for snapshots in list_snapshots(s3_client).values():
+        for entry in snapshots:
+            if entry['type'] == 'chunked' and entry['s3_key'] not in deleted_snapshot_keys:
+                # A snapshot that can't be read aborts the collection instead of losing its chunks
+                for file_entry in load_snapshot(s3_client, entry['s3_key'])['files']:
+                    referenced.update(file_entry['chunks'])
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=CHUNK_GC_GRACE_HOURS)
+    unreferenced = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{S3_PREFIX}chunks/"):
+        for item in page.get('Contents', []):
+            if item['Key'].rsplit('/', 1)[-1] not in referenced and item['LastModified'] < cutoff:
+                unreferenced.append(item['Key'])
+    return unreferenced
+
+# Function to check whether any retention rule is set
+def retention_configured():
+    return any(DEFAULT_RETENTION_POLICY.values()) or bool(parse_retention_policies(RETENTION_POLICIES))
+
+# Function to apply the retention policies to the bucket
+def prune_backups(s3_client, dry_run=False, volume_name=None, collect_chunks=True):
+    """
+    Apply the retention policy of every volume and database container (or
+    only `volume_name`) to the backups in the bucket. Archive indexes go with
+    their archive, segments with their segment index, and chunks only
+    deleted snapshots used are collected, unless `collect_chunks` is False.
+    With `dry_run` nothing is deleted. Returns a report dict: `volumes` as
+    (name, keep, delete) tuples, `deleted` objects, `deleted_bytes`,
+    `chunks` collected and `failed` keys
+    """
+    policies = parse_retention_policies(RETENTION_POLICIES)
+    backups = list(list_snapshots(s3_client, volume_name).items()) + \
+        list(list_database_dumps(s3_client, volume_name).items())
+    report = {'volumes': [], 'deleted': 0, 'deleted_bytes': 0, 'chunks': 0, 'failed': []}
+    delete_keys = []
+    for name, snapshots in sorted(backups):
+        policy = policies.get(name, DEFAULT_RETENTION_POLICY)
+        if not any(policy.values()):
+            continue
+        keep, delete = apply_retention(snapshots, policy)
+        report['volumes'].append((name, keep, delete))
+        for entry in delete:
+            # Segments before their index, so a backup that is only partly deleted stays listed for the next prune
+            delete_keys.extend(entry.get('segment_keys', []))
+            delete_keys.append(entry['s3_key'])
+            if entry['indexed']:
+                delete_keys.append(entry['s3_key'] + ARCHIVE_INDEX_SUFFIX)
+            report['deleted_bytes'] += entry['size']
+    
+    deleted_snapshots = {entry['s3_key'] for _, _, delete in report['volumes'] for entry in delete
+                         if entry['type'] == 'chunked'}
+    chunk_keys = find_unreferenced_chunks(s3_client, deleted_snapshots) if deleted_snapshots and collect_chunks else []
+    report['chunks'] = len(chunk_keys)
+    report['deleted'] = len(delete_keys)
+    if dry_run:
+        return report
+    
+    report['failed'] = delete_s3_objects(s3_client, delete_keys)
+    failed = set(report['failed'])
+    mark_snapshots_deleted([s3_key for s3_key in delete_keys if s3_key not in failed])
+    if chunk_keys and not failed:
+        # Forget them locally first, a chunk missing from the index is only uploaded again
+        forget_chunks([chunk_key.rsplit('/', 1)[-1] for chunk_key in chunk_keys])
+        report['failed'] += delete_s3_objects(s3_client, chunk_keys)
+    logging.info("Retention: deleted %d objects (%.1f MB) and %d chunks, %d failed", len(delete_keys) - len(failed),
+                 report['deleted_bytes'] / (1024 * 1024), len(chunk_keys), len(report['failed']))
+    return report
+
+# Function to print what retention deletes
+def print_prune_report(report, dry_run):
+    """Print the outcome of prune_backups, listing every deleted backup"""
+    action = "would delete" if dry_run else "deleted"
+    for name, keep, delete in report['volumes']:
+        print(f"{name}: keep {len(keep)}, {action} {len(delete)} "
+              f"({sum(entry['size'] for entry in delete) / (1024 * 1024):.1f} MB)")
+        for entry in delete:
+            print(f"  - {entry['timestamp']}  {entry['type']:<11} {entry['s3_key']}")
+    print(f"Total: {action} {report['deleted']} objects ({report['deleted_bytes'] / (1024 * 1024):.1f} MB)"
+          f" and {report['chunks']} unreferenced chunks")
+    if report['failed']:
+        print(f"{len(report['failed'])} objects could not be deleted, see the log")
+
+# Function to apply the retention policies from the command line
+def prune_volumes(volume_name=None, dry_run=False):
+    """Prune the bucket and print the report, returns False when nothing could be done or deletes failed"""
+    if not retention_configured():
+        print("No retention policy configured, set RETENTION_KEEP_* or RETENTION_POLICIES")
+        return False
+    s3_client = get_s3_client()
+    if not s3_client:
+        print("S3 client initialization failed")
+        return False
+    with chunk_store_lock(exclusive=True) as locked:
+        if not locked:
+            print("A backup is running, prune again once it has finished")
+            return False
+        report = prune_backups(s3_client, dry_run, volume_name)
+    print_prune_report(report, dry_run)
+    return not report['failed']
+
+# Guards the chunks already checked by a verify run
+_verify_lock = threading.Lock()
+
+# Function to check the chunks of a chunked snapshot
+def verify_chunks(s3_client, chunk_hashes):
+    """Download chunks on RESTORE_WORKERS threads and check them against their hash, returns (bad hashes, bytes read)"""
+    
+    def check_chunk(chunk_hash):
+        try:
+            body = s3_client.get_object(Bucket=S3_BUCKET, Key=get_chunk_key(chunk_hash))['Body'].read()
+            return hashlib.sha256(zlib.decompress(body)).hexdigest() == chunk_hash, len(body)
+        except (ClientError, BotoCoreError, OSError, zlib.error) as e:
+            logging.error("Chunk [%s] is missing or unreadable: %s", chunk_hash, str(e))
+            return False, 0
     
+    bad = []
+    read_bytes = 0
+    with ThreadPoolExecutor(max_workers=RESTORE_WORKERS) as chunk_pool:
+        for chunk_hash, (ok, size) in zip(chunk_hashes, chunk_pool.map(check_chunk, chunk_hashes)):
+            read_bytes += size
+            if not ok:
+                bad.append(chunk_hash)
+    return bad, read_bytes
+
+# Function to check one backup in the bucket
+def verify_backup(s3_client, entry, recorded_checksum=None, verified_chunks=None):
+    """
+    Read a backup listed by list_snapshots or list_database_dumps back in one
+    sequential pass of ranged GETs, nothing is written to disk. The SHA-256
+    of the stored bytes must match the one taken at upload (object metadata,
+    archive index or `recorded_checksum` from the catalog) and the data must
+    decompress to the end and, for archives, parse as a tar stream. Chunks of
+    a chunked snapshot are checked against their hashes, skipping those in
+    the shared `verified_chunks` set, segments of a segmented archive against
+    its index. Returns a result dict
+    """
+    s3_key = entry['s3_key']
+    result = {'s3_key': s3_key, 'type': entry['type'], 'ok': False, 'reason': None, 'checksum': None,
+              'bytes': 0, 'members': 0, 'seconds': 0}
+    started = time.monotonic()
     try:
-        # Check if container exists and is running
-        result = subprocess.run(['docker', 'inspect', '--format={{.State.Running}}', container_name], 
-                              capture_output=True, text=True, timeout=10)
-        if result.returncode != 0 or result.stdout.strip() != 'true':
-            logging.warning("Container [%s] is not running or doesn't exist", container_name)
-            return None
-        
-        # Detect database type by checking running processes
-        detect_cmd = ['docker', 'exec', container_name, 'ps', 'aux']
-        detect_result = subprocess.run(detect_cmd, capture_output=True, text=True, timeout=10)
+        head = s3_client.head_object(Bucket=S3_BUCKET, Key=s3_key)
+        expected = head.get('Metadata', {}).get(CHECKSUM_METADATA_KEY)
+        if not expected and entry.get('indexed'):
+            expected = (load_archive_index(s3_client, s3_key) or {}).get('sha256')
+        expected = expected or recorded_checksum
         
-        if detect_result.returncode == 0:
-            processes = detect_result.stdout.lower()
-            
-            if 'mysqld' in processes or 'mariadb' in processes:
-                # MySQL/MariaDB dump
-                dump_file = os.path.join(output_dir, f"{container_name}_mysql_{timestamp}.sql")
-                dump_cmd = ['docker', 'exec', container_name, 'mysqldump', '--all-databases', 
-                           '--single-transaction', '--routines', '--triggers']
-                
-            elif 'postgres' in processes:
-                # PostgreSQL dump
-                dump_file = os.path.join(output_dir, f"{container_name}_postgres_{timestamp}.sql")
-                dump_cmd = ['docker', 'exec', container_name, 'pg_dumpall', '-U', 'postgres']
-                
-            else:
-                logging.warning("Unknown database type in container [%s]", container_name)
-                return None
-            
-            # Execute dump command
-            logging.info("Dumping database from container [%s]", container_name)
-            with open(dump_file, 'w') as f:
-                result = subprocess.run(dump_cmd, stdout=f, stderr=subprocess.PIPE, 
-                                      text=True, timeout=300)
-            
-            if result.returncode == 0:
-                logging.info("Database dump successful: [%s]", dump_file)
-                return dump_file
+        # The listed size of a segmented archive includes its segments, they are read through its index
+        object_size = head['ContentLength'] if entry.get('segmented') else entry['size']
+        reader = HashingReader(S3RangeReader(s3_client, s3_key, 0, object_size))
+        try:
+            if entry.get('segmented'):
+                index = decode_archive_index(reader.read())
+                segments = SegmentReader(s3_client, s3_key, index)
+                try:
+                    with tarfile.open(fileobj=segments, mode='r|') as tar:
+                        result['members'] = sum(1 for _ in tar)
+                    # Every segment is checked against the index once read to its end
+                    while segments.read(1024 * 1024):
+                        pass
+                finally:
+                    segments.close()
+                    result['bytes'] += segments.bytes_read
+            elif entry['type'] == 'chunked':
+                snapshot = json.loads(gzip.decompress(reader.read()))
+                result['members'] = len(snapshot['files'])
+                chunk_hashes = list(dict.fromkeys(chunk_hash for file_entry in snapshot['files']
+                                                  for chunk_hash in file_entry['chunks']))
+                if verified_chunks is not None:
+                    # Chunks are shared between snapshots, each one is checked once per verify run
+                    with _verify_lock:
+                        chunk_hashes = [chunk_hash for chunk_hash in chunk_hashes if chunk_hash not in verified_chunks]
+                        verified_chunks.update(chunk_hashes)
+                bad_chunks, chunk_bytes = verify_chunks(s3_client, chunk_hashes)
+                result['bytes'] += chunk_bytes
+                if bad_chunks:
+                    result['reason'] = f"{len(bad_chunks)} of {len(chunk_hashes)} chunks missing or corrupt"
             else:
-                logging.error("Database dump failed for [%s]: %s", container_name, result.stderr)
-                if os.path.exists(dump_file):
-                    os.remove(dump_file)
-                return None
-                
-    except subprocess.TimeoutExpired:
-        logging.error("Database dump timed out for container [%s]", container_name)
-        return None
+                stream = open_decompressor(reader, s3_key)
+                if entry['type'] != 'dump':
+                    with tarfile.open(fileobj=stream, mode='r|') as tar:
+                        result['members'] = sum(1 for _ in tar)
+                # Whatever follows: tar padding and the compressed trailer with its CRC
+                while stream.read(1024 * 1024):
+                    pass
+            while reader.read(1024 * 1024):
+                pass
+        finally:
+            reader.close()
+            result['bytes'] += reader.bytes_read
+        result['checksum'] = reader.hash.hexdigest()
+        
+        if reader.bytes_read != object_size:
+            result['reason'] = f"read {reader.bytes_read} of {object_size} bytes"
+        elif entry.get('segmented') and result['bytes'] != entry['size']:
+            result['reason'] = f"segments hold {result['bytes']} of {entry['size']} bytes in the bucket"
+        elif expected and expected != result['checksum']:
+            result['reason'] = f"checksum mismatch, expected {expected[:12]}, got {result['checksum'][:12]}"
+        result['ok'] = result['reason'] is None
+        if result['ok'] and not expected:
+            result['reason'] = "no checksum recorded, structure only"
     except Exception as e:
-        logging.error("Error dumping database from [%s]: %s", container_name, str(e))
-        return None
+        # Any failure to read, decompress or parse means the backup cannot be restored
+        result['reason'] = f"{type(e).__name__}: {str(e)}"
+    result['seconds'] = time.monotonic() - started
+    (logging.info if result['ok'] else logging.error)(
+        "Verified [%s]: %s (%.1f MB, %d members, %.1fs)", s3_key, "OK" if result['ok'] else result['reason'],
+        result['bytes'] / (1024 * 1024), result['members'], result['seconds'])
+    return result
+
+# Function to check the backups in the bucket
+def verify_backups(s3_client, volume_name=None, all_snapshots=False):
+    """
+    Verify the backups needed to restore the latest snapshot of every volume
+    (its full backup and incrementals since) and the latest dump of every
+    database container, or every stored backup with `all_snapshots`.
+    VERIFY_WORKERS backups are read at the same time. Returns one result
+    dict per backup, with the volume name added
+    """
+    recorded = get_recorded_checksums()
+    selected = []
+    failed = []
+    for name, snapshots in sorted(list_snapshots(s3_client, volume_name).items()):
+        chain = snapshots if all_snapshots else get_restore_chain(snapshots)
+        if not chain:
+            failed.append({'volume': name, 's3_key': snapshots[-1]['s3_key'], 'type': snapshots[-1]['type'],
+                           'ok': False, 'reason': "full backup of the latest snapshot is missing",
+                           'checksum': None, 'bytes': 0, 'members': 0, 'seconds': 0})
+        selected.extend((name, entry) for entry in chain)
+    for name, dumps in sorted(list_database_dumps(s3_client, volume_name).items()):
+        selected.extend((name, entry) for entry in (dumps if all_snapshots else dumps[-1:]))
+    
+    verified_chunks = set()
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify") as verify_pool:
+        results = list(verify_pool.map(
+            lambda item: {'volume': item[0], **verify_backup(s3_client, item[1], recorded.get(item[1]['s3_key']),
+                                                             verified_chunks)}, selected))
+    return failed + results
 
+# Function to verify backups from the command line
+def verify_volumes(volume_name=None, all_snapshots=False):
+    """Verify the backups and print one line per backup, returns False if any of them failed"""
+    s3_client = get_s3_client()
+    if not s3_client:
+        print("S3 client initialization failed")
+        return False
+    results = verify_backups(s3_client, volume_name, all_snapshots)
+    if not results:
+        print(f"No backups found for volume [{volume_name}]" if volume_name else "No backups found")
+        return False
+    for result in results:
+        status = "OK  " if result['ok'] else "FAIL"
+        note = f"  ({result['reason']})" if result['reason'] else ""
+        print(f"{status} {result['volume']}: {result['s3_key']} {result['bytes'] / (1024 * 1024):.1f} MB{note}")
+    failed = sum(1 for result in results if not result['ok'])
+    print(f"Verified {len(results) - failed} of {len(results)} backups")
+    return failed == 0
 
-if __name__ == '__main__':
+# Function to verify backups on the daemon schedule
+def run_scheduled_verify():
+    """Verify the latest backups and send the outcome to Telegram"""
+    s3_client = get_s3_client()
+    if not s3_client:
+        logging.error("Cannot verify backups: S3 client initialization failed")
+        return
+    started = time.monotonic()
+    results = verify_backups(s3_client)
+    failed = [result for result in results if not result['ok']]
+    message = (f"🔍 **Backup verification**\n\n✅ {len(results) - len(failed)} of {len(results)} backups verified "
+               f"({sum(result['bytes'] for result in results) / (1024 * 1024):.1f} MB in {time.monotonic() - started:.0f}s)\n")
+    if failed:
+        message += f"\n❌ **Failed ({len(failed)}):**\n"
+        for result in failed:
+            message += f"• `{result['volume']}` {os.path.basename(result['s3_key'])} - {result['reason']}\n"
+    notifier.send_message(message, parse_mode='Markdown')
+
+# Function to format the live progress message of a run
+def format_backup_progress(volume_names, finished, started):
+    """
+    Progress of the volumes of a run: phase and time of the ones in progress,
+    throughput of every phase of the finished ones. `finished` maps the
+    names of finished volumes to their success
+    """
+    running = []
+    done = []
+    waiting = 0
+    for name in volume_names:
+        active, records = run_metrics.volume_progress(name)
+        rates = ", ".join(f"{record['phase']} {transfer_stats(record['bytes_in'], record['seconds'])['mb_per_s']:.1f} MB/s"
+                          for record in records if record['phase'] != 'scan' and record['success'])
+        if name in finished:
+            done.append(f"{'✅' if finished[name] else '❌'} `{name}` {rates}".rstrip())
+        elif active:
+            phase, seconds = active
+            running.append(f"🔄 `{name}` {phase} {int(seconds) // 60}:{int(seconds) % 60:02d}"
+                           + (f" ({rates})" if rates else ""))
+        elif rates:
+            # Between two phases, e.g. compressed and waiting for an upload thread
+            running.append(f"⏸️ `{name}` queued ({rates})")
+        else:
+            waiting += 1
+    elapsed = int(time.time() - started)
+    title = "⏳ **Backup in progress**" if len(finished) < len(volume_names) else "📦 **Volumes processed**"
+    lines = [f"{title} - {len(finished)} of {len(volume_names)} volumes, "
+             f"{elapsed // 60}:{elapsed % 60:02d}", ""] + running
+    if waiting:
+        lines.append(f"⏸️ {waiting} waiting")
+    return "\n".join(lines + done)
+
+# Function to run a backup pass kept apart from `main.py prune`
+def run_backup(volume_filter=None, include_databases=True):
+    """
+    Run one backup pass (see run_backup_pass) under the shared
+    chunk_store_lock. The chunk index is read again, a daemon keeps running
+    while `main.py prune` deletes chunks
+    """
+    with chunk_store_lock() as lock_file:
+        reset_chunk_index()
+        return run_backup_pass(volume_filter, include_databases, lock_file)
+
+# Function to run one backup pass
+def run_backup_pass(volume_filter=None, include_databases=True, lock_file=None):
+    """
+    Dump databases, back up changed volumes and send the summary.
+    `volume_filter` limits the run to the volume names it returns True for,
+    `include_databases` turns the database dumps off. The retention step only
+    collects chunks if the chunk_store_lock `lock_file` can be made exclusive
+    """
     # Send custom message
-    bot.send_message(TELEGRAM_DEST_CHAT, TELEGRAM_BACKUP_MESSAGE)
+    notifier.send_message(TELEGRAM_BACKUP_MESSAGE)
+    run_id = start_catalog_run()
     # Create temporary output path
     if not os.path.exists(TMP_DIR):
         logging.info("Creating: [" + TMP_DIR + "] folder")
@@ -414,9 +5489,24 @@ if __name__ == '__main__':
     else:
         logging.warning("Folder: [" + TMP_DIR + "] already exists, this could cause some troubles")
     
+    # Abort multipart uploads left behind by crashed runs, they are billed but never complete
+    if S3_ENABLED and S3_BUCKET and ORPHAN_UPLOAD_MAX_AGE_HOURS > 0:
+        s3_client = get_s3_client()
+        if s3_client:
+            try:
+                aborted = sweep_orphaned_uploads(s3_client, ORPHAN_UPLOAD_MAX_AGE_HOURS)
+                if aborted:
+                    logging.info("Aborted %d orphaned multipart upload(s)", aborted)
+            except Exception as e:
+                logging.error("Cannot sweep orphaned multipart uploads: %s", str(e))
+    
+    # Pause mode takes no snapshots
+    if SNAPSHOT_MODE not in ('off', 'pause'):
+        remove_stale_snapshots()
+    
     # Detect database containers and dump them first
     logging.info("Detecting database containers and volumes...")
-    detected_dbs = detect_database_volumes()
+    detected_dbs = detect_database_volumes() if include_databases else []
     
     # Filter detected databases to only include those with volumes in ROOT_DIR
     relevant_dbs = []
@@ -431,36 +5521,19 @@ if __name__ == '__main__':
                                db_info['container'], volume_source)
                     break
     
-    # Dump databases first (before file backup to ensure consistency)
-    dumped_containers = []
-    for db_info in relevant_dbs:
-        container_name = db_info['container']
-        if container_name not in dumped_containers:
-            dump_file = dump_database(container_name, TMP_DIR)
-            if dump_file:
-                try:
-                    bot.send_document(TELEGRAM_DEST_CHAT, open(dump_file, 'rb'))
-                    logging.info("Database dump sent: [%s]", dump_file)
-                    # Delete dump file after sending
-                    os.remove(dump_file)
-                    logging.debug("Database dump file deleted: [%s]", dump_file)
-                    dumped_containers.append(container_name)
-                except Exception as retEx:
-                    logging.error("Cannot send database dump [%s]: %s", dump_file, str(retEx))
-    
     # Also dump containers explicitly listed in DB_CONTAINERS env var
-    for container_name in DB_CONTAINERS:
-        if container_name and container_name not in dumped_containers:
-            dump_file = dump_database(container_name, TMP_DIR)
-            if dump_file:
-                try:
-                    bot.send_document(TELEGRAM_DEST_CHAT, open(dump_file, 'rb'))
-                    logging.info("Database dump sent: [%s]", dump_file)
-                    # Delete dump file after sending
-                    os.remove(dump_file)
-                    logging.debug("Database dump file deleted: [%s]", dump_file)
-                except Exception as retEx:
-                    logging.error("Cannot send database dump [%s]: %s", dump_file, str(retEx))
+    dump_containers = []
+    for container_name in [db_info['container'] for db_info in relevant_dbs] + (DB_CONTAINERS if include_databases else []):
+        if container_name and container_name not in dump_containers:
+            dump_containers.append(container_name)
+    
+    # Dump databases first (before file backup to ensure consistency), several at once
+    database_dumps = dump_databases(dump_containers)
+    for dump in database_dumps:
+        record_snapshot(run_id, dump['container'], {
+            'kind': 'dump', 's3_key': dump['s3_key'], 'size_bytes': int(dump['size_mb'] * 1024 * 1024),
+            'source_bytes': int(dump['raw_mb'] * 1024 * 1024), 'codec': COMPRESSION, 'checksum': dump.get('checksum'),
+            'seconds': dump['seconds'], 'success': dump['success'], 'reason': dump['reason']})
     
     # Load previous backup state for incremental backup
     logging.info("Loading previous backup state...")
@@ -472,6 +5545,7 @@ if __name__ == '__main__':
     failed_files = []
     
     # Process path(s) list
+    volume_folders = []
     for singleLocation in DOCKER_VOLUME_DIRECTORIES:
         try:
             # Check if we can access that folder
@@ -483,84 +5557,103 @@ if __name__ == '__main__':
         for singleSubfolder in subFolders:
             folderToCompress = os.path.join(singleLocation, singleSubfolder)
             # Check if it is a folder
-            if os.path.isdir(folderToCompress):
+            if os.path.isdir(folderToCompress) and (volume_filter is None or volume_filter(singleSubfolder)):
                 logging.debug("Found valid folder: " + folderToCompress)
-                
-                # Check if volume needs backup (incremental backup)
-                needs_backup, volume_info = volume_needs_backup(folderToCompress, singleSubfolder, previous_state)
-                
-                if not needs_backup:
-                    logging.info("Skipping backup for volume [%s] - no changes detected", singleSubfolder)
-                    # Update current info but keep previous backup timestamp
-                    if volume_info:
-                        current_state[singleSubfolder] = {**volume_info, 
-                                                         'last_backup': previous_state.get(singleSubfolder, {}).get('last_backup')}
-                    continue
-                
-                archiveName = singleSubfolder + "-" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".tar.gz"
-                outputPath = os.path.join(TMP_DIR, archiveName)
-                
-                logging.info("Backing up changed volume: [%s]", singleSubfolder)
-                if (MakeTar(folderToCompress, outputPath)):
-                    logging.info("Successfully compressed: [" + outputPath + "]")
-                    
-                    # Send ALL files to S3, no Telegram file uploads
-                    file_size_mb = get_file_size_mb(outputPath)
-                    backup_successful = False
-                    
-                    # Upload to S3 if enabled and configured
-                    if S3_ENABLED and S3_BUCKET:
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        s3_key = f"{S3_PREFIX}{singleSubfolder}-{timestamp}.tar.gz"
-                        
-                        success, result = upload_to_s3(outputPath, s3_key)
-                        if success:
-                            s3_files.append({
-                                'name': singleSubfolder,
-                                'size_mb': file_size_mb,
-                                'method': 's3',
-                                'url': result,
-                                's3_key': s3_key
-                            })
-                            backup_successful = True
-                            logging.info("Document uploaded to S3: [%s] (%.1f MB)", singleSubfolder, file_size_mb)
-                        else:
-                            logging.error("S3 upload failed: %s", result)
-                    else:
-                        logging.warning("S3 not configured - file [%s] cannot be uploaded", singleSubfolder)
-                    
-                    # Update state only if backup was successful
-                    if backup_successful:
-                        current_state[singleSubfolder] = {**volume_info, 'last_backup': datetime.now().isoformat()}
-                    else:
-                        failed_files.append({
-                            'name': singleSubfolder,
-                            'size_mb': file_size_mb,
-                            'reason': 'S3 upload failed or not configured'
-                        })
-                        if volume_info:
-                            current_state[singleSubfolder] = volume_info
-                    
-                    # Delete archive
-                    try:
-                        os.remove(outputPath)
-                        logging.debug("File: [" + outputPath + "] was deleted successfully")
-                    except Exception as retEx:
-                        logging.error("Error while deleting: [" + str(retEx) + "]")
-                else:
-                    logging.error("Cannot compress: [" + outputPath + "]")
-                    failed_files.append({
-                        'name': singleSubfolder,
-                        'size_mb': 0,
-                        'reason': 'Compression failed'
-                    })
-                    # Don't update state if compression failed
-                    if volume_info:
-                        current_state[singleSubfolder] = volume_info
+                volume_folders.append((singleSubfolder, folderToCompress))
+    
+    # Check which volumes need backup (incremental backup), several volumes are scanned at once
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="volume-scan") as scan_pool:
+        scan_results = list(scan_pool.map(lambda volume: volume_needs_backup(volume[1], volume[0], previous_state),
+                                          volume_folders))
+    
+    changed_volumes = []
+    for (singleSubfolder, folderToCompress), (needs_backup, volume_info) in zip(volume_folders, scan_results):
+        if not needs_backup:
+            logging.info("Skipping backup for volume [%s] - no changes detected", singleSubfolder)
+            # Update current info but keep previous backup timestamp
+            if volume_info:
+                previous_entry = previous_state.get(singleSubfolder, {})
+                current_state[singleSubfolder] = {**volume_info, 
+                                                 'last_backup': previous_entry.get('last_backup'),
+                                                 **{field: previous_entry[field] for field in CHAIN_FIELDS
+                                                    if field in previous_entry}}
+                commit_manifest(singleSubfolder, folderToCompress)
+            continue
+        
+        logging.info("Backing up changed volume: [%s]", singleSubfolder)
+        changed_volumes.append(plan_volume_backup(singleSubfolder, folderToCompress, volume_info,
+                                                  previous_state.get(singleSubfolder)))
+    
+    # Runs in the pipeline threads as each volume finishes, so its state is saved right away
+    finished_volumes = {}
+    def on_volume_done(volume, result):
+        finished_volumes[volume['name']] = result['success']
+        previous_entry = previous_state.get(volume['name']) or {}
+        entry = None
+        if result['success']:
+            entry = record_volume_backup(volume, result, previous_entry)
+            commit_manifest(volume['name'], volume['path'])
+        else:
+            # Keep the state of the last backup if compression or upload failed: the next run sees the
+            # changes again, and a new volume is picked up again, so the checkpointed upload can resume
+            if previous_entry:
+                entry = previous_entry
+            if volume_watcher:
+                volume_watcher.mark_full_scan([volume['name']])
+        if entry is not None:
+            current_state[volume['name']] = entry
+        incremental = volume['backup_type'] == 'incremental'
+        record_snapshot(run_id, volume['name'], {
+            'kind': volume['backup_type'], 's3_key': result['s3_key'],
+            'size_bytes': int(result['size_mb'] * 1024 * 1024),
+            'source_bytes': volume['reserve_bytes'] if incremental else (volume['info'] or {}).get('size'),
+            'codec': 'zlib' if volume['backup_type'] == 'chunked' else COMPRESSION,
+            'checksum': result.get('checksum'), 'seconds': run_metrics.volume_seconds(volume['name']),
+            'success': result['success'], 'reason': result['reason']}, entry)
+    
+    # Compress and upload changed volumes in parallel, while a Telegram message shows how far they got
+    if changed_volumes:
+        volume_names = [volume['name'] for volume in changed_volumes]
+        pipeline_started = time.time()
+        notifier.start_progress(lambda: format_backup_progress(volume_names, finished_volumes, pipeline_started))
+    pipeline_results = run_backup_pipeline(changed_volumes, on_volume_done)
+    if changed_volumes:
+        notifier.stop_progress()
+    for volume, result in zip(changed_volumes, pipeline_results):
+        if result['success']:
+            s3_files.append({
+                'name': volume['name'],
+                'size_mb': result['size_mb'],
+                'method': 's3',
+                'url': result['url'],
+                's3_key': result['s3_key'],
+                'mb_per_s': result['mb_per_s'],
+                'backup_type': volume['backup_type']
+            })
+        else:
+            failed_files.append({
+                'name': volume['name'],
+                'size_mb': result['size_mb'],
+                'reason': result['reason']
+            })
     
     # Save updated backup state
     save_backup_state(current_state)
     
+    # Apply the retention policies now that the new backups are in place
+    prune_report = None
+    if S3_ENABLED and S3_BUCKET and retention_configured():
+        s3_client = get_s3_client()
+        if s3_client:
+            # Another backup may be deduplicating against the chunks, leave them to a later prune
+            collect_chunks = lock_file is not None and upgrade_chunk_store_lock(lock_file)
+            if not collect_chunks:
+                logging.info("Another backup is running, unreferenced chunks are collected by a later prune")
+            try:
+                prune_report = prune_backups(s3_client, collect_chunks=collect_chunks)
+            except Exception as e:
+                logging.error("Cannot apply the retention policies: %s", str(e))
+    
     # Send enhanced summary message to Telegram
     skipped_volumes = [vol for vol, info in current_state.items() 
                       if info and 'last_backup' not in info]
@@ -571,7 +5664,11 @@ if __name__ == '__main__':
     if s3_files:
         summary_message += f"☁️ **Uploaded to Backblaze B2 ({len(s3_files)}):**\n"
         for file_info in s3_files:
-            summary_message += f"• `{file_info['name']}` ({file_info['size_mb']:.1f} MB)\n"
+            kind = ", incremental" if file_info['backup_type'] == 'incremental' else ""
+            cpu_saved = run_metrics.volume_cpu_saved(file_info['name'])
+            if cpu_saved >= 0.1:
+                kind += f", {cpu_saved:.1f}s CPU saved"
+            summary_message += f"• `{file_info['name']}` ({file_info['size_mb']:.1f} MB, {file_info['mb_per_s']:.1f} MB/s{kind})\n"
         summary_message += "\n"
     
     # Failed files
@@ -590,17 +5687,24 @@ if __name__ == '__main__':
         summary_message += "\n"
     
     # Database dumps
-    if dumped_containers:
-        summary_message += f"🗄️ **Database dumps ({len(dumped_containers)}):**\n"
-        for container in dumped_containers:
-            summary_message += f"• `{container}`\n"
+    if database_dumps:
+        summary_message += f"🗄️ **Database dumps ({len(database_dumps)}):**\n"
+        for dump in database_dumps:
+            if dump['success']:
+                summary_message += (f"• `{dump['container']}` ({dump['raw_mb']:.1f} MB → {dump['size_mb']:.1f} MB, "
+                                    f"{dump['seconds']:.1f}s, {dump['mb_per_s']:.1f} MB/s)\n")
+            else:
+                summary_message += f"• ❌ `{dump['container']}` - {dump['reason']}\n"
         summary_message += "\n"
     
     # B2 download links
-    if s3_files:
+    if s3_files or any(dump['success'] for dump in database_dumps):
         summary_message += f"🔗 **Download Links (7-day expiry):**\n"
         for file_info in s3_files:
             summary_message += f"[{file_info['name']}]({file_info['url']})\n"
+        for dump in database_dumps:
+            if dump['success']:
+                summary_message += f"[{dump['container']} (database)]({dump['url']})\n"
         summary_message += "\n"
     
     # Summary stats
@@ -610,21 +5714,301 @@ if __name__ == '__main__':
     if total_backed_up > 0:
         summary_message += f"📊 **Total: {total_backed_up} files ({total_size_mb:.1f} MB)**\n"
     
+    if prune_report and prune_report['deleted']:
+        summary_message += (f"🧹 Pruned {prune_report['deleted'] - len(prune_report['failed'])} old backup objects "
+                            f"({prune_report['deleted_bytes'] / (1024 * 1024):.1f} MB)\n")
+    
+    # Where the time went
+    phase_totals = run_metrics.phase_totals()
+    if phase_totals:
+        summary_message += "⏱️ " + ", ".join(f"{phase} {total['seconds']:.1f}s" for phase, total in phase_totals.items()) + "\n"
+    
     summary_message += f"📅 Completed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     
-    try:
-        bot.send_message(TELEGRAM_DEST_CHAT, summary_message, parse_mode='Markdown')
-        logging.info("Backup summary sent to Telegram")
-    except Exception as retEx:
-        logging.error("Cannot send summary message: [%s]", str(retEx))
+    # Long summaries are split into several messages by the notifier
+    notifier.send_message(summary_message, parse_mode='Markdown')
+
+    # Export run metrics
+    run_metrics.counts.update({'backed_up': len(s3_files), 'failed': len(failed_files),
+                               'skipped': len(skipped_volumes),
+                               'dumped': sum(1 for dump in database_dumps if dump['success']),
+                               'dump_failed': sum(1 for dump in database_dumps if not dump['success'])})
+    failed = len(failed_files) + run_metrics.counts['dump_failed']
+    finish_catalog_run(run_id, 'failed' if failed else 'success', len(s3_files) + run_metrics.counts['dumped'],
+                       failed, len(skipped_volumes), time.time() - run_metrics.started)
+    for metrics_file, write_metrics in ((METRICS_REPORT_FILE, run_metrics.write_report),
+                                        (METRICS_TEXTFILE, run_metrics.write_prometheus)):
+        if metrics_file:
+            try:
+                write_metrics(metrics_file)
+            except Exception as e:
+                logging.error("Cannot write metrics to [%s]: %s", metrics_file, str(e))
+
+    # Done, bye! The log file goes out last, only the wait for Telegram is missing from it
+    logging.info("Completed!")
+    notifier.send_document(log_file_name)
+    if not notifier.flush(TELEGRAM_FLUSH_TIMEOUT):
+        logging.warning("Telegram messages still unsent after %ds", TELEGRAM_FLUSH_TIMEOUT)
+
+
+# Cron-like schedule
+class CronSchedule:
+    """
+    Standard 5-field cron expression (minute, hour, day of month, month,
+    day of week) with `*`, lists, ranges and steps. Like cron, when both day
+    fields are restricted a day matching either of them is due
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expected 5 cron fields in [{expression}]")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse_field(field, low, high) for field, (low, high) in zip(fields, self.FIELDS))
+        # Sunday is both 0 and 7
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = (int(value) for value in value_range.split('-'))
+            else:
+                start = int(value_range)
+                end = high if step else start
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field [{field}] out of range {low}-{high}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, moment):
+        day_match = moment.day in self.days
+        # isoweekday() is 1 (Monday) to 7 (Sunday), cron counts from Sunday = 0
+        weekday_match = moment.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_after(self, moment):
+        """First minute after `moment` the schedule is due"""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months or not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression [{self.expression}] never runs")
+
+# Function to parse the per-volume schedules
+def parse_volume_schedules(value):
+    """Parse "volume=cron;volume=cron" into volume name -> CronSchedule, invalid entries are logged and skipped"""
+    schedules = {}
+    for entry in filter(None, (item.strip() for item in value.split(';'))):
+        name, _, expression = entry.partition('=')
+        try:
+            schedules[name.strip()] = CronSchedule(expression)
+        except ValueError as e:
+            logging.error("Invalid VOLUME_SCHEDULES entry [%s]: %s", entry, str(e))
+    return schedules
+
+# Function to start a new log file
+def start_run_log():
+    """Point logging at a fresh file, so each daemon run sends only its own log"""
+    global log_file_name
+    log_file_name = os.path.join(os.path.dirname(log_file_name), datetime.now().strftime("%Y%m%d_%H%M%S") + ".txt")
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, logging.FileHandler):
+            root_logger.removeHandler(handler)
+            handler.close()
+    handler = logging.FileHandler(log_file_name)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root_logger.addHandler(handler)
+
+# Function to run backups on a schedule
+def run_daemon():
+    """
+    Stay resident and run backups on BACKUP_SCHEDULE, with the volumes listed
+    in VOLUME_SCHEDULES on their own schedule. The S3 and Docker clients
+    stay open between runs, the chunk index is read again for each run since
+    `main.py prune` may have deleted chunks in between. SIGTERM stops the
+    daemon: a running backup completes, but uploads stop at the next part
+    and resume from their checkpoint on the next start. A second SIGTERM
+    exits at once
+    """
+    global run_metrics, volume_watcher
+    default_schedule = CronSchedule(BACKUP_SCHEDULE)
+    volume_schedules = parse_volume_schedules(VOLUME_SCHEDULES)
+    running = threading.Event()
+    
+    def handle_signal(signum, frame):
+        if shutdown_requested.is_set() or not running.is_set():
+            logging.warning("Signal %d received, exiting now", signum)
+            raise SystemExit(0)
+        logging.warning("Signal %d received, stopping after the running backup", signum)
+        shutdown_requested.set()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    
+    def next_due(schedule):
+        return schedule.next_after(datetime.now()) + timedelta(seconds=random.uniform(0, SCHEDULE_JITTER_SECONDS))
+    
+    if WATCH_VOLUMES:
+        try:
+            volume_watcher = VolumeWatcher(DOCKER_VOLUME_DIRECTORIES)
+        except (AttributeError, OSError) as e:
+            logging.warning("Cannot watch volumes with inotify, every run scans them in full: %s", str(e))
+    
+    # None stands for the default schedule: databases and every volume without its own schedule
+    schedules = {None: default_schedule, **volume_schedules}
+    due = {key: next_due(schedule) for key, schedule in schedules.items()}
+    verify_schedule = CronSchedule(VERIFY_SCHEDULE) if VERIFY_SCHEDULE else None
+    verify_due = next_due(verify_schedule) if verify_schedule else None
+    logging.info("Daemon started, next backup at %s", min(due.values()).strftime('%Y-%m-%d %H:%M:%S'))
+    
+    while not shutdown_requested.is_set():
+        now = datetime.now()
+        upcoming = min(list(due.values()) + ([verify_due] if verify_due else []))
+        if upcoming > now:
+            # Wake up at least every minute, so clock changes don't delay a run
+            shutdown_requested.wait(min((upcoming - now).total_seconds(), 60))
+            continue
+        
+        if verify_due and verify_due <= now:
+            # Only reads the bucket, so a signal may stop it right away
+            logging.info("Scheduled verification")
+            try:
+                run_scheduled_verify()
+            except Exception as e:
+                logging.exception("Scheduled verification failed: %s", str(e))
+            verify_due = next_due(verify_schedule)
+            continue
+        
+        due_keys = {key for key, when in due.items() if when <= now}
+        if None in due_keys:
+            def volume_filter(name):
+                return name not in volume_schedules or name in due_keys
+        else:
+            def volume_filter(name):
+                return name in due_keys
+        
+        start_run_log()
+        run_metrics = RunMetrics()
+        running.set()
+        logging.info("Scheduled backup: %s", ", ".join(sorted(key or "default" for key in due_keys)))
+        try:
+            run_backup(volume_filter, include_databases=None in due_keys)
+        except Exception as e:
+            logging.exception("Scheduled backup failed: %s", str(e))
+            # Changes taken by the failed run must not be lost
+            if volume_watcher:
+                volume_watcher.mark_full_scan()
+        finally:
+            running.clear()
+        
+        for key in due_keys:
+            due[key] = next_due(schedules[key])
+        logging.info("Next backup at %s", min(due.values()).strftime('%Y-%m-%d %H:%M:%S'))
+    
+    logging.info("Daemon stopped")
+
 
+# Function to profile a call across all of its threads
+def profile_call(function, output_path):
+    """
+    Run `function` under cProfile and save the stats to `output_path`.
+    Threads started meanwhile get their own profiler, merged into the same
+    stats. Compression worker processes are not profiled
+    """
+    thread_profilers = []
+    profilers_lock = threading.Lock()
+    
+    def start_thread_profiler(frame, event, arg):
+        # First profile event of a new thread, cProfile takes over from here
+        profiler = cProfile.Profile()
+        with profilers_lock:
+            thread_profilers.append(profiler)
+        profiler.enable()
+    
+    main_profiler = cProfile.Profile()
+    threading.setprofile(start_thread_profiler)
+    main_profiler.enable()
     try:
-        # Send log file
-        bot.send_document(TELEGRAM_DEST_CHAT, open(log_file_name, 'rb'))
-        logging.debug("Backup file sent")
-    except Exception as retEx:
-        logging.error("Error while sending log file: [" + str(retEx) + "]")
+        return function()
+    finally:
+        main_profiler.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(main_profiler)
+        with profilers_lock:
+            for profiler in thread_profilers:
+                stats.add(profiler)
+        stats.dump_stats(output_path)
+        logging.info("Profile of %d thread(s) written to [%s]", len(thread_profilers) + 1, output_path)
 
 
-    # Done, bye!
-    logging.info("Completed!")
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Docker volume backup to Backblaze B2 with Telegram notifications")
+    subparsers = parser.add_subparsers(dest='command')
+    backup_parser = subparsers.add_parser('backup', help="run a backup pass (default)")
+    backup_parser.add_argument('--profile', metavar='FILE', default=PROFILE_FILE,
+                               help="save cProfile stats of this run to FILE (read them with pstats)")
+    subparsers.add_parser('daemon', help="stay resident and run backups on BACKUP_SCHEDULE")
+    history_parser = subparsers.add_parser('history', help="show the backups recorded in the catalog")
+    history_parser.add_argument('volume', nargs='?', help="only show this volume or database container")
+    snapshots_parser = subparsers.add_parser('snapshots', help="list the backups stored in the bucket")
+    snapshots_parser.add_argument('volume', nargs='?', help="only list this volume")
+    restore_parser = subparsers.add_parser('restore', help="restore a volume from its last full backup and incrementals")
+    restore_parser.add_argument('volume', help="volume name, as shown in the backup summary")
+    restore_parser.add_argument('target_dir', help="folder to restore into")
+    restore_parser.add_argument('--snapshot', metavar='TIMESTAMP',
+                                help="restore this snapshot (as listed by `snapshots`) instead of the latest")
+    restore_parser.add_argument('--path', dest='paths', action='append', metavar='PATH',
+                                help="only restore this file or folder, relative to the volume (repeatable)")
+    verify_parser = subparsers.add_parser('verify', help="read backups back from the bucket and check them")
+    verify_parser.add_argument('volume', nargs='?', help="only verify this volume or database container")
+    verify_parser.add_argument('--all', dest='all_snapshots', action='store_true',
+                               help="verify every stored backup, not only what the latest snapshot needs")
+    prune_parser = subparsers.add_parser('prune', help="delete backups the retention policies no longer keep")
+    prune_parser.add_argument('volume', nargs='?', help="only prune this volume or database container")
+    prune_parser.add_argument('--dry-run', action='store_true', help="only report what would be deleted")
+    decrypt_parser = subparsers.add_parser('decrypt', help="decrypt a backup downloaded from the bucket")
+    decrypt_parser.add_argument('input', help="downloaded archive, segment, index or dump")
+    decrypt_parser.add_argument('output', nargs='?', help="file to write, stdout by default")
+    args = parser.parse_args()
+    
+    if args.command == 'history':
+        sys.exit(0 if print_history(args.volume) else 1)
+    if args.command == 'snapshots':
+        sys.exit(0 if print_snapshots(args.volume) else 1)
+    if args.command == 'restore':
+        sys.exit(0 if restore_volume(args.volume, args.target_dir, args.snapshot, args.paths) else 1)
+    if args.command == 'verify':
+        sys.exit(0 if verify_volumes(args.volume, args.all_snapshots) else 1)
+    if args.command == 'prune':
+        sys.exit(0 if prune_volumes(args.volume, args.dry_run) else 1)
+    if args.command == 'decrypt':
+        sys.exit(0 if decrypt_file(args.input, args.output) else 1)
+    if args.command == 'daemon':
+        run_daemon()
+        sys.exit(0)
+    profile_file = getattr(args, 'profile', PROFILE_FILE)
+    if profile_file:
+        profile_call(run_backup, profile_file)
+    else:
+        run_backup()